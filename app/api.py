@@ -1,76 +1,116 @@
+import asyncio
 import base64
 import datetime
+import functools
 import os
-from io import BytesIO
+import queue
+import threading
+import time
+from contextlib import asynccontextmanager
+from contextvars import copy_context
 from typing import List
 from typing import Optional
+from typing import Tuple
+from typing import Union
 
+import anyio
 from dotenv import load_dotenv
 from fastapi import FastAPI
 from fastapi import HTTPException
+from fastapi import Query
 from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-from langchain.agents import AgentExecutor
-from langchain.agents import create_tool_calling_agent
-from langchain.agents.agent import RunnableAgent
-from langchain_core.messages import AIMessage
-from langchain_core.messages import HumanMessage
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
+from fastapi.responses import PlainTextResponse
+from fastapi.responses import Response
+from fastapi.responses import StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST
+from prometheus_client import generate_latest
 from pydantic import BaseModel
-from supabase import create_client
 
+from app.common import BATCH_MAX_QUESTIONS
 from app.common import logger
-from app.common import MODEL_AGENT
-from app.common import OPENAI_API_KEY
-from app.common import system_prompt
-from app.common.structured_tools import StructuredTool
-from app.common.unstructured_tools import UnstructuredTool
+from app.common import PROFILE_MAX_SECONDS
+from app.common import REQUEST_DEADLINE_SECONDS
+from app.common import RESPONSE_COMPRESSION_MIN_BYTES
+from app.common import tracing
+from app.common import WARMUP_ON_STARTUP
+from app.common import WARMUP_SYNTHESIS
+from app.common.deadline import DEADLINE_EXCEEDED_RESPONSE
+from app.common.deadline import parse_deadline_header
+from app.common.deadline import record_degradation
+from app.common.deadline import start_deadline
+from app.common.encoding import encoded_response
+from app.common.encoding import json_body
+from app.common.metrics import CHAT_BACKEND_LOAD
+from app.common.metrics import timed
+from app.common.middleware import AuthMiddleware
+from app.common.middleware import bearer_key
+from app.common.middleware import CompressionMiddleware
+from app.common.middleware import key_matches
+from app.common.profiling import load_profile
+from app.common.profiling import profile_window
+from app.common.profiling import profiled
 
 load_dotenv()
 
-app = FastAPI()
 
-# Get API keys from environment and split into list
-API_KEYS = set(os.getenv("API_KEYS", "").split(","))
+# The agent, its tools and their indexes, LangChain and Supabase live in app.chat, imported on the
+# first request that needs them rather than with the API: the process serves /api/health and
+# /metrics within a second of starting, while the chat backend loads in the background.
+chat_backend_loaded = threading.Event()
+chat_backend_error: Optional[Exception] = None
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise ValueError("Supabase URL and Key must be set in environment variables")
+def chat_backend():
+    """
+    The chat backend module, imported on first use; concurrent callers wait for the import. The
+    outcome of the last import is what /api/health reports, so a failed import retried by a later
+    request makes the API healthy again.
+    """
+    global chat_backend_error
+    try:
+        from app import chat
+    except Exception as e:
+        logger.error(f"Error loading the chat backend: {str(e)}")
+        chat_backend_error = e
+        raise
+    chat_backend_error = None
+    chat_backend_loaded.set()
+    return chat
 
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 
+def preload() -> None:
+    """Import the chat backend, then warm its caches if configured."""
+    start = time.monotonic()
+    try:
+        chat = chat_backend()
+    except Exception:
+        return
+    CHAT_BACKEND_LOAD.set(time.monotonic() - start)
+    logger.info(f"Chat backend loaded in {time.monotonic() - start:.2f}s")
+    if WARMUP_ON_STARTUP:
+        chat.warm_caches()
 
-def store_conversation(user_id: str, chat_history: List[dict]):
-    """Stores updated chat history in Supabase."""
-    data = {
-        "user_id": user_id,
-        "chat_history": chat_history,  # JSON data
-    }
-    response = (
-        supabase.table("conversations")
-        .insert(
-            data,
-        )
-        .execute()
-    )
-    return response
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the API serves while the chat backend loads and the caches warm up
+    threading.Thread(target=preload, name="preload", daemon=True).start()
+    yield
 
-# HTTPS enforcement middleware for production
-@app.middleware("http")
-async def enforce_https(request: Request, call_next):
-    if os.getenv("environment") == "production":
-        if request.url.scheme != "https":
-            return JSONResponse(
-                status_code=403, content={"detail": "HTTPS is required in production"}
-            )
-    return await call_next(request)
 
+app = FastAPI(lifespan=lifespan)
+
+# Get API keys from environment and split into list
+API_KEYS = {key for key in os.getenv("API_KEYS", "").split(",") if key}
+# Keys that may also profile requests
+ADMIN_API_KEYS = {key for key in os.getenv("ADMIN_API_KEYS", "").split(",") if key}
+
+# Paths served without an API key
+PUBLIC_PATHS = {"/api/health", "/metrics"}
 
 # Configure CORS with more specific settings
 app.add_middleware(
@@ -83,23 +123,21 @@ app.add_middleware(
 )
 
 
-# Add API key validation middleware
-@app.middleware("http")
-async def validate_api_key(request: Request, call_next):
-    if request.url.path == "/api/health":
-        return await call_next(request)
+# Compression of the responses negotiated with Accept-Encoding
+app.add_middleware(CompressionMiddleware, minimum_size=RESPONSE_COMPRESSION_MIN_BYTES)
 
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return JSONResponse(
-            status_code=401, content={"detail": "Missing or invalid Authorization header"}
-        )
 
-    api_key = auth_header.split(" ")[1]
-    if api_key not in API_KEYS:
-        return JSONResponse(status_code=403, content={"detail": "Invalid API key"})
+# HTTPS enforcement in production and API key validation, added last so it runs before CORS
+app.add_middleware(
+    AuthMiddleware,
+    api_keys=API_KEYS | ADMIN_API_KEYS,
+    public_paths=PUBLIC_PATHS,
+    require_https=os.getenv("environment") == "production",
+)
+
 
-    return await call_next(request)
+def is_admin(request: Request) -> bool:
+    return key_matches(bearer_key(request.headers), ADMIN_API_KEYS)
 
 
 @app.exception_handler(RequestValidationError)
@@ -119,29 +157,6 @@ async def general_exception_handler(request, exc):
     )
 
 
-# Initialize the chat components
-prompt_template = ChatPromptTemplate.from_messages(
-    [
-        ("system", system_prompt.format(date=datetime.datetime.now().strftime("%Y-%m-%d"))),
-        ("placeholder", "{chat_history}"),
-        ("human", "{input}"),
-        ("placeholder", "{agent_scratchpad}"),
-    ]
-)
-
-llm = ChatOpenAI(
-    model=MODEL_AGENT,
-    api_key=OPENAI_API_KEY,
-)
-
-tools = [UnstructuredTool(), StructuredTool()]
-runnable = create_tool_calling_agent(llm, tools, prompt_template)
-agent = RunnableAgent(runnable=runnable)
-agent_executor = AgentExecutor(
-    agent=agent, tools=tools, verbose=True, return_intermediate_steps=True
-)
-
-
 class Message(BaseModel):
     role: str
     content: str
@@ -164,52 +179,81 @@ class ChatResponse(BaseModel):
 
 
 @app.post("/api/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
-    try:
-        # Extract the last user message and convert previous messages to chat history
-        chat_history = []
-        for msg in request.messages[:-1]:  # All messages except the last one
-            if msg.role == "user":
-                chat_history.append(HumanMessage(content=msg.content))
-            elif msg.role == "assistant":
-                chat_history.append(AIMessage(content=msg.content))
+async def chat(request: ChatRequest, http_request: Request, response: Response):
+    sampled = tracing.should_sample(http_request.headers.get("X-Trace-Sample"))
+    profile = http_request.headers.get("X-Profile") == "1" and is_admin(http_request)
+    deadline_seconds = parse_deadline_header(
+        http_request.headers.get("X-Deadline-Ms"), REQUEST_DEADLINE_SECONDS
+    )
+    with tracing.start_trace(
+        "chat", sampled, messages=len(request.messages)
+    ) as trace, start_deadline(deadline_seconds) as deadline:
+        response.headers["X-Trace-Id"] = trace.trace_id
+        # the agent, the tools and Supabase block, so keep them off the event loop; at the
+        # deadline the request is answered and the thread left to finish on its own
+        worker = anyio.to_thread.run_sync(
+            functools.partial(copy_context().run, _profiled_chat, request, response, profile),
+            abandon_on_cancel=True,
+        )
+        try:
+            result = await asyncio.wait_for(
+                worker, timeout=deadline.remaining() if deadline is not None else None
+            )
+        except asyncio.TimeoutError:
+            record_degradation("deadline_exceeded")
+            result = ChatResponse(role="assistant", content=DEADLINE_EXCEEDED_RESPONSE)
+        if deadline is not None and deadline.degraded:
+            response.headers["X-Degraded"] = ",".join(dict.fromkeys(deadline.degraded))
+        headers = {name: value for name, value in response.headers.items() if name.startswith("x-")}
+        return encoded_response(result.dict(), http_request.headers.get("Accept"), headers)
+
+
+def _profiled_chat(request: ChatRequest, response: Response, profile: bool) -> ChatResponse:
+    with profiled(profile) as profiler:
+        if profiler is not None:
+            response.headers["X-Profile-Id"] = profiler.profile_id
+        return _chat(request)
+
+
+def format_output(output: Union[dict, str]) -> Tuple[str, List[Image]]:
+    """Answer and base64 page images of an agent or tool output."""
+    if not isinstance(output, dict):
+        return output, []
+
+    from app.common.utils import image_png
+
+    images = []
+    # Convert PIL images to base64 strings
+    if "image" in output:
+        with timed("image_encoding") as span:
+            for img in output["image"]:
+                img_base64 = base64.b64encode(image_png(img)).decode()
+
+                caption = f"{img.info['file_name']} - Page {img.info['page']}"
+                images.append(Image(base64=img_base64, caption=caption))
+            span.set_attributes(
+                images=len(images), image_bytes=sum(len(img.base64) for img in images)
+            )
+    return output["result"], images
 
-        # Get the last user message
-        user_message = request.messages[-1].content
 
+def _chat(request: ChatRequest) -> ChatResponse:
+    try:
+        chat = chat_backend()
         # Prepare input for the agent
-        input_ = {
-            "chat_history": chat_history,
-            "input": user_message,
-        }
+        input_ = chat.agent_input([msg.dict() for msg in request.messages])
 
         # Execute the agent
-        result = agent_executor.invoke(input=input_)
+        with timed("agent_run"):
+            result = chat.run_agent(input_)
 
         # Process the result
-        response_content = ""
-        images = []
-
-        if isinstance(result["output"], dict):
-            response_content = result["output"]["result"]
-
-            # Convert PIL images to base64 strings
-            if "image" in result["output"]:
-                for img in result["output"]["image"]:
-                    buffered = BytesIO()
-                    img.save(buffered, format="PNG")
-                    img_base64 = base64.b64encode(buffered.getvalue()).decode()
-
-                    caption = f"{img.info['file_name']} - Page {img.info['page']}"
-                    images.append(Image(base64=img_base64, caption=caption))
-
-        else:
-            response_content = result["output"]
+        response_content, images = format_output(result["output"])
 
         # Store conversation in Supabase
         all_messages = request.messages + [Message(role="assistant", content=response_content)]
         chat_history_for_db = [msg.dict() for msg in all_messages]
-        store_conversation(request.userId, chat_history_for_db)
+        chat.store_conversation(request.userId, chat_history_for_db)
 
         return ChatResponse(
             role="assistant", content=response_content, images=images if images else None
@@ -220,12 +264,195 @@ async def chat(request: ChatRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+class BatchQuestion(BaseModel):
+    question: str
+    id: Optional[str] = None  # echoed in the result, e.g. the row of a question sheet
+
+
+class BatchRequest(BaseModel):
+    questions: List[BatchQuestion]
+
+
+class BatchResult(BaseModel):
+    index: int
+    id: Optional[str] = None
+    content: Optional[str] = None
+    images: Optional[List[Image]] = None
+    error: Optional[str] = None
+
+
+class WarmupRequest(BaseModel):
+    questions: Optional[List[str]] = None
+    synthesis: bool = WARMUP_SYNTHESIS
+
+
+@app.post("/api/batch")
+async def batch(request: BatchRequest, http_request: Request):
+    """
+    Answer independent questions without chat history, streamed as NDJSON lines (BatchResult) in
+    the order they finish.
+    """
+    if not request.questions:
+        raise HTTPException(status_code=400, detail="No questions")
+    if len(request.questions) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(
+            status_code=400, detail=f"At most {BATCH_MAX_QUESTIONS} questions per batch"
+        )
+
+    sampled = tracing.should_sample(http_request.headers.get("X-Trace-Sample"))
+    lines: "queue.Queue[Optional[str]]" = queue.Queue()
+    cancelled = threading.Event()
+    # the batch runs in its own thread and trace, the response streams its lines as they come
+    threading.Thread(
+        target=copy_context().run,
+        args=(_run_batch, request.questions, sampled, lines, cancelled),
+        daemon=True,
+    ).start()
+    trace_id = await run_in_threadpool(lines.get)
+    return StreamingResponse(
+        _stream_lines(lines, cancelled),
+        media_type="application/x-ndjson",
+        headers={"X-Trace-Id": trace_id},
+    )
+
+
+def _run_batch(
+    questions: List[BatchQuestion],
+    sampled: bool,
+    lines: "queue.Queue[Optional[str]]",
+    cancelled: threading.Event,
+) -> None:
+    def emit(index: int, output: Optional[Union[dict, str]], error: Optional[Exception]) -> None:
+        result = BatchResult(index=index, id=questions[index].id)
+        if error is not None:
+            result.error = str(error)
+        else:
+            result.content, images = format_output(output)
+            result.images = images or None
+        lines.put(json_body(result.dict()).decode() + "\n")
+
+    try:
+        with tracing.start_trace("batch", sampled, questions=len(questions)) as trace:
+            lines.put(trace.trace_id)
+            chat_backend().answer_batch([item.question for item in questions], emit, cancelled)
+    except Exception as e:
+        logger.error(f"Error in batch endpoint: {str(e)}")
+    finally:
+        lines.put(None)
+
+
+def _stream_lines(lines: "queue.Queue[Optional[str]]", cancelled: threading.Event):
+    try:
+        while True:
+            line = lines.get()
+            if line is None:
+                break
+            yield line
+    finally:
+        cancelled.set()
+
+
 # Make the health check more informative
 @app.get("/api/health")
 async def health_check():
+    if chat_backend_error is not None:
+        return JSONResponse(
+            status_code=503, content={"status": "unhealthy", "detail": str(chat_backend_error)}
+        )
+    if not chat_backend_loaded.is_set():
+        return JSONResponse(status_code=503, content={"status": "starting"})
+
+    from app.common.vector_store import registry
+
     try:
         # Add any critical dependencies check here
-        return {"status": "healthy", "timestamp": datetime.datetime.now().isoformat()}
+        return {
+            "status": "healthy",
+            "timestamp": datetime.datetime.now().isoformat(),
+            "collections": registry.versions(),
+        }
     except Exception as e:
         logger.error(f"Health check failed: {str(e)}")
         return JSONResponse(status_code=503, content={"status": "unhealthy", "detail": str(e)})
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.post("/admin/profile")
+async def profile(request: Request, seconds: float = Query(10.0, gt=0, le=PROFILE_MAX_SECONDS)):
+    """Profiles the whole process for a time window and returns the collapsed stacks."""
+    if not is_admin(request):
+        raise HTTPException(status_code=403, detail="Admin API key required")
+
+    profiler = await run_in_threadpool(profile_window, seconds)
+    return PlainTextResponse(profiler.collapsed(), headers={"X-Profile-Id": profiler.profile_id})
+
+
+@app.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str, request: Request):
+    if not is_admin(request):
+        raise HTTPException(status_code=403, detail="Admin API key required")
+
+    collapsed = load_profile(profile_id)
+    if collapsed is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(collapsed)
+
+
+@app.post("/admin/warmup")
+async def warmup(request: Request, warmup_request: Optional[WarmupRequest] = None):
+    """
+    Warm the caches with the given questions, by default the suggested and most frequent ones,
+    and return what was warmed. The LLM synthesis is skipped unless `synthesis` is set.
+    """
+    if not is_admin(request):
+        raise HTTPException(status_code=403, detail="Admin API key required")
+
+    warmup_request = warmup_request or WarmupRequest()
+    chat = await run_in_threadpool(chat_backend)
+    return await run_in_threadpool(
+        chat.warm_caches, warmup_request.questions, warmup_request.synthesis
+    )
+
+
+@app.get("/admin/collections")
+async def list_collections(request: Request):
+    """Versions served and the manifests of the collections, and the caches in memory."""
+    if not is_admin(request):
+        raise HTTPException(status_code=403, detail="Admin API key required")
+
+    await run_in_threadpool(chat_backend)
+    from app.common.utils import page_image_cache
+    from app.common.vector_store import LEGACY_PATHS
+    from app.common.vector_store import read_manifest
+    from app.common.vector_store import registry
+    from app.common.vector_store import shard_cache
+
+    return {
+        "serving": registry.versions(),
+        "shard_cache": shard_cache.stats(),
+        "page_image_cache": page_image_cache.stats(),
+        "manifests": {name: read_manifest(name) for name in LEGACY_PATHS},
+    }
+
+
+@app.post("/admin/collections/{name}/swap")
+async def swap_collection(name: str, request: Request, version: Optional[str] = None):
+    """
+    Serve a version of a collection, by default the current one of its manifest. Requests in
+    flight finish on the version they started with.
+    """
+    if not is_admin(request):
+        raise HTTPException(status_code=403, detail="Admin API key required")
+
+    await run_in_threadpool(chat_backend)
+    from app.common.vector_store import registry
+
+    try:
+        previous, current = await run_in_threadpool(registry.swap, name, version)
+    except (KeyError, FileNotFoundError) as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"collection": name, "previous": previous, "current": current}
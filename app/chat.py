@@ -0,0 +1,199 @@
+import datetime
+import os
+import threading
+from typing import List
+from typing import Optional
+from typing import Union
+
+from langchain.agents import AgentExecutor
+from langchain.agents import create_tool_calling_agent
+from langchain.agents.agent import RunnableAgent
+from langchain.agents.tools import InvalidTool
+from langchain_core.agents import AgentAction
+from langchain_core.agents import AgentFinish
+from langchain_core.messages import AIMessage
+from langchain_core.messages import HumanMessage
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_openai import ChatOpenAI
+from supabase import create_client
+
+from app.common import BATCH_CONCURRENCY
+from app.common import LOCAL_ROUTER
+from app.common import logger
+from app.common import MODEL_AGENT
+from app.common import OPENAI_API_KEY
+from app.common import PARALLEL_TOOLS
+from app.common import SPECULATIVE_RETRIEVAL
+from app.common import system_prompt
+from app.common import tool_call_instruction_parallel
+from app.common import tool_call_instruction_single
+from app.common import tracing
+from app.common import WARMUP_SYNTHESIS
+from app.common.batch import Emit
+from app.common.batch import run_batch
+from app.common.callbacks import LLMMetricsCallback
+from app.common.metrics import timed
+from app.common.openai_clients import http_async_client
+from app.common.openai_clients import http_client
+from app.common.parallel_tools import merge_tool_outputs
+from app.common.parallel_tools import run_tool_calls
+from app.common.router import query_router
+from app.common.speculation import speculate
+from app.common.structured_tools import StructuredTool
+from app.common.unstructured_tools import UnstructuredTool
+from app.common.warmup import warm_up
+from app.common.warmup import warmup_questions
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+
+if not SUPABASE_URL or not SUPABASE_KEY:
+    raise ValueError("Supabase URL and Key must be set in environment variables")
+
+supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+
+def store_conversation(user_id: str, chat_history: List[dict]):
+    """Stores updated chat history in Supabase."""
+    data = {
+        "user_id": user_id,
+        "chat_history": chat_history,  # JSON data
+    }
+    with timed("supabase_write"):
+        response = (
+            supabase.table("conversations")
+            .insert(
+                data,
+            )
+            .execute()
+        )
+    return response
+
+
+# Initialize the chat components
+prompt_template = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            system_prompt.format(
+                date=datetime.datetime.now().strftime("%Y-%m-%d"),
+                tool_call_instruction=(
+                    tool_call_instruction_parallel
+                    if PARALLEL_TOOLS
+                    else tool_call_instruction_single
+                ),
+            ),
+        ),
+        ("placeholder", "{chat_history}"),
+        ("human", "{input}"),
+        ("placeholder", "{agent_scratchpad}"),
+    ]
+)
+
+llm = ChatOpenAI(
+    model=MODEL_AGENT,
+    api_key=OPENAI_API_KEY,
+    callbacks=[LLMMetricsCallback("agent_llm")],
+    http_client=http_client,
+    http_async_client=http_async_client,
+)
+
+tools = [UnstructuredTool(), StructuredTool()]
+runnable = create_tool_calling_agent(llm, tools, prompt_template)
+agent = RunnableAgent(runnable=runnable)
+agent_executor = AgentExecutor(
+    agent=agent, tools=tools, verbose=True, return_intermediate_steps=True
+)
+tools_by_name = {tool.name: tool for tool in tools}
+
+
+def agent_input(messages: List[dict]) -> dict:
+    """Input of the agent for the messages of a chat request, the last one being answered."""
+    # Extract the last user message and convert previous messages to chat history
+    chat_history = []
+    for msg in messages[:-1]:  # All messages except the last one
+        if msg["role"] == "user":
+            chat_history.append(HumanMessage(content=msg["content"]))
+        elif msg["role"] == "assistant":
+            chat_history.append(AIMessage(content=msg["content"]))
+
+    return {
+        "chat_history": chat_history,
+        "input": messages[-1]["content"],
+    }
+
+
+def run_agent(input_: dict) -> dict:
+    """Runs the agent, executing all tool calls of a single step concurrently in parallel mode."""
+    if LOCAL_ROUTER:
+        decision = query_router.route(input_["input"], input_["chat_history"])
+        if decision is not None:
+            return {"output": tools_by_name[decision.tool].invoke(decision.tool_input)}
+
+    # the searches the tools will likely run start now, while the agent plans
+    with speculate(input_["input"], enabled=SPECULATIVE_RETRIEVAL):
+        return _run_agent(input_)
+
+
+def _run_agent(input_: dict) -> dict:
+    if not PARALLEL_TOOLS:
+        return agent_executor.invoke(input=input_)
+
+    intermediate_steps = []
+    for _ in range(agent_executor.max_iterations):
+        next_step = agent.plan(intermediate_steps=intermediate_steps, **input_)
+        if isinstance(next_step, AgentFinish):
+            return next_step.return_values
+
+        actions = [action for action in next_step if action.tool in tools_by_name]
+        if actions:
+            if len(actions) < len(next_step):
+                logger.warning(f"Skipping invalid tool calls: {[a.tool for a in next_step]}")
+            logger.info(f"Running tools concurrently: {[action.tool for action in actions]}")
+            outputs = run_tool_calls(actions, tools_by_name)
+            return {"output": merge_tool_outputs(outputs)}
+
+        # only invalid tool calls: plan again with their errors, as the executor does
+        intermediate_steps = intermediate_steps + [
+            (
+                action,
+                InvalidTool().run(
+                    {
+                        "requested_tool_name": action.tool,
+                        "available_tool_names": list(tools_by_name),
+                    }
+                ),
+            )
+            for action in next_step
+        ]
+    return {"output": "Agent stopped due to iteration limit or time limit."}
+
+
+def plan_tool_calls(input_: dict) -> Union[dict, List[AgentAction]]:
+    """Tool calls of the agent's first step, or its answer if it calls no tool."""
+    if LOCAL_ROUTER:
+        decision = query_router.route(input_["input"], input_["chat_history"])
+        if decision is not None:
+            return [AgentAction(tool=decision.tool, tool_input=decision.tool_input, log="")]
+
+    next_step = agent.plan(intermediate_steps=[], **input_)
+    if isinstance(next_step, AgentFinish):
+        return next_step.return_values
+    return next_step if isinstance(next_step, list) else [next_step]
+
+
+def answer_batch(questions: List[str], emit: Emit, cancelled: threading.Event) -> dict:
+    """Answer independent questions without chat history, see `run_batch`."""
+    inputs = [{"chat_history": [], "input": question} for question in questions]
+    return run_batch(inputs, plan_tool_calls, tools_by_name, emit, BATCH_CONCURRENCY, cancelled)
+
+
+def warm_caches(questions: Optional[List[str]] = None, synthesis: bool = WARMUP_SYNTHESIS) -> dict:
+    """Warm the caches with questions, by default the suggested and most frequent ones."""
+    with tracing.start_trace("warmup", True):
+        if questions is None:
+            questions = warmup_questions(supabase)
+        answer = None
+        if synthesis:
+            answer = lambda question: run_agent({"input": question, "chat_history": []})
+        return warm_up(questions, answer)
@@ -33,9 +33,132 @@ MODEL_STRUCTURED = "gpt-4o-mini"  # to proceess questions about structured data
 MODEL_UNSTRUCTURED = "gpt-4o-mini"  # to process questions about unstructured data (text)
 MODEL_AGENT = "gpt-4o"  # to route the question to the correct tool
 OPENAI_EMBEDDING_MODEL = "text-embedding-3-small"
+# "openai", or "hashing" for a deterministic local stand-in (offline benchmarks and tests)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "openai").lower()
 PROMPT_PATH = os.path.join("app", "prompts")
 
 TOP_K = 5
+TOP_K_UNSTRUCTURED = 20
+# FAISS index built by the ingestion: flat (exact), flat-fp16, flat-int8, hnsw, hnsw-fp16, hnsw-int8
+# or ivfpq; the search parameters of the approximate ones are set per tool when a collection loads
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "flat")
+INDEX_SEARCH_PARAMS = {
+    "structured": {
+        "efSearch": int(os.getenv("EF_SEARCH", "64")),
+        "nprobe": int(os.getenv("NPROBE", "16")),
+    },
+    "unstructured": {
+        "efSearch": int(os.getenv("EF_SEARCH_UNSTRUCTURED", "128")),
+        "nprobe": int(os.getenv("NPROBE_UNSTRUCTURED", "32")),
+    },
+}
+# Context sources of the unstructured synthesis prompt: token budget, and word 5-gram overlap above
+# which a chunk is dropped as a duplicate of a better ranked one
+UNSTRUCTURED_CONTEXT_TOKEN_BUDGET = int(os.getenv("UNSTRUCTURED_CONTEXT_TOKEN_BUDGET", "6000"))
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.6"))
+
+# Page images of the reports, base64 PNG files `{report}/{report}_page_{n}.txt`
+PAGES_PATH = os.path.join("data", "for_pydata", "pdf_png_base64")
+# Memory budget of the decoded page images kept for the pages cited most recently
+PAGE_IMAGE_CACHE_MB = int(os.getenv("PAGE_IMAGE_CACHE_MB", "256"))
+
+# Versioned collections (manifest and index versions) of the tools; the folders above are served
+# while a collection has no manifest
+COLLECTIONS_PATH = os.path.join("data", "collections")
+# Memory budget of the collection shards (one per company) held in memory, loaded on demand
+SHARD_MEMORY_BUDGET_MB = int(os.getenv("SHARD_MEMORY_BUDGET_MB", "4096"))
+# BM25 retrievers kept per collection shard, one per set of (company, year, quarter) partitions
+BM25_CACHE_SIZE = int(os.getenv("BM25_CACHE_SIZE", "64"))
+# Candidates of the hybrid search kept per tool, query, filter and collection version, and for how
+# long; 0 disables the cache
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "1024"))
+RETRIEVAL_CACHE_TTL_SECONDS = float(os.getenv("RETRIEVAL_CACHE_TTL_SECONDS", "3600"))
+# Memory budget of the query embeddings kept per collection version, e.g. embedded at once for a
+# batch of questions
+QUERY_EMBEDDING_CACHE_MB = int(os.getenv("QUERY_EMBEDDING_CACHE_MB", "64"))
+
+# Time budget of a /api/chat request, unless its X-Deadline-Ms header sets one; 0 disables it
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "25"))
+# Time left below which each stage degrades, in this order as the deadline approaches: the FAISS
+# MMR search is skipped, the retrieved top_k halved, the page images left out of the answer, and
+# the retrieved sources returned without the synthesis LLM call
+DEGRADATION_THRESHOLDS = {
+    "skip_mmr": float(os.getenv("DEGRADE_SKIP_MMR_SECONDS", "12")),
+    "shrink_top_k": float(os.getenv("DEGRADE_SHRINK_TOP_K_SECONDS", "10")),
+    "drop_images": float(os.getenv("DEGRADE_DROP_IMAGES_SECONDS", "8")),
+    "skip_synthesis": float(os.getenv("DEGRADE_SKIP_SYNTHESIS_SECONDS", "6")),
+}
+
+# Hedge the synthesis LLM calls: a call that has not returned after HEDGE_PERCENTILE of the recent
+# latencies of its kind is sent again, the first answer wins and the other request is cancelled;
+# calls are hedged after HEDGE_MIN_SAMPLES calls were observed and at most HEDGE_MAX_RATE of them
+HEDGED_LLM_CALLS = os.getenv("HEDGED_LLM_CALLS", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MAX_RATE = float(os.getenv("HEDGE_MAX_RATE", "0.1"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+
+# Responses smaller than this are sent uncompressed, whatever the client accepts
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", "1024"))
+
+# /api/batch: questions planned and tool calls (retrieval and synthesis) run at the same time, and
+# questions accepted per request
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "200"))
+
+# Vision prompts of the structured tool: longest side of the table crops, which are sent with
+# "low" detail when they fit in a single 512px tile
+VISION_MAX_SIDE = int(os.getenv("VISION_MAX_SIDE", "1024"))
+
+# Facts extracted from the tables at ingestion, to answer exact lookups without a vision call
+FACTS_DB_PATH = os.path.join("data", "facts", "facts.sqlite")
+# share of the query words (besides company and period) the matched line item must cover
+FACT_MATCH_THRESHOLD = float(os.getenv("FACT_MATCH_THRESHOLD", "0.6"))
+
+# Vector stores of the tools
+STRUCTURED_VDB_PATH = os.path.join(
+    "data", "structured_vdb", "faiss_structured_pydata_v0.0.1_full_size_score_above_50"
+)
+UNSTRUCTURED_VDB_PATH = os.path.join("data", "unstructured_vdb", "faiss_unstructured_pydata_v0.0.2")
+
+# Let the agent call structured_tool and unstructured_tool in one step and run them concurrently
+PARALLEL_TOOLS = os.getenv("PARALLEL_TOOLS", "false").lower() == "true"
+
+# Route well-formed queries to a tool locally, skipping the agent LLM call
+LOCAL_ROUTER = os.getenv("LOCAL_ROUTER", "false").lower() == "true"
+ROUTER_CONFIDENCE_THRESHOLD = float(os.getenv("ROUTER_CONFIDENCE_THRESHOLD", "0.75"))
+
+# Start the searches of both tools with the companies and periods found in the user message while
+# the agent LLM call is in flight; a tool called with the same companies and periods and a nearly
+# equal query (fuzzy token sort ratio, 0-100) uses their candidates, waiting for them at most
+# SPECULATION_MAX_WAIT_SECONDS before searching itself
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "false").lower() == "true"
+SPECULATION_QUERY_SIMILARITY = int(os.getenv("SPECULATION_QUERY_SIMILARITY", "90"))
+SPECULATION_MAX_WAIT_SECONDS = float(os.getenv("SPECULATION_MAX_WAIT_SECONDS", "2"))
+
+# Cache warm-up replaying the prompt suggestions of the frontend and the most frequent questions of
+# the last WARMUP_HISTORY_ROWS stored conversations, at startup or on /admin/warmup, within a time
+# and an OpenAI calls budget; the questions are answered by the agent only with WARMUP_SYNTHESIS
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "false").lower() == "true"
+WARMUP_SYNTHESIS = os.getenv("WARMUP_SYNTHESIS", "false").lower() == "true"
+WARMUP_MAX_QUESTIONS = int(os.getenv("WARMUP_MAX_QUESTIONS", "50"))
+WARMUP_HISTORY_ROWS = int(os.getenv("WARMUP_HISTORY_ROWS", "1000"))
+WARMUP_MAX_SECONDS = float(os.getenv("WARMUP_MAX_SECONDS", "60"))
+WARMUP_MAX_OPENAI_CALLS = int(os.getenv("WARMUP_MAX_OPENAI_CALLS", "100"))
+WARMUP_SUGGESTIONS_PATH = os.getenv(
+    "WARMUP_SUGGESTIONS_PATH", os.path.join("frontend", "src", "app", "constants.ts")
+)
+
+# Request tracing: "jsonl", "otlp" or "none"
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none").lower()
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+OTLP_ENDPOINT = os.getenv("OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+# share of requests traced unless the X-Trace-Sample header decides
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.0"))
+
+# On-demand sampling profiler, triggered with admin API keys
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
 
 # Prompt for our agent
 system_prompt = """
@@ -118,12 +241,21 @@ financial reports. Examples:
   Current date is {date}, so you can use it as a reference.
   5. Choose the correct tool (unstructured_tool or structured_tool) that best answers the USER_QUERY. \
 The tool should be relevant to the query. Also, use the features obtained in step 4 to\
- call the tool. IMPORTANT: YOU NEED TO CALL ONLY ONE TOOL ONLY ONCE AND NOTHING ELSE!
+ call the tool. {tool_call_instruction}
 
   Remember! If the query requires specific data from the financial reports, use the tools provided to\
  you, rather than making up the facts.
 """
 
+tool_call_instruction_single = (
+    "IMPORTANT: YOU NEED TO CALL ONLY ONE TOOL ONLY ONCE AND NOTHING ELSE!"
+)
+
+tool_call_instruction_parallel = """\
+IMPORTANT: CALL EACH TOOL AT MOST ONCE AND NOTHING ELSE! If the query needs both numbers \
+(structured_tool) and qualitative information (unstructured_tool), call BOTH tools in the same \
+step, each with its own re-written query covering its part of the question. Otherwise call only one tool."""
+
 system_prompt_structured_tool = """\
 You are a helpful AI assistant in financial data analysis.
 You need to provide a RESPONSE and the correct CONTEXT_SOURCES given a USER_QUERY and a \
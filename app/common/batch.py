@@ -0,0 +1,200 @@
+import json
+import threading
+from collections import defaultdict
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Union
+
+from langchain.schema import AgentAction
+from langchain.tools import BaseTool
+
+from app.common import logger
+from app.common import tracing
+from app.common.knowledge_graphs import company_matcher
+from app.common.metrics import timed
+from app.common.parallel_tools import merge_tool_outputs
+from app.common.retrieval import embed_queries
+from app.common.vector_store import registry
+
+# collection searched by each retrieval tool
+TOOL_COLLECTIONS = {"structured_tool": "structured", "unstructured_tool": "unstructured"}
+
+# planner of a question: the tool calls of the agent's first step, or its answer without tools
+Plan = Callable[[dict], Union[dict, List[AgentAction]]]
+# receives the index of a question and its tool output or answer, or the error that failed it
+Emit = Callable[[int, Optional[Union[dict, str]], Optional[Exception]], None]
+
+
+def tool_call_key(action: AgentAction) -> str:
+    """Identity of a tool call: tools are deterministic in their input, equal calls run once."""
+    return json.dumps([action.tool, action.tool_input], sort_keys=True, default=str)
+
+
+def retrieval_group(action: AgentAction) -> tuple:
+    """Tool, canonical companies, years and quarters of a call, which select the same shards."""
+    tool_input = action.tool_input if isinstance(action.tool_input, dict) else {}
+    companies = {
+        company_matcher.get_canonical_name(company_name)
+        for company_name in tool_input.get("company_names") or []
+    }
+    return (
+        action.tool,
+        tuple(sorted(companies)),
+        tuple(sorted(str(year) for year in tool_input.get("years") or [])),
+        tuple(sorted(str(quarter).lower() for quarter in tool_input.get("quarters") or [])),
+    )
+
+
+def prefetch_query_embeddings(actions: List[AgentAction]) -> int:
+    """
+    Embed the distinct queries of the retrieval calls with one embedding call per collection and
+    companies, so the searches find them in the query embedding cache.
+
+    Returns:
+        int: Number of queries embedded
+    """
+    queries: Dict[tuple, List[str]] = defaultdict(list)
+    for action in actions:
+        if action.tool not in TOOL_COLLECTIONS or not isinstance(action.tool_input, dict):
+            continue
+        if action.tool_input.get("user_query"):
+            companies = retrieval_group(action)[1]
+            queries[(TOOL_COLLECTIONS[action.tool], companies)].append(
+                action.tool_input["user_query"]
+            )
+
+    embedded = 0
+    for (name, companies), group_queries in queries.items():
+        embedded += embed_queries(registry.get(name), list(companies), group_queries)
+    return embedded
+
+
+def run_batch(
+    inputs: List[dict],
+    plan: Plan,
+    tools: Dict[str, BaseTool],
+    emit: Emit,
+    max_workers: int,
+    cancelled: Optional[threading.Event] = None,
+) -> dict:
+    """
+    Answer independent questions concurrently, emitting each answer as soon as it is ready.
+
+    The questions are planned first; those the agent answers without tools are emitted right away.
+    The tool calls are then deduplicated across the batch, the distinct queries embedded in bulk,
+    and the calls run grouped by company and period, so a group shares its shards, BM25 retrievers
+    and cached retrievals. A question is emitted when all of its calls are done, with their merged
+    output, or with the error of its calls if none succeeded.
+
+    Args:
+        inputs (List[dict]): Agent inputs of the questions, with "input" and "chat_history"
+        plan (Plan): Planner of a question
+        tools (Dict[str, BaseTool]): Available tools by name
+        emit (Emit): Receiver of the answers, called from the thread running the batch
+        max_workers (int): Questions planned and tool calls run at the same time
+        cancelled (Optional[threading.Event]): Set to stop running new calls, e.g. when the
+            client disconnects
+
+    Returns:
+        dict: Counts of the questions, tool calls, distinct tool calls and embedded queries
+    """
+    cancelled = cancelled or threading.Event()
+    actions_by_index: Dict[int, List[AgentAction]] = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        with timed("batch_planning"):
+            futures = {
+                executor.submit(copy_context().run, plan, input_): index
+                for index, input_ in enumerate(inputs)
+            }
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    planned = future.result()
+                except Exception as e:
+                    logger.error(f"Error planning batch question {index}: {str(e)}")
+                    emit(index, None, e)
+                    continue
+                if isinstance(planned, dict):
+                    emit(index, planned["output"], None)
+                    continue
+                unknown = [action.tool for action in planned if action.tool not in tools]
+                if not planned:
+                    emit(index, None, ValueError("No tool call planned"))
+                    continue
+                if unknown:
+                    emit(index, None, ValueError(f"Unknown tools {unknown}"))
+                    continue
+                actions_by_index[index] = list(planned)
+
+        calls: Dict[str, AgentAction] = {}
+        for actions in actions_by_index.values():
+            for action in actions:
+                calls.setdefault(tool_call_key(action), action)
+        stats = {
+            "questions": len(inputs),
+            "tool_calls": sum(len(actions) for actions in actions_by_index.values()),
+            "distinct_tool_calls": len(calls),
+        }
+        with timed("batch_embedding"):
+            stats["embedded_queries"] = prefetch_query_embeddings(list(calls.values()))
+        tracing.set_attributes(**stats)
+        logger.info(f"Batch: {stats}")
+
+        # distinct calls a question still waits for, and the questions of each call
+        waiting: Dict[int, int] = {}
+        questions_by_call: Dict[str, List[int]] = defaultdict(list)
+        for index, actions in actions_by_index.items():
+            keys = list(dict.fromkeys(tool_call_key(action) for action in actions))
+            waiting[index] = len(keys)
+            for key in keys:
+                questions_by_call[key].append(index)
+
+        results: Dict[str, Union[dict, str, Exception]] = {}
+        with timed("batch_tool_calls"):
+            groups = {key: str(retrieval_group(action)) for key, action in calls.items()}
+            ordered = sorted(calls, key=groups.get)
+            futures = {
+                executor.submit(
+                    copy_context().run, tools[calls[key].tool].invoke, calls[key].tool_input
+                ): key
+                for key in ordered
+            }
+            for future in as_completed(futures):
+                if cancelled.is_set():
+                    for pending in futures:
+                        pending.cancel()
+                    logger.info("Batch cancelled")
+                    break
+                key = futures[future]
+                try:
+                    results[key] = future.result()
+                except Exception as e:
+                    logger.error(f"Error in {calls[key].tool}: {str(e)}")
+                    results[key] = e
+                for index in questions_by_call[key]:
+                    waiting[index] -= 1
+                    if waiting[index] == 0:
+                        _emit_question(index, actions_by_index[index], results, emit)
+    return stats
+
+
+def _emit_question(
+    index: int,
+    actions: List[AgentAction],
+    results: Dict[str, Union[dict, str, Exception]],
+    emit: Emit,
+) -> None:
+    outputs = []
+    errors = []
+    for key in dict.fromkeys(tool_call_key(action) for action in actions):
+        result = results[key]
+        (errors if isinstance(result, Exception) else outputs).append(result)
+    if outputs:
+        emit(index, merge_tool_outputs(outputs), None)
+    else:
+        emit(index, None, errors[0])
@@ -0,0 +1,128 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+from typing import Dict
+from typing import Generic
+from typing import Hashable
+from typing import Optional
+from typing import Tuple
+from typing import TypeVar
+
+from app.common import logger
+from app.common.metrics import CACHE_EVICTIONS
+from app.common.metrics import CACHE_SIZE
+from app.common.metrics import record_cache_lookup
+
+V = TypeVar("V")
+
+
+class SizedLRUCache(Generic[V]):
+    """
+    Thread-safe LRU cache bounded by the total size of its entries rather than their number.
+
+    Lookups are counted as hits and misses, evictions and the size held are exported per cache
+    name. A value is loaded once even when several threads miss it at the same time. Entries may
+    also expire a fixed time after they are stored.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_size: float,
+        size: Callable[[V], float],
+        ttl: Optional[float] = None,
+    ):
+        """
+        Args:
+            name (str): Cache name, for metrics and logs
+            max_size (float): Budget of the entries, in the unit of `size`
+            size (Callable[[V], float]): Size of an entry, e.g. its estimated bytes
+            ttl (Optional[float]): Seconds an entry is kept after it is stored, forever if None
+        """
+        self.name = name
+        self.max_size = max_size
+        self.size = size
+        self.ttl = ttl
+        # value, size and time stored of the entries, least recently used first
+        self.entries: "OrderedDict[Hashable, Tuple[V, float, float]]" = OrderedDict()
+        self.total = 0.0
+        self.lock = threading.Lock()
+        self.loading: Dict[Hashable, threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _entry(self, key: Hashable) -> Optional[Tuple[V, float, float]]:
+        """Entry of the key, removed if it expired; the caller holds the lock."""
+        entry = self.entries.get(key)
+        if entry is not None and self.ttl is not None and time.monotonic() - entry[2] > self.ttl:
+            del self.entries[key]
+            self.total -= entry[1]
+            CACHE_SIZE.labels(self.name).set(self.total)
+            return None
+        return entry
+
+    def get(self, key: Hashable) -> Optional[V]:
+        with self.lock:
+            entry = self._entry(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        record_cache_lookup(self.name, entry is not None)
+        return entry[0] if entry is not None else None
+
+    def put(self, key: Hashable, value: V) -> None:
+        size = self.size(value)
+        with self.lock:
+            if key in self.entries:
+                self.total -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size, time.monotonic())
+            self.total += size
+            # the newest entry stays even if it alone exceeds the budget
+            while self.total > self.max_size and len(self.entries) > 1:
+                evicted, (_, evicted_size, _) = self.entries.popitem(last=False)
+                self.total -= evicted_size
+                CACHE_EVICTIONS.labels(self.name).inc()
+                logger.info(f"Evicted {evicted} from the {self.name} cache ({evicted_size:.0f})")
+            CACHE_SIZE.labels(self.name).set(self.total)
+        if size > self.max_size:
+            logger.warning(f"{key} alone exceeds the {self.name} cache budget of {self.max_size}")
+
+    def get_or_load(self, key: Hashable, load: Callable[[], V]) -> V:
+        """Cached value of the key, loaded with `load` on a miss, once across threads."""
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self.lock:
+            key_lock = self.loading.setdefault(key, threading.Lock())
+        try:
+            with key_lock:
+                with self.lock:
+                    entry = self._entry(key)
+                if entry is not None:
+                    # loaded by another thread while this one waited
+                    return entry[0]
+                value = load()
+                self.put(key, value)
+        finally:
+            with self.lock:
+                self.loading.pop(key, None)
+        return value
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self.lock:
+            return self._entry(key) is not None
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hit_ratio": self.hits / lookups if lookups else None,
+                "size": self.total,
+                "max_size": self.max_size,
+                "keys": [str(key) for key in self.entries],
+            }
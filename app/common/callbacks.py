@@ -0,0 +1,59 @@
+import time
+from typing import Any
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+from app.common import tracing
+from app.common.metrics import record_token_usage
+from app.common.metrics import STAGE_ERRORS
+from app.common.metrics import STAGE_LATENCY
+
+
+class LLMMetricsCallback(BaseCallbackHandler):
+    """Records latency, errors and token usage of the LangChain chat models it is attached to."""
+
+    def __init__(self, stage: str, tool: str = ""):
+        self.stage = stage
+        self.tool = tool
+        self.runs: Dict[UUID, Tuple[float, Any]] = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, **kwargs: Any) -> None:
+        self._start(run_id)
+
+    def on_llm_start(self, serialized, prompts, *, run_id: UUID, **kwargs: Any) -> None:
+        self._start(run_id)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        span = self._observe(run_id)
+        # streamed generations come without token usage
+        llm_output: Optional[dict] = response.llm_output or {}
+        token_usage = llm_output.get("token_usage") or {}
+        if token_usage:
+            record_token_usage(
+                llm_output.get("model_name", ""),
+                token_usage.get("prompt_tokens", 0),
+                token_usage.get("completion_tokens", 0),
+            )
+            span.set_attributes(
+                prompt_tokens=token_usage.get("prompt_tokens", 0),
+                completion_tokens=token_usage.get("completion_tokens", 0),
+            )
+        span.end()
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._observe(run_id).end(error=error)
+        STAGE_ERRORS.labels(self.stage, self.tool).inc()
+
+    def _start(self, run_id: UUID) -> None:
+        self.runs[run_id] = (time.perf_counter(), tracing.start_span(self.stage, tool=self.tool))
+
+    def _observe(self, run_id: UUID):
+        start, span = self.runs.pop(run_id, (None, tracing.NOOP_SPAN))
+        if start is not None:
+            STAGE_LATENCY.labels(self.stage, self.tool).observe(time.perf_counter() - start)
+        return span
@@ -0,0 +1,134 @@
+import functools
+import re
+from typing import Callable
+from typing import List
+from typing import Set
+from typing import Tuple
+
+import tiktoken
+from langchain.schema import Document
+
+from app.common import logger
+from app.common import tracing
+from app.common.metrics import CONTEXT_TOKENS
+
+
+WORD_PATTERN = re.compile(r"\w+")
+SHINGLE_SIZE = 5
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model: str) -> int:
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+def shingles(text: str) -> Set[Tuple[str, ...]]:
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {tuple(words)}
+    return {tuple(words[i : i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def deduplicate_chunks(docs: List[Document], threshold: float) -> List[Document]:
+    """
+    Drop chunks that mostly overlap a better ranked chunk, e.g. neighbouring chunks of a page.
+
+    Args:
+        docs (List[Document]): Chunks, best ranked first
+        threshold (float): Share of the smaller chunk's word 5-grams found in the other chunk above
+            which the lower ranked chunk is dropped
+
+    Returns:
+        List[Document]: Remaining chunks in the same order
+    """
+    kept: List[Document] = []
+    kept_shingles: List[Set[Tuple[str, ...]]] = []
+    for doc in docs:
+        doc_shingles = shingles(doc.page_content)
+        is_duplicate = any(
+            len(doc_shingles & other) / max(1, min(len(doc_shingles), len(other))) >= threshold
+            for other in kept_shingles
+        )
+        if not is_duplicate:
+            kept.append(doc)
+            kept_shingles.append(doc_shingles)
+    return kept
+
+
+def format_source(index: int, file_name: str, text: str) -> str:
+    return f"[{index}] {file_name}\n{text.strip()}\n"
+
+
+def pack_sources(
+    docs: List[Document],
+    file_name: Callable[[Document], str],
+    token_budget: int,
+    dedup_threshold: float,
+    model: str,
+) -> Tuple[List[Document], str]:
+    """
+    Select the context sources for a synthesis prompt within a token budget and serialize them.
+
+    Chunks are deduplicated, then taken in their fusion ranking order while they fit in the
+    budget. Each source is serialized as a "[index] file_name" line followed by its text, with
+    indices renumbered from 0 over the selected chunks.
+
+    Args:
+        docs (List[Document]): Retrieved chunks, best ranked first
+        file_name (Callable[[Document], str]): File name of a chunk, shown in its header
+        token_budget (int): Maximum number of tokens of the serialized sources
+        dedup_threshold (float): Overlap above which a chunk is a duplicate, see `deduplicate_chunks`
+        model (str): Model the prompt is sent to, for the tokenizer
+
+    Returns:
+        Tuple[List[Document], str]: Selected chunks, whose positions are the cited indices, and
+        the serialized sources
+    """
+    candidates = deduplicate_chunks(docs, dedup_threshold)
+
+    packed_docs: List[Document] = []
+    blocks: List[str] = []
+    used_tokens = 0
+    for doc in candidates:
+        block = format_source(len(packed_docs), file_name(doc), doc.page_content)
+        block_tokens = count_tokens(block, model)
+        if used_tokens + block_tokens > token_budget:
+            continue
+        packed_docs.append(doc)
+        blocks.append(block)
+        used_tokens += block_tokens
+
+    serialized = "\n".join(blocks)
+
+    # what the prompt used to receive: the repr of a list of dicts with every chunk
+    repr_tokens = count_tokens(
+        str(
+            [
+                {"index": index, "file_name": file_name(doc), "context": doc.page_content}
+                for index, doc in enumerate(docs)
+            ]
+        ),
+        model,
+    )
+    CONTEXT_TOKENS.labels("packed").inc(used_tokens)
+    CONTEXT_TOKENS.labels("saved").inc(max(0, repr_tokens - used_tokens))
+    tracing.set_attributes(
+        retrieved_chunks=len(docs),
+        deduplicated_chunks=len(candidates),
+        packed_chunks=len(packed_docs),
+        context_tokens=used_tokens,
+        repr_tokens=repr_tokens,
+    )
+    logger.info(
+        f"Context packing: {len(docs)} chunks -> {len(candidates)} deduplicated -> "
+        f"{len(packed_docs)} packed, {used_tokens} tokens instead of {repr_tokens} "
+        f"({repr_tokens - used_tokens} saved)"
+    )
+    return packed_docs, serialized
@@ -0,0 +1,112 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List
+from typing import Optional
+from typing import TYPE_CHECKING
+from typing import Union
+
+from app.common import DEGRADATION_THRESHOLDS
+from app.common import logger
+from app.common import tracing
+from app.common.metrics import DEGRADATIONS
+
+if TYPE_CHECKING:
+    from openai import NotGiven
+
+# answer of a tool that skips its synthesis, followed by the sources it retrieved
+NO_SYNTHESIS_RESPONSE = (
+    "There was not enough time to write an answer, these are the most relevant sources found."
+)
+# answer of a request that runs out of time altogether
+DEADLINE_EXCEEDED_RESPONSE = (
+    "Sorry, the answer took too long to prepare. Please try again or ask a narrower question."
+)
+# shortest timeout given to an LLM call, even with less time left
+MIN_LLM_TIMEOUT_SECONDS = 1.0
+
+
+class Deadline:
+    """Time budget of a request, and the degradations applied to keep within it."""
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+        self.degraded: List[str] = []
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+
+_current_deadline: ContextVar[Optional[Deadline]] = ContextVar("current_deadline", default=None)
+
+
+def parse_deadline_header(value: Optional[str], default: float) -> float:
+    """Seconds of an X-Deadline-Ms header, the default if it is missing or invalid."""
+    try:
+        milliseconds = float(value)
+    except (TypeError, ValueError):
+        return default
+    return milliseconds / 1000 if milliseconds > 0 else default
+
+
+@contextmanager
+def start_deadline(seconds: float):
+    """
+    Set the deadline of a request for the block, and for the threads started with a copy of its
+    context. No deadline is set if `seconds` is 0.
+    """
+    deadline = Deadline(seconds) if seconds > 0 else None
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left before the deadline of the current request, None without a deadline."""
+    deadline = _current_deadline.get()
+    return deadline.remaining() if deadline is not None else None
+
+
+def record_degradation(degradation: str, tool: str = "") -> None:
+    DEGRADATIONS.labels(degradation, tool).inc()
+    tracing.set_attributes(degraded=degradation)
+    deadline = _current_deadline.get()
+    if deadline is not None:
+        deadline.degraded.append(degradation)
+        logger.warning(f"Degraded {degradation} {tool}: {deadline.remaining():.2f}s left")
+
+
+def degrade(degradation: str, tool: str = "") -> bool:
+    """
+    Whether a stage should degrade, i.e. the current request has less time left than the
+    threshold of the degradation in DEGRADATION_THRESHOLDS. A degradation is recorded in the
+    metrics, the current span and the deadline.
+
+    Args:
+        degradation (str): "skip_mmr", "shrink_top_k", "drop_images" or "skip_synthesis"
+        tool (str): Tool the stage runs in, for metrics
+
+    Returns:
+        bool: True if the stage should degrade
+    """
+    time_left = remaining()
+    if time_left is None or time_left >= DEGRADATION_THRESHOLDS[degradation]:
+        return False
+    record_degradation(degradation, tool)
+    return True
+
+
+def llm_timeout() -> Union[float, "NotGiven"]:
+    """
+    Timeout of an OpenAI call: the time left of the request, or the client's default. The timeout
+    applies to each attempt, so the calls under a deadline are made without retries.
+    """
+    # imported here, the API sets deadlines before it imports OpenAI
+    from openai import NOT_GIVEN
+
+    time_left = remaining()
+    if time_left is None:
+        return NOT_GIVEN
+    return max(time_left, MIN_LLM_TIMEOUT_SECONDS)
@@ -0,0 +1,73 @@
+import hashlib
+import re
+import time
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from app.common import EMBEDDING_BACKEND
+from app.common import OPENAI_API_KEY
+from app.common import OPENAI_EMBEDDING_MODEL
+
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    Deterministic local stand-in for the OpenAI embeddings, for offline benchmarks and tests.
+
+    Words and word bigrams are hashed into a fixed number of signed buckets and the vector is
+    L2-normalized, so texts sharing words are close in cosine and L2 distance.
+    """
+
+    def __init__(self, dimensions: int = 1536, latency_ms: float = 0.0):
+        """
+        Args:
+            dimensions (int): Size of the vectors, 1536 like text-embedding-3-small
+            latency_ms (float): Simulated latency of each embedding call
+        """
+        self.dimensions = dimensions
+        self.latency_ms = latency_ms
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        tokens = TOKEN_PATTERN.findall(text.lower())
+        features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+        for feature in features:
+            digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dimensions
+            sign = 1.0 if digest[4] & 1 else -1.0
+            vector[bucket] += sign
+
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def get_embeddings(backend: str = EMBEDDING_BACKEND) -> Embeddings:
+    """Embeddings used to search the vector stores, set by EMBEDDING_BACKEND ("openai" or "hashing")."""
+    if backend == "hashing":
+        return HashingEmbeddings()
+    # imported here, so that the hashing backend runs without importing OpenAI
+    from langchain_openai import OpenAIEmbeddings
+
+    from app.common.openai_clients import http_async_client
+    from app.common.openai_clients import http_client
+
+    return OpenAIEmbeddings(
+        model=OPENAI_EMBEDDING_MODEL,
+        api_key=OPENAI_API_KEY,
+        http_client=http_client,
+        http_async_client=http_async_client,
+    )
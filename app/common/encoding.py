@@ -0,0 +1,159 @@
+import base64
+import uuid
+import zlib
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import orjson
+from starlette.responses import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Levels of the codecs: the large responses are mostly base64 of deflated PNGs, on which the
+# higher levels gain a few percent for several times the CPU
+GZIP_LEVEL = 1
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+
+# Content types worth compressing; PNGs and multipart responses of PNGs are compressed already
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/x-ndjson", "application/xml")
+
+# compresses a chunk of a response, the final one ending the stream; flushes the others so they
+# can be decoded as they arrive
+Compress = Callable[[bytes, bool], bytes]
+
+
+def _gzip() -> Compress:
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return lambda data, final: compressor.compress(data) + compressor.flush(
+        zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH
+    )
+
+
+def _brotli() -> Compress:
+    compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+    return lambda data, final: compressor.process(data) + (
+        compressor.finish() if final else compressor.flush()
+    )
+
+
+def _zstd() -> Compress:
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    return lambda data, final: compressor.compress(data) + compressor.flush(
+        zstandard.COMPRESSOBJ_FLUSH_FINISH if final else zstandard.COMPRESSOBJ_FLUSH_BLOCK
+    )
+
+
+# Content-Encoding tokens of the installed codecs, in order of preference
+COMPRESSORS: Dict[str, Callable[[], Compress]] = {
+    name: factory
+    for name, factory, available in [
+        ("zstd", _zstd, zstandard is not None),
+        ("br", _brotli, brotli is not None),
+        ("gzip", _gzip, True),
+    ]
+    if available
+}
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    Encoding of a response given the Accept-Encoding header of its request: the installed codec
+    the client accepts with the highest quality, the first of COMPRESSORS on a tie, or None to
+    send it as is.
+    """
+    if not accept_encoding:
+        return None
+    qualities = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.strip().lower()] = quality
+
+    best, best_quality = None, 0.0
+    for name in COMPRESSORS:
+        quality = qualities.get(name, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = name, quality
+    return best
+
+
+def compressor(encoding: str) -> Compress:
+    return COMPRESSORS[encoding]()
+
+
+def is_compressible(content_type: Optional[str]) -> bool:
+    return bool(content_type) and content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def json_body(content) -> bytes:
+    """JSON of a response, serialized with orjson."""
+    return orjson.dumps(content)
+
+
+def accepts_multipart(accept: Optional[str]) -> bool:
+    """Whether the Accept header of a request asks for a multipart response."""
+    return bool(accept) and "multipart/mixed" in accept
+
+
+def multipart_body(content: dict, parts: List[Tuple[str, bytes]]) -> Tuple[bytes, str]:
+    """
+    Multipart response: the JSON content first, then each part as raw bytes, without the third
+    that base64 adds. A part is identified by its Content-ID, to which the JSON content refers.
+
+    Args:
+        content (dict): JSON content of the response
+        parts (List[Tuple[str, bytes]]): Content-ID and bytes of the PNG parts
+
+    Returns:
+        Tuple[bytes, str]: Body and media type of the response
+    """
+    boundary = uuid.uuid4().hex
+    chunks = [
+        f"--{boundary}\r\nContent-Type: application/json\r\n\r\n".encode(),
+        json_body(content),
+    ]
+    for content_id, data in parts:
+        chunks.append(
+            f"\r\n--{boundary}\r\nContent-Type: image/png\r\n"
+            f"Content-ID: <{content_id}>\r\nContent-Length: {len(data)}\r\n\r\n".encode()
+        )
+        chunks.append(data)
+    chunks.append(f"\r\n--{boundary}--\r\n".encode())
+    return b"".join(chunks), f"multipart/mixed; boundary={boundary}"
+
+
+def encoded_response(
+    content: dict, accept: Optional[str], headers: Optional[dict] = None
+) -> Response:
+    """
+    Response of a JSON content with base64 "images", serialized with orjson, or, if the client
+    accepts multipart/mixed, a multipart response with the images as raw PNG parts, each image
+    referring to its part by a `content_id` instead of its `base64`.
+    """
+    if not accepts_multipart(accept):
+        return Response(json_body(content), media_type="application/json", headers=headers)
+    parts = []
+    for index, image in enumerate(content.get("images") or []):
+        content_id = f"image-{index}"
+        parts.append((content_id, base64.b64decode(image.pop("base64"))))
+        image["content_id"] = content_id
+    body, media_type = multipart_body(content, parts)
+    return Response(body, media_type=media_type, headers=headers)
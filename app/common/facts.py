@@ -0,0 +1,341 @@
+import os
+import re
+import sqlite3
+import threading
+from typing import Iterable
+from typing import List
+from typing import Optional
+
+from pydantic import BaseModel
+
+from app.common import FACT_MATCH_THRESHOLD
+from app.common import FACTS_DB_PATH
+from app.common import logger
+
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+# longest line item name matched against the query, in words
+MAX_ITEM_WORDS = 8
+
+# query words that do not ask for a different figure than the line item
+NEUTRAL_WORDS = {
+    "a",
+    "an",
+    "and",
+    "are",
+    "as",
+    "at",
+    "by",
+    "company",
+    "did",
+    "do",
+    "does",
+    "during",
+    "end",
+    "for",
+    "from",
+    "group",
+    "has",
+    "have",
+    "how",
+    "in",
+    "is",
+    "it",
+    "its",
+    "me",
+    "much",
+    "of",
+    "on",
+    "per",
+    "please",
+    "reported",
+    "s",
+    "tell",
+    "the",
+    "their",
+    "to",
+    "was",
+    "were",
+    "what",
+    "whats",
+    "which",
+    # periods
+    "annual",
+    "fiscal",
+    "full",
+    "fy",
+    "h1",
+    "h2",
+    "half",
+    "period",
+    "q1",
+    "q2",
+    "q3",
+    "q4",
+    "quarter",
+    "report",
+    "year",
+    "jan",
+    "january",
+    "feb",
+    "february",
+    "mar",
+    "march",
+    "apr",
+    "april",
+    "may",
+    "jun",
+    "june",
+    "jul",
+    "july",
+    "aug",
+    "august",
+    "sep",
+    "sept",
+    "september",
+    "oct",
+    "october",
+    "nov",
+    "november",
+    "dec",
+    "december",
+}
+
+# query words asking for a figure derived from the line item rather than the item itself, unless
+# the line item names them, e.g. "Operating margin"
+DERIVED_WORDS = {
+    "average",
+    "change",
+    "changed",
+    "changes",
+    "compare",
+    "compared",
+    "comparison",
+    "decline",
+    "declined",
+    "decrease",
+    "decreased",
+    "difference",
+    "drop",
+    "dropped",
+    "fall",
+    "fell",
+    "grew",
+    "grow",
+    "growth",
+    "increase",
+    "increased",
+    "margin",
+    "margins",
+    "percent",
+    "percentage",
+    "ratio",
+    "ratios",
+    "rise",
+    "rose",
+    "share",
+    "trend",
+    "versus",
+    "vs",
+    "yoy",
+}
+
+# month of a table column header, e.g. "Apr-Jun 2023" or "31 Dec 2023"
+MONTHS = {
+    name: number
+    for number, names in enumerate(
+        [
+            ("jan", "january"),
+            ("feb", "february"),
+            ("mar", "march"),
+            ("apr", "april"),
+            ("may",),
+            ("jun", "june"),
+            ("jul", "july"),
+            ("aug", "august"),
+            ("sep", "sept", "september"),
+            ("oct", "october"),
+            ("nov", "november"),
+            ("dec", "december"),
+        ],
+        start=1,
+    )
+    for name in names
+}
+ANNUAL_WORDS = {"annual", "fiscal", "full", "fy", "year"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS facts (
+    company TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    quarter TEXT NOT NULL,
+    period_year INTEGER NOT NULL,
+    period TEXT NOT NULL,
+    line_item TEXT NOT NULL,
+    item_key TEXT NOT NULL,
+    value REAL NOT NULL,
+    value_text TEXT NOT NULL,
+    unit TEXT,
+    page_nr INTEGER NOT NULL,
+    file_name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_facts_lookup ON facts (company, period_year, item_key);
+CREATE INDEX IF NOT EXISTS idx_facts_item ON facts (item_key);
+"""
+
+
+class Fact(BaseModel):
+    """A figure read from a table of a report."""
+
+    company: str
+    year: int  # year of the report
+    quarter: str  # quarter of the report, or "annual"
+    period_year: int  # year of the table column
+    period: str  # header of the table column, e.g. "Jan-Dec 2023"
+    line_item: str
+    item_key: str
+    value: float
+    value_text: str  # as printed, e.g. "(1,234)"
+    unit: Optional[str] = None
+    page_nr: int
+    file_name: str
+
+
+def normalize_item(text: str) -> str:
+    """Lookup key of a line item name: lowercase words, "&" as "and"."""
+    return " ".join(WORD_PATTERN.findall(text.lower().replace("&", " and ")))
+
+
+def period_quarter(period: str, report_quarter: str) -> Optional[str]:
+    """
+    Quarter ("q1" to "q4") or "annual" a table column covers, from its header and the quarter of
+    its report; None if it covers another period, e.g. "Jan-Jun 2023", or cannot be told.
+    """
+    words = WORD_PATTERN.findall(period.lower())
+    for word in words:
+        if re.fullmatch(r"q[1-4]", word):
+            return word
+    months = [MONTHS[word] for word in words if word in MONTHS]
+    if len(months) >= 2:
+        first, last = months[0], months[-1]
+        if (first, last) == (1, 12):
+            return "annual"
+        if last - first == 2 and first % 3 == 1:
+            return f"q{last // 3}"
+        return None
+    if len(months) == 1:
+        # balance sheet date, the end of a quarter or of the year
+        if months[0] == 12 and report_quarter in ("q4", "annual"):
+            return report_quarter
+        return f"q{months[0] // 3}" if months[0] in (3, 6, 9) else None
+    if ANNUAL_WORDS.intersection(words):
+        return "annual"
+    # a bare year is the whole year in an annual report, and ambiguous in a quarterly one
+    if all(word.isdigit() for word in words) and report_quarter == "annual":
+        return "annual"
+    return None
+
+
+class FactStore:
+    """SQLite store of the facts extracted from the tables of the reports at ingestion."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # sqlite3 connections are not shared across threads
+        if not hasattr(self.local, "connection"):
+            self.local.connection = sqlite3.connect(self.path)
+            self.local.connection.row_factory = sqlite3.Row
+        return self.local.connection
+
+    def write(self, facts: Iterable[Fact]) -> int:
+        """Replace the content of the store with the given facts and return their number."""
+        with self.connection as connection:
+            connection.executescript(SCHEMA)
+            connection.execute("DELETE FROM facts")
+            rows = [tuple(fact.dict().values()) for fact in facts]
+            if rows:
+                connection.executemany(
+                    f"INSERT INTO facts VALUES ({', '.join('?' * len(rows[0]))})", rows
+                )
+        return len(rows)
+
+    def lookup(self, company: str, period_year: int, item_keys: List[str]) -> List[Fact]:
+        """Facts of a company and year for the given line items, from its own year's reports."""
+        if not item_keys:
+            return []
+        rows = self.connection.execute(
+            "SELECT * FROM facts WHERE company = ? AND period_year = ? AND year = period_year "
+            f"AND item_key IN ({', '.join('?' * len(item_keys))})",
+            [company, period_year, *item_keys],
+        ).fetchall()
+        return [Fact(**row) for row in rows]
+
+    def match(
+        self,
+        query: str,
+        company: str,
+        year: int,
+        quarters: List[str],
+        ignored_terms: Iterable[str] = (),
+    ) -> Optional[Fact]:
+        """
+        Find the fact a query asks for, if it is an exact lookup of a line item.
+
+        The longest line item named in the query is looked up for the company and year, in the
+        columns covering an asked quarter of the reports of an asked quarter, the year's columns
+        only if "annual" is asked. The match is confident if the line item covers at least
+        FACT_MATCH_THRESHOLD of the query words that do not name the company or period and none
+        of the others asks for a derived figure (DERIVED_WORDS, e.g. growth or margin), and all
+        these columns agree on its value.
+
+        Args:
+            query (str): User query
+            company (str): Canonical company name
+            year (int): Year of the figure
+            quarters (List[str]): Quarters asked, "q1" to "q4" or "annual"
+            ignored_terms (Iterable[str]): Terms of the query to ignore, e.g. the company name
+
+        Returns:
+            Optional[Fact]: The matched fact, or None to fall back to the document search
+        """
+        normalized_query = normalize_item(query)
+        for term in filter(None, map(normalize_item, ignored_terms)):
+            normalized_query = re.sub(rf"\b{re.escape(term)}\b", " ", normalized_query)
+        words = normalized_query.split()
+
+        candidates = {
+            " ".join(words[start : start + n])
+            for n in range(1, MAX_ITEM_WORDS + 1)
+            for start in range(len(words) - n + 1)
+        }
+        # the year's figure, not the fourth quarter's, when both are asked as by default
+        periods = ["annual"] if "annual" in quarters else quarters
+        facts = [
+            fact
+            for fact in self.lookup(company, year, sorted(candidates))
+            if fact.quarter in quarters and period_quarter(fact.period, fact.quarter) in periods
+        ]
+        if not facts:
+            return None
+
+        item_key = max(sorted({fact.item_key for fact in facts}), key=lambda key: len(key.split()))
+        facts = [fact for fact in facts if fact.item_key == item_key]
+        content_words = [word for word in words if word not in NEUTRAL_WORDS and not word.isdigit()]
+        coverage = len(item_key.split()) / max(1, len(content_words))
+        derived_words = DERIVED_WORDS.intersection(content_words).difference(item_key.split())
+        values = {fact.value for fact in facts}
+        if coverage < FACT_MATCH_THRESHOLD or derived_words or len(values) > 1:
+            logger.info(
+                f"Fact store: no confident match for '{item_key}' (coverage {coverage:.2f}, "
+                f"derived {sorted(derived_words)}, {len(values)} distinct values)"
+            )
+            return None
+
+        return min(facts, key=lambda fact: (fact.file_name, fact.page_nr))
+
+
+fact_store = FactStore(FACTS_DB_PATH) if os.path.exists(FACTS_DB_PATH) else None
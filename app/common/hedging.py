@@ -0,0 +1,162 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from contextvars import Context
+from contextvars import copy_context
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Optional
+from typing import TypeVar
+
+import numpy as np
+
+from app.common import HEDGE_MAX_RATE
+from app.common import HEDGE_MIN_SAMPLES
+from app.common import HEDGE_PERCENTILE
+from app.common import logger
+from app.common import tracing
+from app.common.metrics import HEDGE_DELAY
+from app.common.metrics import HEDGED_CALLS
+
+T = TypeVar("T")
+
+# recent calls of a kind the latency percentile and the hedge rate are computed over
+HEDGE_WINDOW = 200
+
+
+class Hedger:
+    """Latencies and hedges of the recent calls of a kind, e.g. the vision synthesis calls."""
+
+    def __init__(
+        self,
+        name: str,
+        percentile: float = HEDGE_PERCENTILE,
+        max_rate: float = HEDGE_MAX_RATE,
+        min_samples: int = HEDGE_MIN_SAMPLES,
+    ):
+        self.name = name
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=HEDGE_WINDOW)
+        self.hedged = deque(maxlen=HEDGE_WINDOW)
+        self.lock = threading.Lock()
+
+    def observe(self, latency: float) -> None:
+        with self.lock:
+            self.latencies.append(latency)
+
+    def delay(self) -> Optional[float]:
+        """Seconds after which a call is hedged, None until enough calls were observed."""
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            delay = float(np.percentile(self.latencies, self.percentile))
+        HEDGE_DELAY.labels(self.name).set(delay)
+        return delay
+
+    def record_call(self, hedged: bool) -> None:
+        with self.lock:
+            self.hedged.append(hedged)
+
+    def may_hedge(self) -> bool:
+        """Whether hedging one more call keeps the hedged share of the recent calls in the cap."""
+        with self.lock:
+            return sum(self.hedged) + 1 <= self.max_rate * (len(self.hedged) + 1)
+
+
+hedgers: Dict[str, Hedger] = {}
+_hedgers_lock = threading.Lock()
+
+
+def get_hedger(name: str) -> Hedger:
+    with _hedgers_lock:
+        if name not in hedgers:
+            hedgers[name] = Hedger(name)
+        return hedgers[name]
+
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+
+def _event_loop() -> asyncio.AbstractEventLoop:
+    """Event loop the hedged calls run on, in a daemon thread started on the first call."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="hedging", daemon=True).start()
+        return _loop
+
+
+def hedged(name: str, call: Callable[[], Awaitable[T]]) -> T:
+    """
+    Run an async LLM call from a worker thread, hedged: if it has not returned after the
+    HEDGE_PERCENTILE latency of the recent calls of its kind, the same call is sent again, the
+    first to succeed wins and the other is cancelled, which closes its request. Calls are not
+    hedged before HEDGE_MIN_SAMPLES latencies are observed, nor beyond HEDGE_MAX_RATE of the
+    recent calls.
+
+    The calls run on a shared event loop, so that a losing request can be cancelled, which a
+    synchronous client cannot do from another thread; they must use an async client. Each attempt
+    runs in a copy of the caller's context, so its spans belong to the request trace and it sees
+    the request deadline.
+
+    Args:
+        name (str): Kind of the call, whose latencies set the hedging delay
+        call (Callable[[], Awaitable[T]]): Starts a request, called once per attempt
+
+    Returns:
+        T: Result of the first attempt to succeed
+    """
+    hedger = get_hedger(name)
+    future = asyncio.run_coroutine_threadsafe(_race(hedger, call, copy_context()), _event_loop())
+    result, outcome = future.result()
+    HEDGED_CALLS.labels(name, outcome).inc()
+    tracing.set_attributes(hedge=outcome)
+    return result
+
+
+async def _attempt(hedger: Hedger, call: Callable[[], Awaitable[T]]) -> T:
+    start = time.perf_counter()
+    try:
+        return await call()
+    finally:
+        # a cancelled attempt is recorded with the time it was given, a lower bound of its latency
+        hedger.observe(time.perf_counter() - start)
+
+
+def _start_attempt(hedger: Hedger, call: Callable[[], Awaitable[T]], context: Context):
+    # a task runs in a copy of the context it is created in
+    return context.run(asyncio.ensure_future, _attempt(hedger, call))
+
+
+async def _race(hedger: Hedger, call: Callable[[], Awaitable[T]], context: Context):
+    primary = _start_attempt(hedger, call, context)
+    delay = hedger.delay()
+    if delay is not None:
+        await asyncio.wait({primary}, timeout=delay)
+    if delay is None or primary.done():
+        hedger.record_call(False)
+        return await primary, "not_hedged"
+    if not hedger.may_hedge():
+        hedger.record_call(False)
+        return await primary, "capped"
+
+    hedger.record_call(True)
+    logger.info(f"Hedging {hedger.name} after {delay:.2f}s")
+    hedge = _start_attempt(hedger, call, context)
+    pending = {primary, hedge}
+    error = None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is None:
+                for other in pending:
+                    other.cancel()
+                return task.result(), "hedge_won" if task is hedge else "primary_won"
+            error = error or task.exception()
+    raise error
@@ -1,17 +1,74 @@
 import os
+import re
+from typing import Dict
+from typing import List
 from typing import Optional
 from typing import Tuple
 
 from fuzzywuzzy import fuzz
 from rdflib import Graph
+from rdflib import Namespace
+from rdflib.namespace import RDFS
 
 from app.common import logger
 
+EX = Namespace("http://example.com/")
+
 
 class CompanyMatcher:
     def __init__(self, graph_path: str):
         self.g = Graph()
         self.g.parse(os.path.join(graph_path, "companies.ttl"), format="ttl")
+        self.alias_index = self._build_alias_index()
+        # longest aliases first so that "Volvo Group" wins over "Volvo"
+        self.alias_pattern = (
+            re.compile(
+                "|".join(
+                    rf"(?<!\w){re.escape(alias)}(?!\w)"
+                    for alias in sorted(self.alias_index, key=len, reverse=True)
+                ),
+                re.IGNORECASE,
+            )
+            if self.alias_index
+            else None
+        )
+
+    def _build_alias_index(self) -> Dict[str, Tuple[str, str]]:
+        """
+        Map every lowercased label and alternative label to its (canonical name, official name).
+        The triples are read directly: rdflib imports and prepares its SPARQL engine on the first
+        query, a fraction of a second at startup.
+
+        Returns:
+            Dict[str, Tuple[str, str]]: Alias index of the graph
+        """
+        alias_index = {}
+        for company, label in self.g.subject_objects(RDFS.label):
+            for canonical_name in self.g.objects(company, EX.canonicalName):
+                match = (str(canonical_name), str(label))
+                alias_index[str(label).lower()] = match
+                for alt_label in self.g.objects(company, EX.altLabel):
+                    alias_index.setdefault(str(alt_label).lower(), match)
+        return alias_index
+
+    def find_companies(self, text: str) -> List[str]:
+        """
+        Find the company names mentioned in a free text using the alias index.
+
+        Args:
+            text (str): Text to search, e.g. a user query
+
+        Returns:
+            List[str]: Company names as they appear in the text, one per canonical company
+        """
+        if self.alias_pattern is None:
+            return []
+
+        companies = {}
+        for match in self.alias_pattern.finditer(text):
+            canonical_name, _ = self.alias_index[match.group(0).lower()]
+            companies.setdefault(canonical_name, match.group(0))
+        return list(companies.values())
 
     def get_company_matches(self, company_name: str) -> Optional[Tuple[str, str, float]]:
         """
@@ -23,25 +80,10 @@ class CompanyMatcher:
         Returns:
             Optional[Tuple[str, str, float]]: Tuple of (canonical name, official name, match ratio) or None if no match found
         """
-        # First try exact match
-        query = (
-            """
-            PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-            PREFIX ex: <http://example.com/>
-            SELECT ?canonicalName ?label
-            WHERE {
-                ?company rdfs:label ?label ;
-                        ex:canonicalName ?canonicalName .
-                BIND(LCASE(str(?label)) AS ?lowerLabel)
-                FILTER(?lowerLabel = "%s")
-            }
-        """
-            % company_name.lower()
-        )
-
-        results = self.g.query(query)
-        for row in results:
-            return (str(row.canonicalName), str(row.label), 100.0)
+        # First try exact match against the labels and alternative labels
+        match = self.alias_index.get(company_name.lower())
+        if match:
+            return (match[0], match[1], 100.0)
 
         # If no exact match, try fuzzy matching against all labels
         query = """
@@ -101,10 +143,6 @@ class CompanyMatcher:
         return company_name  # Return the original name if no match found
 
 
-g = Graph()
-g.parse(os.path.join("data", "knowledge_graph", "companies.ttl"), format="ttl")
-
-
 def is_company_match(source, company_name):
     query = """
     PREFIX ex: <http://example.com/>
@@ -119,7 +157,7 @@ def is_company_match(source, company_name):
         source
     )
 
-    results = g.query(query)
+    results = company_matcher.g.query(query)
 
     logger.info(source)
     for row in results:
@@ -0,0 +1,152 @@
+import functools
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
+
+from app.common import tracing
+
+
+# LLM calls take seconds, in-memory stages take milliseconds
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    20.0,
+    40.0,
+)
+
+STAGE_LATENCY = Histogram(
+    "kapital_stage_latency_seconds",
+    "Latency of a stage of a chat request",
+    ["stage", "tool"],
+    buckets=LATENCY_BUCKETS,
+)
+STAGE_ERRORS = Counter(
+    "kapital_stage_errors_total",
+    "Number of errors raised in a stage of a chat request",
+    ["stage", "tool"],
+)
+LLM_TOKENS = Counter(
+    "kapital_llm_tokens_total",
+    "Number of tokens sent to and received from the LLMs",
+    ["model", "kind"],
+)
+CACHE_REQUESTS = Counter(
+    "kapital_cache_requests_total",
+    "Number of cache lookups",
+    ["cache", "result"],
+)
+CACHE_EVICTIONS = Counter(
+    "kapital_cache_evictions_total",
+    "Number of entries evicted from a size-bounded cache",
+    ["cache"],
+)
+CACHE_SIZE = Gauge(
+    "kapital_cache_size",
+    "Size of the entries held by a size-bounded cache, in its unit (e.g. bytes)",
+    ["cache"],
+)
+DEGRADATIONS = Counter(
+    "kapital_degradations_total",
+    "Number of stages degraded, or requests cut, to answer within the request deadline",
+    ["degradation", "tool"],
+)
+HEDGED_CALLS = Counter(
+    "kapital_llm_hedged_calls_total",
+    "Number of hedgeable LLM calls by outcome: not_hedged (returned in time or too few latencies "
+    "observed), capped (late, over the hedge rate), primary_won or hedge_won (hedged)",
+    ["call", "outcome"],
+)
+HEDGE_DELAY = Gauge(
+    "kapital_llm_hedge_delay_seconds",
+    "Latency percentile after which an LLM call is hedged",
+    ["call"],
+)
+SPECULATIONS = Counter(
+    "kapital_speculations_total",
+    "Number of speculative searches by outcome: hit (used by the tool), miss (the tool was called "
+    "with other arguments), cancelled (not started when claimed), timeout (still running after "
+    "the wait), error or unused (the tool was not called)",
+    ["tool", "outcome"],
+)
+SPECULATION_SAVED = Histogram(
+    "kapital_speculation_saved_seconds",
+    "Search time a speculative hit saved the tool",
+    ["tool"],
+    buckets=LATENCY_BUCKETS,
+)
+ROUTER_DECISIONS = Counter(
+    "kapital_router_decisions_total",
+    "Number of local router decisions",
+    ["tool", "routed"],
+)
+FACT_LOOKUPS = Counter(
+    "kapital_fact_lookups_total",
+    "Number of structured queries looked up in the fact store",
+    ["result"],
+)
+CONTEXT_TOKENS = Counter(
+    "kapital_context_tokens_total",
+    "Number of context tokens packed into synthesis prompts and saved by the packing",
+    ["kind"],
+)
+CHAT_BACKEND_LOAD = Gauge(
+    "kapital_chat_backend_load_seconds",
+    "Time the chat backend (the agent, its tools and their indexes) took to load at startup",
+)
+
+
+@contextmanager
+def timed(stage: str, tool: str = ""):
+    """
+    Measure the latency of a stage and count its errors, recording it as a span of the request trace.
+
+    Args:
+        stage (str): Stage name, e.g. "faiss_search"
+        tool (str): Tool the stage runs in, empty for request-level stages
+
+    Yields:
+        The span of the stage, to add attributes to
+    """
+    start = time.perf_counter()
+    try:
+        with tracing.span(stage, tool=tool) as span:
+            yield span
+    except Exception:
+        STAGE_ERRORS.labels(stage, tool).inc()
+        raise
+    finally:
+        STAGE_LATENCY.labels(stage, tool).observe(time.perf_counter() - start)
+
+
+def timed_tool_run(run):
+    """Decorate the `_run` method of a tool to time it as the "tool_run" stage."""
+
+    @functools.wraps(run)
+    def wrapper(self, *args, **kwargs):
+        with timed("tool_run", self.name):
+            return run(self, *args, **kwargs)
+
+    return wrapper
+
+
+def record_token_usage(model: str, prompt_tokens: int, completion_tokens: int) -> None:
+    LLM_TOKENS.labels(model, "prompt").inc(prompt_tokens)
+    LLM_TOKENS.labels(model, "completion").inc(completion_tokens)
+
+
+def record_cache_lookup(cache: str, hit: bool) -> None:
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
@@ -0,0 +1,159 @@
+import hmac
+from typing import Iterable
+from typing import Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.datastructures import MutableHeaders
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp
+from starlette.types import Message
+from starlette.types import Receive
+from starlette.types import Scope
+from starlette.types import Send
+
+from app.common.encoding import Compress
+from app.common.encoding import compressor
+from app.common.encoding import is_compressible
+from app.common.encoding import negotiate_encoding
+
+# bodies compressed in a worker thread rather than on the event loop
+OFFLOAD_BYTES = 64 * 1024
+
+
+def key_matches(api_key: Optional[str], keys: Iterable[str]) -> bool:
+    """Whether the key is one of the keys, comparing with all of them in constant time."""
+    if not api_key:
+        return False
+    candidate = api_key.encode("utf-8")
+    matched = False
+    for key in keys:
+        matched |= hmac.compare_digest(candidate, key.encode("utf-8"))
+    return matched
+
+
+def bearer_key(headers: Headers) -> Optional[str]:
+    auth_header = headers.get("authorization", "")
+    if not auth_header.startswith("Bearer "):
+        return None
+    return auth_header[len("Bearer ") :]
+
+
+class AuthMiddleware:
+    """
+    Pure ASGI middleware rejecting plain HTTP in production and requests without a valid API key,
+    except for the public paths.
+
+    Unlike `@app.middleware("http")`, it does not wrap the request and response streams in tasks,
+    so accepted requests reach the app as they are and streaming responses are not buffered.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        api_keys: Iterable[str],
+        public_paths: Iterable[str] = (),
+        require_https: bool = False,
+    ):
+        self.app = app
+        self.api_keys = [key for key in api_keys if key]
+        self.public_paths = frozenset(public_paths)
+        self.require_https = require_https
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if self.require_https and scope.get("scheme") != "https":
+            response = JSONResponse(
+                status_code=403, content={"detail": "HTTPS is required in production"}
+            )
+        elif scope["path"] in self.public_paths:
+            response = None
+        else:
+            api_key = bearer_key(Headers(scope=scope))
+            if api_key is None:
+                response = JSONResponse(
+                    status_code=401, content={"detail": "Missing or invalid Authorization header"}
+                )
+            elif not key_matches(api_key, self.api_keys):
+                response = JSONResponse(status_code=403, content={"detail": "Invalid API key"})
+            else:
+                response = None
+
+        if response is not None:
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+
+class CompressionMiddleware:
+    """
+    Pure ASGI middleware compressing the responses with the encoding negotiated from the
+    Accept-Encoding header of the request (zstd, br or gzip, see `negotiate_encoding`).
+
+    A response in one chunk is compressed if it has at least `minimum_size` bytes. A streaming
+    response is compressed chunk by chunk, each chunk flushed so that it can still be decoded as
+    soon as it arrives. Responses already encoded or of incompressible types are sent as they are.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start: Optional[Message] = None
+        compress: Optional[Compress] = None
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start, compress
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start is not None:
+                # first chunk: decide from the headers and the size whether to compress at all
+                headers = MutableHeaders(raw=start["headers"])
+                if (
+                    "content-encoding" not in headers
+                    and is_compressible(headers.get("content-type"))
+                    and (more_body or len(body) >= self.minimum_size)
+                ):
+                    compress = compressor(encoding)
+                    headers["Content-Encoding"] = encoding
+                    headers.add_vary_header("Accept-Encoding")
+                    if "content-length" in headers:
+                        del headers["content-length"]
+                    body = await _compress(compress, body, not more_body)
+                    if not more_body:
+                        headers["Content-Length"] = str(len(body))
+                    message = {"type": "http.response.body", "body": body, "more_body": more_body}
+                await send(start)
+                start = None
+            elif compress is not None:
+                body = await _compress(compress, body, not more_body)
+                message = {"type": "http.response.body", "body": body, "more_body": more_body}
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+
+async def _compress(compress: Compress, data: bytes, final: bool) -> bytes:
+    # a large body takes milliseconds to compress, which would stall the other requests
+    if len(data) >= OFFLOAD_BYTES:
+        return await run_in_threadpool(compress, data, final)
+    return compress(data, final)
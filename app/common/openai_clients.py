@@ -0,0 +1,27 @@
+import functools
+
+from openai import AsyncOpenAI
+from openai import DefaultAsyncHttpxClient
+from openai import DefaultHttpxClient
+from openai import OpenAI
+
+from app.common import OPENAI_API_KEY
+
+# One connection pool for all the OpenAI clients, LangChain's included, instead of one per client:
+# each pool builds its own TLS context at startup, and its connections are not reused by the others.
+# The async clients run on the event loop of app.common.hedging only.
+http_client = DefaultHttpxClient()
+http_async_client = DefaultAsyncHttpxClient()
+
+
+# created on first use, the modules calling OpenAI are also imported by offline tools run without
+# an API key, e.g. benchmarks.retrieval
+@functools.lru_cache(maxsize=None)
+def get_client() -> OpenAI:
+    return OpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
+
+
+# for the hedged calls
+@functools.lru_cache(maxsize=None)
+def get_async_client() -> AsyncOpenAI:
+    return AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_async_client)
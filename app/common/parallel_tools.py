@@ -0,0 +1,81 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from typing import Dict
+from typing import List
+
+from langchain.schema import AgentAction
+from langchain.tools import BaseTool
+
+from app.common import logger
+
+
+def run_tool_calls(actions: List[AgentAction], tools: Dict[str, BaseTool]) -> List[dict]:
+    """
+    Run the tool calls issued by the agent in a single step concurrently.
+
+    Args:
+        actions (List[AgentAction]): Tool calls planned by the agent
+        tools (Dict[str, BaseTool]): Available tools by name
+
+    Returns:
+        List[dict]: Outputs of the tools that succeeded, in the order of the calls
+    """
+    with ThreadPoolExecutor(max_workers=len(actions)) as executor:
+        # each call gets a copy of the request context, so its spans join the request trace
+        futures = [
+            executor.submit(copy_context().run, tools[action.tool].invoke, action.tool_input)
+            for action in actions
+        ]
+
+    outputs = []
+    errors = []
+    for action, future in zip(actions, futures):
+        try:
+            outputs.append(future.result())
+        except Exception as e:
+            logger.error(f"Error in {action.tool}: {str(e)}")
+            errors.append(e)
+
+    if not outputs and errors:
+        raise errors[0]
+    return outputs
+
+
+def merge_tool_outputs(outputs: List[dict]) -> dict:
+    """
+    Combine the answers, sources and page images of several tools into one tool output.
+
+    Args:
+        outputs (List[dict]): Tool outputs with "result", "metadata" and "image" keys
+
+    Returns:
+        dict: A single output with the same structure
+    """
+    if len(outputs) == 1:
+        return outputs[0]
+
+    results = []
+    file_names = []
+    pages = []
+    images = []
+    seen_images = set()
+    for output in outputs:
+        if not isinstance(output, dict):
+            results.append(str(output))
+            continue
+
+        results.append(output["result"])
+        file_names.extend(output["metadata"]["file_name"])
+        pages.extend(output["metadata"]["page"])
+        for image in output.get("image", []):
+            # both tools can cite the same page
+            key = (image.info["file_name"], image.info["page"])
+            if key not in seen_images:
+                seen_images.add(key)
+                images.append(image)
+
+    return {
+        "result": "\n\n".join(results),
+        "metadata": {"file_name": file_names, "page": pages},
+        "image": images,
+    }
@@ -0,0 +1,139 @@
+import datetime
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import List
+from typing import Optional
+
+from app.common import logger
+from app.common import PROFILE_DIR
+from app.common import PROFILE_INTERVAL_MS
+
+
+# Leaf frames of threads that are idle rather than working for a request
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+}
+
+PROFILE_ID_PATTERN = re.compile(r"^[0-9]{8}T[0-9]{6}-[0-9a-f]{8}$")
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler that periodically samples the Python stacks of the running threads, or of
+    a single thread, from a background thread, and aggregates them into collapsed stacks for
+    flamegraphs.
+    """
+
+    def __init__(self, interval: float, target_thread_id: Optional[int] = None):
+        """
+        Args:
+            interval (float): Seconds between two samples
+            target_thread_id (Optional[int]): Thread serving the profiled request, the only one
+                sampled, idle frames included (e.g. waiting on the tools it runs). Without it, all
+                the threads are sampled, except the idle ones.
+        """
+        self.interval = interval
+        self.target_thread_id = target_thread_id
+        self.profile_id = (
+            f"{datetime.datetime.now().strftime('%Y%m%dT%H%M%S')}-{os.urandom(4).hex()}"
+        )
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _sample_loop(self) -> None:
+        own_thread_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+                # the other threads serve concurrent requests, unrelated to the profiled one
+                if self.target_thread_id is not None and thread_id != self.target_thread_id:
+                    continue
+
+                leaf = (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+                if leaf in IDLE_FRAMES and self.target_thread_id is None:
+                    continue
+
+                stack: List[str] = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        """Collapsed stacks ("root;...;leaf count" lines), the input of flamegraph.pl or speedscope."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def save(self, profile_dir: str) -> str:
+        os.makedirs(profile_dir, exist_ok=True)
+        file_path = os.path.join(profile_dir, f"{self.profile_id}.collapsed")
+        with open(file_path, "w") as f:
+            f.write(self.collapsed())
+        logger.info(f"Saved profile {self.profile_id} with {self.samples} samples to {file_path}")
+        return file_path
+
+
+@contextmanager
+def profiled(enabled: bool):
+    """
+    Profile the block in the current thread if enabled, and store the result in PROFILE_DIR.
+
+    Yields:
+        Optional[SamplingProfiler]: The running profiler, None if disabled
+    """
+    if not enabled:
+        yield None
+        return
+
+    profiler = SamplingProfiler(PROFILE_INTERVAL_MS / 1000, target_thread_id=threading.get_ident())
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        profiler.save(PROFILE_DIR)
+
+
+def profile_window(seconds: float) -> SamplingProfiler:
+    """Profile the whole process for a time window, blocking the calling thread."""
+    profiler = SamplingProfiler(PROFILE_INTERVAL_MS / 1000)
+    profiler.start()
+    time.sleep(seconds)
+    profiler.stop()
+    profiler.save(PROFILE_DIR)
+    return profiler
+
+
+def load_profile(profile_id: str) -> Optional[str]:
+    """Read a stored profile, None if the id is malformed or unknown."""
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    file_path = os.path.join(PROFILE_DIR, f"{profile_id}.collapsed")
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path) as f:
+        return f.read()
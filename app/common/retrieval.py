@@ -0,0 +1,268 @@
+import itertools
+from collections import defaultdict
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+from langchain.schema import Document
+
+from app.common import QUERY_EMBEDDING_CACHE_MB
+from app.common import RETRIEVAL_CACHE_SIZE
+from app.common import RETRIEVAL_CACHE_TTL_SECONDS
+from app.common.cache import SizedLRUCache
+from app.common.deadline import degrade
+from app.common.metrics import timed
+from app.common.vector_store import Collection
+from app.common.vector_store import Shard
+
+# shard keys and docstore ids of the fused candidates of recent searches, so a repeated search
+# skips the embedding, FAISS, BM25 and fusion; keyed by collection version, it never serves
+# candidates of a swapped out version
+retrieval_cache: SizedLRUCache[List[Tuple[str, str]]] = SizedLRUCache(
+    "retrieval", RETRIEVAL_CACHE_SIZE, lambda ids: 1, ttl=RETRIEVAL_CACHE_TTL_SECONDS
+)
+
+
+def reciprocal_rank_fusion(doc_lists: List[List[Document]], c: int = 60) -> List[Document]:
+    """
+    Fuse several rankings with Reciprocal Rank Fusion, like EnsembleRetriever with equal weights.
+
+    Args:
+        doc_lists (List[List[Document]]): Rankings of documents, best first
+        c (int): Constant that controls the influence of the lower ranks
+
+    Returns:
+        List[Document]: Documents deduplicated by content, sorted by their fused score
+    """
+    weight = 1 / len(doc_lists)
+    rrf_score: Dict[str, float] = defaultdict(float)
+    unique_docs: Dict[str, Document] = {}
+    for doc_list in doc_lists:
+        for rank, doc in enumerate(doc_list, start=1):
+            rrf_score[doc.page_content] += weight / (rank + c)
+            unique_docs.setdefault(doc.page_content, doc)
+
+    return sorted(unique_docs.values(), key=lambda doc: rrf_score[doc.page_content], reverse=True)
+
+
+def interleave(doc_lists: List[List[Document]], k: int) -> List[Document]:
+    """First k documents of several rankings taken in turns, best first."""
+    return [doc for docs in itertools.zip_longest(*doc_lists) for doc in docs if doc is not None][
+        :k
+    ]
+
+
+# float32 query embeddings by collection version and query
+query_embedding_cache: SizedLRUCache[np.ndarray] = SizedLRUCache(
+    "query_embedding", QUERY_EMBEDDING_CACHE_MB * 2**20, lambda vector: vector.nbytes
+)
+
+
+def query_embedding(collection: Collection, shards: List[Shard], query: str) -> np.ndarray:
+    """Embedding of a query with the model of the collection version, cached."""
+    return query_embedding_cache.get_or_load(
+        (collection.name, collection.version, query),
+        lambda: np.asarray(shards[0].db.embedding_function.embed_query(query), dtype=np.float32),
+    )
+
+
+def embed_queries(
+    collection: Collection, companies: Optional[List[str]], queries: List[str]
+) -> int:
+    """
+    Embed the queries not in `query_embedding_cache` in a single call to the embedding model.
+
+    Args:
+        collection (Collection): Collection version the queries will search
+        companies (Optional[List[str]]): Companies of the queries, whose shards are loaded
+        queries (List[str]): Queries to embed
+
+    Returns:
+        int: Number of queries embedded
+    """
+    missing = [
+        query
+        for query in dict.fromkeys(queries)
+        if (collection.name, collection.version, query) not in query_embedding_cache
+    ]
+    shards = collection.shards(companies)
+    if not missing or not shards:
+        return 0
+    vectors = shards[0].db.embedding_function.embed_documents(missing)
+    for query, vector in zip(missing, vectors):
+        query_embedding_cache.put(
+            (collection.name, collection.version, query), np.asarray(vector, dtype=np.float32)
+        )
+    return len(missing)
+
+
+def retrieval_cache_key(
+    collection: Collection, query: str, query_metadata: dict, top_k: int, tool: str
+) -> tuple:
+    """
+    Cache key of a search: the query with its case and whitespace normalized, the allowed metadata
+    values in any order, and the collection version.
+    """
+    filter_key = tuple(
+        sorted(
+            (name, tuple(sorted(str(value) for value in values)) if values is not None else None)
+            for name, values in query_metadata.items()
+        )
+    )
+    normalized_query = " ".join(query.casefold().split())
+    return (tool, collection.name, collection.version, normalized_query, filter_key, top_k)
+
+
+def hybrid_search(
+    collection: Collection,
+    query: str,
+    query_metadata: dict,
+    metadata_filter: Callable[[dict], bool],
+    top_k: int,
+    tool: str,
+    use_cache: bool = True,
+) -> List[Document]:
+    """
+    Search with FAISS similarity, FAISS MMR and BM25 over the filtered chunks, and fuse the results.
+
+    Only the shards of the queried companies are searched, loaded on demand. The candidates are
+    cached, the metadata filter must therefore be the one of the allowed metadata values. Close to
+    the deadline of the request, the search degrades by skipping MMR, then halving top_k.
+
+    Args:
+        collection (Collection): Collection version of the tool
+        query (str): Search query
+        query_metadata (dict): Allowed metadata values for the BM25 chunks, by metadata key
+        metadata_filter (Callable[[dict], bool]): Metadata filter for the FAISS search
+        top_k (int): Number of documents to return per retriever
+        tool (str): Tool name, for metrics
+        use_cache (bool): Look up and store the candidates in `retrieval_cache`, and the query
+            embedding in `query_embedding_cache`
+
+    Returns:
+        List[Document]: Fused documents with unique page numbers, company names and years
+    """
+    cache_candidates = use_cache and RETRIEVAL_CACHE_SIZE > 0
+    if cache_candidates:
+        key = retrieval_cache_key(collection, query, query_metadata, top_k, tool)
+        with timed("retrieval_cache", tool) as span:
+            ids = retrieval_cache.get(key)
+            docs = collection.documents(ids) if ids is not None else None
+            span.set_attributes(hit=ids is not None)
+        if docs is not None:
+            return docs
+
+    # close to the request deadline, the MMR search is skipped, then fewer documents retrieved;
+    # the candidates of a degraded search are not cached
+    mmr = not degrade("skip_mmr", tool)
+    shrink = degrade("shrink_top_k", tool)
+    if shrink:
+        top_k = max(1, top_k // 2)
+    cache_candidates = cache_candidates and mmr and not shrink
+
+    docs, shards = search_candidates(
+        collection, query, query_metadata, metadata_filter, top_k, tool, use_cache, mmr
+    )
+    if cache_candidates:
+        ids = collection.document_ids(docs, shards)
+        if ids is not None:
+            retrieval_cache.put(key, ids)
+    return docs
+
+
+def search_candidates(
+    collection: Collection,
+    query: str,
+    query_metadata: dict,
+    metadata_filter: Callable[[dict], bool],
+    top_k: int,
+    tool: str,
+    use_cache: bool = True,
+    mmr: bool = True,
+) -> Tuple[List[Document], List[Shard]]:
+    """
+    The hybrid search without the candidates cache, returning the fused documents and the shards
+    searched; `use_cache` applies to the query embedding, `mmr` runs the FAISS MMR search.
+    """
+    with timed("shard_select", tool) as span:
+        shards = collection.shards(query_metadata.get("company"))
+        span.set_attributes(shards=len(shards), collection_version=collection.version)
+    if not shards:
+        return [], shards
+
+    with timed("query_embedding", tool) as span:
+        if use_cache:
+            embedding = query_embedding(collection, shards, query)
+        else:
+            embedding = shards[0].db.embedding_function.embed_query(query)
+        span.set_attributes(query_chars=len(query))
+
+    with timed("faiss_search", tool) as span:
+        # distances are comparable across shards, the MMR and BM25 rankings are interleaved
+        similarity = sorted(
+            (
+                result
+                for shard in shards
+                for result in shard.db.similarity_search_with_score_by_vector(
+                    embedding, k=top_k, filter=metadata_filter
+                )
+            ),
+            key=lambda result: result[1],
+        )
+        doc_lists = [[doc for doc, _ in similarity[:top_k]]]
+        if mmr:
+            doc_lists.append(
+                interleave(
+                    [
+                        shard.db.max_marginal_relevance_search_by_vector(
+                            embedding, k=top_k, filter=metadata_filter
+                        )
+                        for shard in shards
+                    ],
+                    top_k,
+                )
+            )
+        span.set_attributes(
+            top_k=top_k,
+            similarity_candidates=len(doc_lists[0]),
+            mmr_candidates=len(doc_lists[1]) if mmr else 0,
+        )
+
+    with timed("bm25_build", tool) as span:
+        bm25_retrievers = [
+            retriever
+            for retriever in (shard.bm25_retriever(query_metadata) for shard in shards)
+            if retriever is not None
+        ]
+        span.set_attributes(
+            chunks=sum(len(shard.documents) for shard in shards),
+            filtered_chunks=sum(len(retriever.docs) for retriever in bm25_retrievers),
+        )
+
+    if bm25_retrievers:
+        with timed("bm25_search", tool) as span:
+            doc_lists.append(
+                interleave(
+                    [retriever.get_relevant_documents(query) for retriever in bm25_retrievers],
+                    bm25_retrievers[0].k,
+                )
+            )
+            span.set_attributes(bm25_candidates=len(doc_lists[-1]))
+
+    with timed("fusion", tool) as span:
+        ensemble_relevant_docs = reciprocal_rank_fusion(doc_lists)
+
+        # get docs with unique page numbers, company names and years
+        unique_docs = {}
+        for doc in ensemble_relevant_docs:
+            key = (doc.metadata["page_nr"], doc.metadata["company"], doc.metadata["year"])
+            if key not in unique_docs:
+                unique_docs[key] = doc
+        span.set_attributes(
+            fused_candidates=len(ensemble_relevant_docs), unique_pages=len(unique_docs)
+        )
+
+    return list(unique_docs.values()), shards
@@ -0,0 +1,237 @@
+import re
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from pydantic import BaseModel
+
+from app.common import logger
+from app.common import ROUTER_CONFIDENCE_THRESHOLD
+from app.common.knowledge_graphs import company_matcher
+from app.common.metrics import ROUTER_DECISIONS
+
+
+YEAR_PATTERN = re.compile(r"(?<!\d)(20\d{2})(?!\d)")
+
+# (pattern, quarters) pairs, in the same terms as the tools' `quarters` argument
+QUARTER_PATTERNS = [
+    (re.compile(r"\bq([1-4])\b|\b([1-4])q\b", re.IGNORECASE), None),
+    (re.compile(r"\b(h1|first half|half[- ]year)\b", re.IGNORECASE), ["q2"]),
+    (re.compile(r"\b(9m|nine months)\b", re.IGNORECASE), ["q3"]),
+    (
+        re.compile(r"\b(fy|full[- ]year|whole year|annual|annually)\b", re.IGNORECASE),
+        ["q4", "annual"],
+    ),
+]
+
+# Periods relative to the current date are left to the agent, which knows the date
+RELATIVE_PERIOD_PATTERN = re.compile(
+    r"\b(last|this|next|previous|current|past|recent|latest|coming)\s+"
+    r"(year|quarter|half|period|report|years|quarters)\b|\b(ytd|today|yesterday)\b",
+    re.IGNORECASE,
+)
+
+# Requests other than a question on the reports (creative writing, other tasks, advice) are left
+# to the agent, which decides what is in its scope
+OUT_OF_SCOPE_TERMS = [
+    "write",
+    "compose",
+    "draft",
+    "rewrite",
+    "translate",
+    "poem",
+    "poems",
+    "story",
+    "joke",
+    "song",
+    "essay",
+    "haiku",
+    "limerick",
+    "rap",
+    "letter",
+    "email",
+    "tweet",
+    "pretend",
+    "imagine",
+    "roleplay",
+    "role play",
+    "act as",
+    "ignore",
+    "draw",
+    "script",
+    "predict",
+    "recommend",
+    "should i",
+    "advice",
+]
+OUT_OF_SCOPE_PATTERN = re.compile(r"\b(" + "|".join(OUT_OF_SCOPE_TERMS) + r")\b", re.IGNORECASE)
+
+# Terms that point at tables and figures (structured_tool) or at text (unstructured_tool)
+NUMERIC_TERMS = [
+    "revenue",
+    "sales",
+    "profit",
+    "income",
+    "ebit",
+    "ebitda",
+    "margin",
+    "liabilities",
+    "assets",
+    "equity",
+    "cash flow",
+    "debt",
+    "earnings",
+    "eps",
+    "dividend",
+    "total",
+    "amount",
+    "how much",
+    "how many",
+    "expenses",
+    "costs",
+    "capex",
+    "loans",
+    "turnover",
+    "deficit",
+    "retained",
+    "gross",
+    "balance sheet",
+    "number of",
+]
+NARRATIVE_TERMS = [
+    "risk",
+    "risks",
+    "why",
+    "explain",
+    "strategy",
+    "trend",
+    "trends",
+    "outlook",
+    "describe",
+    "definition",
+    "what is meant",
+    "mean",
+    "policy",
+    "policies",
+    "impact",
+    "opportunities",
+    "board",
+    "members",
+    "management",
+    "how does",
+    "how did",
+    "consider",
+    "recognition",
+    "approach",
+    "determine",
+    "sustainability",
+]
+NUMERIC_PATTERN = re.compile(r"\b(" + "|".join(NUMERIC_TERMS) + r")\b", re.IGNORECASE)
+NARRATIVE_PATTERN = re.compile(r"\b(" + "|".join(NARRATIVE_TERMS) + r")\b", re.IGNORECASE)
+
+QUESTION_PREFIX_PATTERN = re.compile(
+    r"^\s*(what|how much|how many)\s+(is|was|are|were)\s+(the\s+)?", re.IGNORECASE
+)
+
+
+class RouteDecision(BaseModel):
+    tool: str
+    tool_input: dict
+    confidence: float
+
+
+def parse_years(query: str) -> Optional[List[int]]:
+    """Extract explicit years (e.g. 2023) from a query."""
+    years = sorted({int(year) for year in YEAR_PATTERN.findall(query)})
+    return years or None
+
+
+def parse_quarters(query: str) -> Optional[List[str]]:
+    """
+    Extract explicit periods from a query, e.g. "Q3" -> ['q3'], "H1" -> ['q2'], "FY" -> ['q4', 'annual'].
+    """
+    quarters = []
+    for pattern, mapped_quarters in QUARTER_PATTERNS:
+        for match in pattern.finditer(query):
+            if mapped_quarters is None:
+                quarters.append(f"q{match.group(1) or match.group(2)}")
+            else:
+                quarters.extend(mapped_quarters)
+    return sorted(set(quarters)) or None
+
+
+def classify_intent(query: str) -> Tuple[str, float]:
+    """
+    Classify a query as numeric (structured_tool) or narrative (unstructured_tool).
+
+    Returns:
+        Tuple[str, float]: Tool name and confidence between 0 and 1
+    """
+    numeric_hits = len(NUMERIC_PATTERN.findall(query))
+    narrative_hits = len(NARRATIVE_PATTERN.findall(query))
+    total_hits = numeric_hits + narrative_hits
+    if total_hits == 0:
+        return "unstructured_tool", 0.0
+
+    tool = "structured_tool" if numeric_hits > narrative_hits else "unstructured_tool"
+    # a single unambiguous term is less certain than several agreeing ones
+    confidence = abs(numeric_hits - narrative_hits) / total_hits * min(1.0, 0.5 + 0.25 * total_hits)
+    return tool, confidence
+
+
+def rewrite_query(query: str) -> str:
+    """Turn a question into a search query, e.g. "What is the total revenue of IKEA in 2023?" ->
+    "Total revenue of IKEA in 2023"."""
+    search_query = QUESTION_PREFIX_PATTERN.sub("", query).strip().rstrip("?").strip()
+    return search_query[:1].upper() + search_query[1:]
+
+
+class QueryRouter:
+    """Routes well-formed queries to a tool locally, without the agent LLM call."""
+
+    def __init__(self, confidence_threshold: float):
+        self.confidence_threshold = confidence_threshold
+
+    def route(self, query: str, chat_history: Optional[list] = None) -> Optional[RouteDecision]:
+        """
+        Decide which tool answers the query and with which arguments. Follow-up messages, which
+        only the conversation gives a meaning, and requests out of the scope of a question on the
+        reports are left to the agent.
+
+        Args:
+            query (str): The last user message
+            chat_history (Optional[list]): Previous messages of the conversation
+
+        Returns:
+            Optional[RouteDecision]: The decision if it is confident enough, None to fall back to the agent
+        """
+        company_names = company_matcher.find_companies(query)
+        years = parse_years(query)
+        tool, intent_confidence = classify_intent(query)
+
+        confidence = intent_confidence
+        if not company_names or years is None or RELATIVE_PERIOD_PATTERN.search(query):
+            confidence = 0.0
+        if chat_history or OUT_OF_SCOPE_PATTERN.search(query):
+            confidence = 0.0
+
+        decision = RouteDecision(
+            tool=tool,
+            tool_input={
+                "user_query": rewrite_query(query),
+                "company_names": company_names,
+                "years": years,
+                "quarters": parse_quarters(query),
+            },
+            confidence=confidence,
+        )
+        routed = confidence >= self.confidence_threshold
+        ROUTER_DECISIONS.labels(tool, str(routed).lower()).inc()
+        logger.info(
+            f"Local router: routed={routed}, tool={tool}, confidence={confidence:.2f}, "
+            f"input={decision.tool_input}"
+        )
+        return decision if routed else None
+
+
+query_router = QueryRouter(ROUTER_CONFIDENCE_THRESHOLD)
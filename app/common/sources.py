@@ -0,0 +1,119 @@
+import os
+from typing import Dict
+from typing import Iterable
+from typing import Optional
+
+from langchain.schema import Document
+from pydantic import BaseModel
+
+from app.common import PAGES_PATH
+
+# structured documents are the table followed by its summary
+SUMMARY_SEPARATOR = "## Summary of the table:\n"
+
+COMPANY_DISPLAY_NAMES = {"hm": "H&M", "volvo": "Volvo", "ikea": "IKEA"}
+QUARTER_DISPLAY_NAMES = {"q1": "Q1", "q2": "Q2", "q3": "Q3", "q4": "Q4", "annual": "FY"}
+REPORT_TYPES = {"q1": "Q1", "q2": "Q2", "q3": "Q3", "q4": "Q4", "annual": "annual"}
+# metadata a source is derived from, besides the content
+SOURCE_KEYS = ("company", "quarter", "year", "page_nr", "source")
+
+
+class SourceInfo(BaseModel):
+    """What the tools show and load for a retrieved document, derived once when it is loaded."""
+
+    report: str  # e.g. "volvo_q4_2023"
+    file_name: str  # e.g. "volvo_q4_2023.pdf"
+    company: str
+    company_display: str  # e.g. "Volvo"
+    quarter: str
+    quarter_display: str  # e.g. "Q4", "FY" for annual reports
+    year: int
+    page_nr: int
+    display_name: str  # e.g. "Volvo Q4 report, year 2023", listed under the answer
+    caption: str  # e.g. "Volvo Q4 2023", shown with the page image
+    image_key: str  # path of the base64 page image
+    summary: Optional[str] = None  # summary of a table, for the structured tool
+
+
+def page_image_path(report: str, page: int) -> str:
+    return os.path.join(PAGES_PATH, report, f"{report}_page_{page}.txt")
+
+
+def make_source_info(
+    company: str,
+    quarter: str,
+    year: int,
+    page_nr: int,
+    report: Optional[str] = None,
+    summary: Optional[str] = None,
+) -> SourceInfo:
+    """
+    Source of a page of a report, named like `{company}_{quarter}_{year}` unless given.
+
+    Unknown companies and quarters are shown as they are stored.
+    """
+    quarter = quarter.lower()
+    report = report or f"{company}_{quarter}_{year}"
+    company_display = COMPANY_DISPLAY_NAMES.get(company.lower(), company)
+    quarter_display = QUARTER_DISPLAY_NAMES.get(quarter, quarter)
+    report_type = REPORT_TYPES.get(quarter, quarter)
+    return SourceInfo(
+        report=report,
+        file_name=f"{report}.pdf",
+        company=company,
+        company_display=company_display,
+        quarter=quarter,
+        quarter_display=quarter_display,
+        year=int(year),
+        page_nr=int(page_nr),
+        display_name=f"{company_display} {report_type} report, year {year}",
+        caption=f"{company_display} {quarter_display} {year}",
+        image_key=page_image_path(report, int(page_nr)),
+        summary=summary,
+    )
+
+
+def document_source_info(doc: Document, table: bool) -> SourceInfo:
+    """
+    Source of a document of either collection. Text chunks name their report in the path of their
+    `source`; tables carry their summary after SUMMARY_SEPARATOR, or are their own summary if it
+    is missing.
+    """
+    metadata = doc.metadata
+    report, summary = None, None
+    if table:
+        content, separator, summary = doc.page_content.partition(SUMMARY_SEPARATOR)
+        summary = (summary if separator else content).strip()
+    elif metadata.get("source", "").count("/") >= 1:
+        report = metadata["source"].split("/")[-2]
+    return make_source_info(
+        metadata["company"],
+        metadata["quarter"],
+        metadata["year"],
+        metadata["page_nr"],
+        report=report,
+        summary=summary,
+    )
+
+
+def document_key(doc: Document) -> tuple:
+    """Identity of a document across its copies: its content and the metadata of its source."""
+    return (doc.page_content, *(doc.metadata.get(name) for name in SOURCE_KEYS))
+
+
+def attach_source_info(docs: Iterable[Document], table: bool) -> int:
+    """
+    Store the SourceInfo of documents in their metadata under "source_info", computed once per
+    distinct document, so its copies (in the FAISS docstore and the BM25 corpus) share it.
+
+    Returns:
+        int: Number of distinct documents
+    """
+    infos: Dict[tuple, SourceInfo] = {}
+    for doc in docs:
+        key = document_key(doc)
+        info = infos.get(key)
+        if info is None:
+            info = infos[key] = document_source_info(doc, table)
+        doc.metadata["source_info"] = info
+    return len(infos)
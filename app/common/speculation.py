@@ -0,0 +1,210 @@
+import datetime
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError
+from contextlib import contextmanager
+from contextvars import ContextVar
+from contextvars import copy_context
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from fuzzywuzzy import fuzz
+from langchain.schema import Document
+
+from app.common import logger
+from app.common import SPECULATION_MAX_WAIT_SECONDS
+from app.common import SPECULATION_QUERY_SIMILARITY
+from app.common import TOP_K
+from app.common import TOP_K_UNSTRUCTURED
+from app.common import tracing
+from app.common.knowledge_graphs import company_matcher
+from app.common.metrics import SPECULATION_SAVED
+from app.common.metrics import SPECULATIONS
+from app.common.metrics import timed
+from app.common.retrieval import hybrid_search
+from app.common.router import parse_quarters
+from app.common.router import parse_years
+from app.common.router import rewrite_query
+from app.common.utils import metadata_filter_callable
+from app.common.vector_store import Collection
+from app.common.vector_store import registry
+
+# collection and top_k of the search of each tool
+SPECULATIVE_SEARCHES = {
+    "structured_tool": ("structured", TOP_K),
+    "unstructured_tool": ("unstructured", TOP_K_UNSTRUCTURED),
+}
+
+executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="speculation")
+
+
+class SpeculativeSearch:
+    """A tool's search started from the user message before the agent calls the tool."""
+
+    def __init__(self, tool: str, collection: Collection, query: str, query_metadata: dict):
+        self.tool = tool
+        self.collection = collection
+        self.query = query
+        self.query_metadata = query_metadata
+        self.started_at = time.monotonic()
+        self.finished_at: Optional[float] = None
+        self.outcome: Optional[str] = None
+        self.future: Optional[Future] = None
+        # a search is claimed once, by one of the parallel calls of its tool
+        self.lock = threading.Lock()
+
+    def run(self) -> List[Document]:
+        try:
+            with timed("speculative_search", self.tool):
+                return tool_search(self.tool, self.collection, self.query, self.query_metadata)
+        finally:
+            self.finished_at = time.monotonic()
+
+    def matches(self, collection: Collection, query: str, query_metadata: dict) -> bool:
+        """
+        Whether the search stands in for the tool's: same filter and version, and a nearly equal
+        query once both are turned into search queries. A narrower query, e.g. one part of the
+        message, does not match.
+        """
+        return (
+            collection.version == self.collection.version
+            and metadata_key(query_metadata) == metadata_key(self.query_metadata)
+            and fuzz.token_sort_ratio(rewrite_query(query), self.query)
+            >= SPECULATION_QUERY_SIMILARITY
+        )
+
+
+_current_searches: ContextVar[Optional[Dict[str, SpeculativeSearch]]] = ContextVar(
+    "speculative_searches", default=None
+)
+
+
+def metadata_key(query_metadata: dict) -> tuple:
+    """Companies, years and quarters of a search, in any order and case."""
+    return tuple(
+        (name, frozenset(str(value).lower() for value in values) if values is not None else None)
+        for name, values in sorted(query_metadata.items())
+    )
+
+
+def tool_search(
+    tool: str, collection: Collection, query: str, query_metadata: dict
+) -> List[Document]:
+    """The hybrid search a tool runs for a query and its companies, years and quarters."""
+    return hybrid_search(
+        collection,
+        query,
+        query_metadata,
+        metadata_filter_callable(
+            companies=query_metadata["company"],
+            years=query_metadata["year"],
+            quarters=query_metadata["quarter"],
+        ),
+        SPECULATIVE_SEARCHES[tool][1],
+        tool,
+    )
+
+
+def speculative_metadata(message: str) -> Optional[dict]:
+    """
+    Companies, years and quarters the tools would likely be called with for a user message, with
+    their defaults; None if the message names no company.
+    """
+    company_names = company_matcher.find_companies(message)
+    if not company_names:
+        return None
+    return {
+        "company": [company_matcher.get_canonical_name(name) for name in company_names],
+        "year": parse_years(message) or [datetime.datetime.now().year - 1],
+        "quarter": parse_quarters(message) or ["q4", "annual"],
+    }
+
+
+@contextmanager
+def speculate(message: str, enabled: bool = True):
+    """
+    Start the search of each tool from the companies, periods and search query found locally in
+    the user message, for the block and the threads started with a copy of its context, and
+    record the searches no tool claimed when it ends.
+    """
+    query_metadata = speculative_metadata(message) if enabled else None
+    if query_metadata is None:
+        yield
+        return
+
+    query = rewrite_query(message)
+    searches = {}
+    for tool, (name, _) in SPECULATIVE_SEARCHES.items():
+        search = SpeculativeSearch(tool, registry.get(name), query, query_metadata)
+        search.future = executor.submit(copy_context().run, search.run)
+        searches[tool] = search
+    logger.info(f"Speculative searches: {query} {query_metadata}")
+
+    token = _current_searches.set(searches)
+    try:
+        yield
+    finally:
+        _current_searches.reset(token)
+        for search in searches.values():
+            with search.lock:
+                if search.outcome is None:
+                    search.outcome = "unused"
+                    # free the workers for the searches of other requests
+                    search.future.cancel()
+                    SPECULATIONS.labels(search.tool, "unused").inc()
+
+
+def claim_speculation(
+    tool: str, collection: Collection, query: str, query_metadata: dict
+) -> Optional[List[Document]]:
+    """
+    Candidates of the speculative search of the tool if it matches the tool's search, waiting for
+    it to finish at most SPECULATION_MAX_WAIT_SECONDS; None to search, if there is none, it does
+    not match, has not started yet, is still running after the wait or failed.
+    """
+    searches = _current_searches.get()
+    search = searches.get(tool) if searches is not None else None
+    if search is None:
+        return None
+
+    claimed_at = time.monotonic()
+    with search.lock:
+        if search.outcome is not None:
+            return None
+        if not search.matches(collection, query, query_metadata):
+            outcome = "miss"
+        elif search.future.cancel():
+            # queued behind the searches of other requests, searching now is faster
+            outcome = "cancelled"
+        else:
+            outcome = "claimed"
+        search.outcome = outcome
+    if outcome != "claimed":
+        SPECULATIONS.labels(tool, outcome).inc()
+        tracing.set_attributes(speculation=outcome)
+        logger.info(f"Speculation {outcome} for {tool}: {search.query} {search.query_metadata}")
+        return None
+
+    try:
+        docs = search.future.result(timeout=SPECULATION_MAX_WAIT_SECONDS)
+    except TimeoutError:
+        search.outcome = "timeout"
+        SPECULATIONS.labels(tool, "timeout").inc()
+        tracing.set_attributes(speculation="timeout")
+        logger.info(f"Speculative search of {tool} still running, searching")
+        return None
+    except Exception as e:
+        logger.error(f"Error in the speculative search of {tool}: {str(e)}")
+        search.outcome = "error"
+        SPECULATIONS.labels(tool, "error").inc()
+        return None
+    # the search ran ahead of the tool until it finished or was claimed
+    saved = min(search.finished_at, claimed_at) - search.started_at
+    search.outcome = "hit"
+    SPECULATIONS.labels(tool, "hit").inc()
+    SPECULATION_SAVED.labels(tool).observe(saved)
+    tracing.set_attributes(speculation="hit", speculation_saved_seconds=saved)
+    return docs
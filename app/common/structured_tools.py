@@ -1,82 +1,67 @@
-import base64
 import datetime
-import io
 import json
+import math
 import os
 from typing import List
 from typing import Optional
 from typing import Type
 
-from langchain.retrievers import BM25Retriever
-from langchain.retrievers import EnsembleRetriever
 from langchain.tools import BaseTool
-from langchain_community.vectorstores import FAISS
-from langchain_openai import OpenAIEmbeddings
-from PIL import Image
 from pydantic import BaseModel
 from pydantic import Field
 
 from app.common import logger
 from app.common import MODEL_STRUCTURED
-from app.common import OPENAI_API_KEY
-from app.common import OPENAI_EMBEDDING_MODEL
 from app.common import TOP_K
+from app.common import tracing
+from app.common.deadline import degrade
+from app.common.deadline import NO_SYNTHESIS_RESPONSE
+from app.common.facts import Fact
+from app.common.facts import fact_store
 from app.common.knowledge_graphs import company_matcher
-from app.common.utils import get_base_64_string
-from app.common.utils import load_docs_from_jsonl
+from app.common.metrics import FACT_LOOKUPS
+from app.common.metrics import timed
+from app.common.metrics import timed_tool_run
+from app.common.retrieval import hybrid_search
+from app.common.sources import make_source_info
+from app.common.speculation import claim_speculation
+from app.common.utils import load_page_image
 from app.common.utils import metadata_filter_callable
+from app.common.utils import open_page_image
 from app.common.utils import process_chat_completion
+from app.common.vector_store import registry
+from app.common.vision import prepare_vision_image
 
 
-faiss_vdb = "faiss_structured_pydata_v0.0.1_full_size_score_above_50"
+# loaded at startup; requests get the version served at the time from the registry
+registry.get("structured")
 
 
-db = FAISS.load_local(
-    os.path.join("data", "structured_vdb", faiss_vdb),
-    OpenAIEmbeddings(model=OPENAI_EMBEDDING_MODEL, api_key=OPENAI_API_KEY),
-    allow_dangerous_deserialization=True,
-)
-
-documents = load_docs_from_jsonl(os.path.join("data", "structured_vdb", faiss_vdb, "docs.jsonl"))
-
-
-def context_from_hybrid_retriever(query, query_metadata, chunks, metadata_filter, top_k=TOP_K):
-    bm25_relevant_docs = [
-        doc
-        for doc in chunks
-        if all(doc.metadata[key] in query_metadata[key] for key in query_metadata.keys())
-    ]
-
-    faiss_similarity_retriever = db.as_retriever(
-        search_type="similarity", search_kwargs={"k": top_k, "filter": metadata_filter}
-    )
-
-    faiss_mmr_retriever = db.as_retriever(
-        search_type="mmr", search_kwargs={"k": top_k, "filter": metadata_filter}
+def context_from_hybrid_retriever(collection, query, query_metadata, metadata_filter, top_k=TOP_K):
+    docs = claim_speculation("structured_tool", collection, query, query_metadata)
+    if docs is not None:
+        return docs
+    return hybrid_search(
+        collection, query, query_metadata, metadata_filter, top_k, tool="structured_tool"
     )
 
-    retrievers = [faiss_similarity_retriever, faiss_mmr_retriever]
 
-    if len(bm25_relevant_docs) > 0:
-        bm25_retriever = BM25Retriever.from_documents(bm25_relevant_docs)
-        retrievers.append(bm25_retriever)
-
-    ensemble_relevant_docs = EnsembleRetriever(
-        retrievers=retrievers,
-        # weights=[0.3, 0.2, 0.4],
-    ).invoke(query)
-
-    # get docs with unique page numbers, company names and years
-    unique_docs = {}
-    for doc in ensemble_relevant_docs:
-        key = (doc.metadata["page_nr"], doc.metadata["company"], doc.metadata["year"])
-        if key not in unique_docs:
-            unique_docs[key] = doc
-        else:
-            continue
-
-    ensemble_relevant_docs = list(unique_docs.values())
-    return ensemble_relevant_docs
+def match_fact(user_query, companies, years, quarters) -> Optional[Fact]:
+    """Fact answering an exact lookup for a single company and year, if the fact store has one."""
+    if fact_store is None or len(companies) != 1 or len(years) != 1:
+        return None
+    with timed("fact_lookup", "structured_tool"):
+        fact = fact_store.match(
+            user_query,
+            companies[0],
+            int(years[0]),
+            quarters,
+            ignored_terms=company_matcher.find_companies(user_query),
+        )
+    FACT_LOOKUPS.labels("hit" if fact is not None else "miss").inc()
+    tracing.set_attributes(fact_match=fact is not None)
+    logger.info(f"Fact store match: {fact}")
+    return fact
 
 
 class StructuredToolInput(BaseModel):
@@ -139,6 +124,7 @@ class StructuredTool(BaseTool):
     def __init__(self, **data):
         super().__init__(**data)
 
+    @timed_tool_run
     def _run(
         self,
         user_query: str = "",
@@ -160,114 +146,156 @@ class StructuredTool(BaseTool):
         }
 
         # logger.info(f"Metadata: {user_query}")
-        canonical_company_names = [
-            company_matcher.get_canonical_name(company_name) for company_name in company_names
-        ]
+        with timed("company_resolution", self.name):
+            canonical_company_names = [
+                company_matcher.get_canonical_name(company_name) for company_name in company_names
+            ]
+        tracing.set_attributes(companies=canonical_company_names, years=years, quarters=quarters)
         logger.info(f"Metadata: {str(input_)}, ")
 
-        metadata_filter = metadata_filter_callable(canonical_company_names, years, quarters)
-        query_metadata = {
-            # "user_query": user_query,
-            "company": canonical_company_names,
-            "year": years,
-            "quarter": quarters,
-        }
-        docs = context_from_hybrid_retriever(
-            user_query, query_metadata, documents, metadata_filter, top_k=TOP_K
-        )
-
-        docs = docs[:TOP_K]
-
-        source_data = []
-        for index, doc in enumerate(docs):
-            company_name = doc.metadata["company"]
-            quarter = doc.metadata["quarter"]
-            year = doc.metadata["year"]
-            page = int(doc.metadata["page_nr"])
-            file_name = f"{company_name}_{quarter}_{year}.pdf"
-            logger.info(f"File name: {file_name}, Page: {page}")
+        fact = match_fact(user_query, canonical_company_names, years, quarters)
+        if fact is not None:
+            # exact lookup answered from the fact store, citing its page
+            source = make_source_info(
+                fact.company,
+                fact.quarter,
+                fact.year,
+                fact.page_nr,
+                report=os.path.splitext(fact.file_name)[0],
+            )
             try:
-                base64_string = get_base_64_string(
-                    os.path.join(
-                        "data",
-                        "for_pydata",
-                        "pdf_png_base64",
-                        file_name.split(".")[0],
-                        file_name.split(".")[0] + "_page_" f"{page}.txt",
-                    )
-                )
-
-                context = base64_string
-                summary = doc.page_content.split("## Summary of the table:\n")[1].strip()
+                page_image = load_page_image(source)
             except Exception as e:
                 logger.error(str(e))
-                logger.info(os.path.join("data", "pdf", file_name))
-                summary = doc.page_content.split("## Summary of the table:\n")[1].strip()
-                context = None
-
-            source_data.append(
+                page_image = None
+            source_data = [
                 {
-                    "index": index,
-                    "file_name": file_name,
-                    "summary": summary,
-                    "context": context,
-                    "page_nr": page,
+                    "index": 0,
+                    "file_name": source.file_name,
+                    "page_image": page_image,
+                    "page_nr": source.page_nr,
+                    "source": source,
                 }
+            ]
+            unit = f" {fact.unit}" if fact.unit else ""
+            result = json.dumps(
+                {
+                    "response": f"The answer is: {fact.line_item} ({fact.period}): "
+                    f"{fact.value_text}{unit}.",
+                    "context_sources_indices": [0],
+                }
+            )
+        else:
+            metadata_filter = metadata_filter_callable(
+                companies=canonical_company_names, years=years, quarters=quarters
+            )
+            query_metadata = {
+                # "user_query": user_query,
+                "company": canonical_company_names,
+                "year": years,
+                "quarter": quarters,
+            }
+            docs = context_from_hybrid_retriever(
+                registry.get("structured"),
+                user_query,
+                query_metadata,
+                metadata_filter,
+                top_k=TOP_K,
+            )
+
+            docs = docs[:TOP_K]
+            # close to the deadline, the retrieved pages are returned without the vision call
+            synthesize = not degrade("skip_synthesis", self.name)
+
+            source_data = []
+            for index, doc in enumerate(docs):
+                source = doc.metadata["source_info"]
+                logger.info(f"File name: {source.file_name}, Page: {source.page_nr}")
+                try:
+                    page_image = load_page_image(source)
+                except Exception as e:
+                    logger.error(str(e))
+                    page_image = None
+
+                # the vision model reads the table crops, the user gets the full page
+                vision_context, detail, image_tokens = None, None, 0
+                if page_image is not None and synthesize:
+                    with timed("image_crop", self.name):
+                        vision_context, detail, image_tokens = prepare_vision_image(
+                            page_image, source.image_key
+                        )
+
+                source_data.append(
+                    {
+                        "index": index,
+                        "file_name": source.file_name,
+                        "summary": source.summary,
+                        "page_image": page_image,
+                        "vision_context": vision_context,
+                        "detail": detail,
+                        "image_tokens": image_tokens,
+                        "page_nr": source.page_nr,
+                        "source": source,
+                    }
+                )
+
+            # base64 size of the full pages, as sent before the crops
+            page_bytes = sum(
+                4 * math.ceil(len(item["page_image"] or b"") / 3) for item in source_data
+            )
+            vision_bytes = sum(len(item["vision_context"] or "") for item in source_data)
+            image_tokens = sum(item["image_tokens"] for item in source_data)
+            tracing.set_attributes(
+                page_bytes=page_bytes, vision_bytes=vision_bytes, image_tokens=image_tokens
+            )
+            logger.info(
+                f"Vision payload: {vision_bytes} bytes instead of {page_bytes} for the full pages, "
+                f"~{image_tokens} image tokens"
             )
 
-        result = process_chat_completion(source_data, user_query, model=MODEL_STRUCTURED)
+            if synthesize:
+                with timed("synthesis_llm", self.name):
+                    result = process_chat_completion(
+                        source_data, user_query, model=MODEL_STRUCTURED
+                    )
+            else:
+                result = json.dumps(
+                    {
+                        "response": NO_SYNTHESIS_RESPONSE,
+                        "context_sources_indices": list(range(len(source_data))),
+                    }
+                )
 
         # try to convert into dict
         try:
             result = json.loads(result)
             context_sources_indices = result.get("context_sources_indices", [])
             logger.info(f"Context sources indices: {len(context_sources_indices)}")
-            file_names = [source_data[index]["file_name"] for index in context_sources_indices]
-            pages = [source_data[index]["page_nr"] for index in context_sources_indices]
-            images = [
-                source_data[index]["context"] for index in context_sources_indices
-            ]  # this is a list of base64 strings
-            # convert to png with pillow without saving to disk
-            images = [Image.open(io.BytesIO(base64.b64decode(image))) for image in images]
+            sources = [source_data[index] for index in context_sources_indices]
         # list index out of range error
         except IndexError as e:
             logger.error(f"Index error: {e}")
             context_sources_indices = [index - 1 for index in context_sources_indices]
-            file_names = [source_data[index]["file_name"] for index in context_sources_indices]
-            pages = [source_data[index]["page_nr"] for index in context_sources_indices]
-            images = [
-                source_data[index]["context"] for index in context_sources_indices
-            ]  # this is a list of base64 strings
-            images = [Image.open(io.BytesIO(base64.b64decode(image))) for image in images]
+            sources = [source_data[index] for index in context_sources_indices]
         except Exception as e:
             logger.error(f"Error converting result to dict: {e}")
-            file_names = []
-            pages = []
-            images = []
-
-        company_dict = {
-            "hm": "H&M",
-            "volvo": "Volvo",
-            "ikea": "IKEA",
-        }
-        quarter_dict = {"q1": "Q1", "q2": "Q2", "q3": "Q3", "q4": "Q4", "annual": "FY"}
-        for image, file_name, page in zip(images, file_names, pages):
-            company = company_dict[file_name.split("_")[0]]
-            quarter = quarter_dict[file_name.split("_")[1]]
-            year = file_name.split("_")[2].split(".")[0]
-
-            image.info["file_name"] = f"{company} {quarter} {year}"
-            image.info["page"] = page
-
+            sources = []
+
+        file_names = [item["source"].file_name for item in sources]
+        pages = [item["source"].page_nr for item in sources]
+        images = []
+        # close to the deadline, the pages are cited without their images
+        pages_shown = [] if degrade("drop_images", self.name) else sources
+        for item in pages_shown:
+            if item["page_image"] is None:
+                # the page image is missing, the page is still cited
+                continue
+            images.append(open_page_image(item["page_image"], item["source"]))
+
+        # pages cited per report, listed under its display name
         used_sources = {}
-        for file, page_nr in zip(file_names, pages):
-            if file in used_sources:
-                # used_sources[file].append(str(page_nr))
-                used_sources[file].append(page_nr)
-            else:
-                # used_sources[file] = [str(page_nr)]
-                used_sources[file] = [page_nr]
-
+        for item in sources:
+            used_sources.setdefault(item["source"].display_name, []).append(item["source"].page_nr)
         for source in used_sources:
             used_sources[source] = [str(page_nr) for page_nr in sorted(used_sources[source])]
 
@@ -275,19 +303,12 @@ class StructuredTool(BaseTool):
         logger.info(f"Used sources: {str(used_sources)}")
         result_markdown = f"{result['response']}"
 
-        def format_file_name(file_name: str) -> str:
-            company, report_type, year = file_name.replace(".pdf", "").split("_")
-            company_mapping = {"ikea": "IKEA", "volvo": "Volvo", "hm": "H&M"}
-            report_mapping = {"q1": "Q1", "q2": "Q2", "q3": "Q3", "q4": "Q4", "annual": "annual"}
-            report_type = report_mapping[report_type]
-            return f"{company_mapping[company]} {report_type} report, year {year}"
-
         if len(used_sources) > 0:
             result_markdown += "\n\n**Sources:**\n\n"
             result_markdown += "\n".join(
                 [
-                    f"- {format_file_name(file_name)}\n  - Pages: {', '.join(used_sources[file_name])}"
-                    for file_name in used_sources
+                    f"- {display_name}\n  - Pages: {', '.join(pages_nr)}"
+                    for display_name, pages_nr in used_sources.items()
                 ]
             )
 
@@ -0,0 +1,245 @@
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from app.common import logger
+from app.common import OTLP_ENDPOINT
+from app.common import TRACE_EXPORTER
+from app.common import TRACE_FILE
+from app.common import TRACE_SAMPLE_RATE
+
+
+class Span:
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], attributes: dict):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.status = "ok"
+        self.start_time_ns = time.time_ns()
+        self.end_time_ns: Optional[int] = None
+
+    def set_attributes(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        if error is not None:
+            self.status = "error"
+            self.attributes["error"] = str(error)
+        self.end_time_ns = time.time_ns()
+        self.trace.add(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time_ns": self.start_time_ns,
+            "end_time_ns": self.end_time_ns,
+            "duration_ms": (self.end_time_ns - self.start_time_ns) / 1e6,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class NoopSpan:
+    """Stands in for a span when the request is not sampled."""
+
+    span_id = None
+
+    def set_attributes(self, **attributes: Any) -> None:
+        pass
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Trace:
+    def __init__(self, sampled: bool):
+        self.trace_id = os.urandom(16).hex()
+        self.sampled = sampled
+        self.spans: List[Span] = []
+        # spans of the tools can finish in several threads at once
+        self.lock = threading.Lock()
+
+    def add(self, span: Span) -> None:
+        with self.lock:
+            self.spans.append(span)
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[Any] = ContextVar("current_span", default=NOOP_SPAN)
+
+
+def should_sample(sample_header: Optional[str]) -> bool:
+    """
+    Decide whether to record the trace of a request.
+
+    Args:
+        sample_header (Optional[str]): Value of the X-Trace-Sample header, "1" or "0" forces the decision
+
+    Returns:
+        bool: True if the request should be traced
+    """
+    if sample_header is not None and sample_header.lower() in ("1", "true"):
+        return True
+    if sample_header is not None and sample_header.lower() in ("0", "false"):
+        return False
+    return random.random() < TRACE_SAMPLE_RATE
+
+
+@contextmanager
+def start_trace(name: str, sampled: bool, **attributes: Any):
+    """Open the trace of a request with its root span, and export it when the request is done."""
+    trace = Trace(sampled)
+    trace_token = _current_trace.set(trace)
+    try:
+        with span(name, **attributes):
+            yield trace
+    finally:
+        _current_trace.reset(trace_token)
+        if trace.sampled:
+            exporter.export(trace)
+
+
+def start_span(name: str, **attributes: Any):
+    """
+    Start a span under the current one without making it current, for callbacks with separate
+    start and end hooks. The caller must call `end()` on it.
+    """
+    trace = _current_trace.get()
+    if trace is None or not trace.sampled:
+        return NOOP_SPAN
+    return Span(trace, name, _current_span.get().span_id, attributes)
+
+
+@contextmanager
+def span(name: str, **attributes: Any):
+    """Record a span around a block, as a child of the current span."""
+    new_span = start_span(name, **attributes)
+    if new_span is NOOP_SPAN:
+        yield new_span
+        return
+
+    span_token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.end(error=e)
+        raise
+    else:
+        new_span.end()
+    finally:
+        _current_span.reset(span_token)
+
+
+def set_attributes(**attributes: Any) -> None:
+    """Add attributes to the current span."""
+    _current_span.get().set_attributes(**attributes)
+
+
+class JsonlExporter:
+    """Appends each trace as one JSON line to a local file."""
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+
+    def export(self, trace: Trace) -> None:
+        line = json.dumps(
+            {"trace_id": trace.trace_id, "spans": [span.to_dict() for span in trace.spans]},
+            default=str,
+        )
+        with open(self.file_path, "a") as f:
+            f.write(line + "\n")
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class OtlpExporter:
+    """Posts traces in the OTLP/HTTP JSON format to a collector."""
+
+    def __init__(self, endpoint: str, service_name: str = "kapital-api"):
+        self.endpoint = endpoint
+        self.service_name = service_name
+
+    def export(self, trace: Trace) -> None:
+        spans = [
+            {
+                "traceId": trace.trace_id,
+                "spanId": span.span_id,
+                "parentSpanId": span.parent_id or "",
+                "name": span.name,
+                "kind": 1,
+                "startTimeUnixNano": str(span.start_time_ns),
+                "endTimeUnixNano": str(span.end_time_ns),
+                "attributes": [
+                    {"key": key, "value": _otlp_value(value)}
+                    for key, value in span.attributes.items()
+                ],
+                "status": {"code": 2 if span.status == "error" else 1},
+            }
+            for span in trace.spans
+        ]
+        payload = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {"key": "service.name", "value": {"stringValue": self.service_name}}
+                        ]
+                    },
+                    "scopeSpans": [{"scope": {"name": "app.common.tracing"}, "spans": spans}],
+                }
+            ]
+        }
+        # imported here, only the OTLP exporter needs it
+        import requests
+
+        requests.post(self.endpoint, json=payload, timeout=5).raise_for_status()
+
+
+class BackgroundExporter:
+    """Exports traces off the request path, logging failures instead of raising them."""
+
+    def __init__(self, exporter):
+        self.exporter = exporter
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trace-export")
+
+    def export(self, trace: Trace) -> None:
+        if self.exporter is not None:
+            self.executor.submit(self._export, trace)
+
+    def _export(self, trace: Trace) -> None:
+        try:
+            self.exporter.export(trace)
+        except Exception as e:
+            logger.error(f"Error exporting trace {trace.trace_id}: {str(e)}")
+
+
+if TRACE_EXPORTER == "jsonl":
+    exporter = BackgroundExporter(JsonlExporter(TRACE_FILE))
+elif TRACE_EXPORTER == "otlp":
+    exporter = BackgroundExporter(OtlpExporter(OTLP_ENDPOINT))
+else:
+    exporter = BackgroundExporter(None)
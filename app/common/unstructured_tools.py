@@ -1,6 +1,4 @@
-import base64
 import datetime
-import io
 import json
 import os
 from typing import List
@@ -10,88 +8,72 @@ from typing import Type
 from langchain.prompts import load_prompt
 from langchain.pydantic_v1 import BaseModel
 from langchain.pydantic_v1 import Field
-from langchain.retrievers import BM25Retriever
-from langchain.retrievers import EnsembleRetriever
 from langchain.tools import BaseTool
-from langchain_community.vectorstores import FAISS
 from langchain_openai import ChatOpenAI
-from langchain_openai import OpenAIEmbeddings
-from PIL import Image
 
+from app.common import CONTEXT_DEDUP_THRESHOLD
+from app.common import HEDGED_LLM_CALLS
 from app.common import logger
 from app.common import MODEL_UNSTRUCTURED
 from app.common import OPENAI_API_KEY
-from app.common import OPENAI_EMBEDDING_MODEL
 from app.common import PROMPT_PATH
+from app.common import TOP_K_UNSTRUCTURED
+from app.common import tracing
+from app.common import UNSTRUCTURED_CONTEXT_TOKEN_BUDGET
+from app.common.callbacks import LLMMetricsCallback
+from app.common.context_packing import pack_sources
+from app.common.deadline import degrade
+from app.common.deadline import llm_timeout
+from app.common.deadline import NO_SYNTHESIS_RESPONSE
+from app.common.deadline import remaining
+from app.common.hedging import hedged
 from app.common.knowledge_graphs import company_matcher
-from app.common.utils import get_base_64_string
-from app.common.utils import load_docs_from_jsonl
+from app.common.metrics import timed
+from app.common.metrics import timed_tool_run
+from app.common.openai_clients import http_async_client
+from app.common.openai_clients import http_client
+from app.common.retrieval import hybrid_search
+from app.common.speculation import claim_speculation
+from app.common.utils import load_page_image
 from app.common.utils import metadata_filter_callable
+from app.common.utils import open_page_image
+from app.common.vector_store import registry
 
 
-faiss_vdb = "faiss_unstructured_pydata_v0.0.2"
+# loaded at startup; requests get the version served at the time from the registry
+registry.get("unstructured")
 
-emebeddings = OpenAIEmbeddings(model=OPENAI_EMBEDDING_MODEL, api_key=OPENAI_API_KEY)
 
-db = FAISS.load_local(
-    os.path.join("data", "unstructured_vdb", faiss_vdb),
-    emebeddings,
-    allow_dangerous_deserialization=True,
-)
-
-documents = load_docs_from_jsonl(os.path.join("data", "unstructured_vdb", faiss_vdb, "docs.jsonl"))
+def synthesis_llm(**kwargs) -> ChatOpenAI:
+    return ChatOpenAI(
+        model=MODEL_UNSTRUCTURED,
+        api_key=OPENAI_API_KEY,
+        model_kwargs={"response_format": {"type": "json_object"}},
+        callbacks=[LLMMetricsCallback("synthesis_llm", "unstructured_tool")],
+        http_client=http_client,
+        http_async_client=http_async_client,
+        **kwargs,
+    )
 
 
-llm = ChatOpenAI(
-    model=MODEL_UNSTRUCTURED,
-    api_key=OPENAI_API_KEY,
-    model_kwargs={"response_format": {"type": "json_object"}},
-)
+llm = synthesis_llm()
+# under a request deadline, whose time left is the timeout that a retry would outlive
+llm_without_retries = synthesis_llm(max_retries=0)
 prompt = load_prompt(os.path.join(PROMPT_PATH, "rephrase.yaml"))
-chain = prompt | llm
 
 
-def context_from_hybrid_retriever(query, query_metadata, chunks, metadata_filter, top_k=20):
+def context_from_hybrid_retriever(
+    collection, query, query_metadata, metadata_filter, top_k=TOP_K_UNSTRUCTURED
+):
     logger.info(f"query metadata: {query_metadata}")
-    logger.info(f"doc metadata: {chunks[0].metadata}")
-    bm25_relevant_docs = [
-        doc
-        for doc in chunks
-        if all(doc.metadata[key] in query_metadata[key] for key in query_metadata.keys())
-    ]
-    logger.info(f"len bm25: {len(bm25_relevant_docs)}")
-
-    faiss_similarity_retriever = db.as_retriever(
-        search_type="similarity", search_kwargs={"k": top_k, "filter": metadata_filter}
-    )
-
-    faiss_mmr_retriever = db.as_retriever(
-        search_type="mmr", search_kwargs={"k": top_k, "filter": metadata_filter}
+    logger.info(f"collection version: {collection.version}")
+    docs = claim_speculation("unstructured_tool", collection, query, query_metadata)
+    if docs is not None:
+        return docs
+    return hybrid_search(
+        collection, query, query_metadata, metadata_filter, top_k, tool="unstructured_tool"
     )
 
-    retrievers = [faiss_similarity_retriever, faiss_mmr_retriever]
-
-    if len(bm25_relevant_docs) > 0:
-        bm25_retriever = BM25Retriever.from_documents(bm25_relevant_docs)
-        retrievers.append(bm25_retriever)
-
-    ensemble_relevant_docs = EnsembleRetriever(
-        retrievers=retrievers,
-        # weights=[0.3, 0.2, 0.4],
-    ).invoke(query)
-
-    # get docs with unique page numbers, company names and years
-    unique_docs = {}
-    for doc in ensemble_relevant_docs:
-        key = (doc.metadata["page_nr"], doc.metadata["company"], doc.metadata["year"])
-        if key not in unique_docs:
-            unique_docs[key] = doc
-        else:
-            continue
-
-    ensemble_relevant_docs = list(unique_docs.values())
-    return ensemble_relevant_docs
-
 
 class UnstructuredToolInput(BaseModel):
     user_query: str = Field(query="User search query directed at structured data")
@@ -151,6 +133,7 @@ opportunities, trends, and other qualitative aspects of the financial data.
     def __init__(self, **data):
         super().__init__(**data)
 
+    @timed_tool_run
     def _run(
         self,
         user_query: str = "",
@@ -169,9 +152,11 @@ opportunities, trends, and other qualitative aspects of the financial data.
             "quarters": quarters,
         }
         logger.info(f"Metadata: {user_query} {input_}")
-        canonical_company_names = [
-            company_matcher.get_canonical_name(company_name) for company_name in company_names
-        ]
+        with timed("company_resolution", self.name):
+            canonical_company_names = [
+                company_matcher.get_canonical_name(company_name) for company_name in company_names
+            ]
+        tracing.set_attributes(companies=canonical_company_names, years=years, quarters=quarters)
         logger.info(f"Canonical company names: {canonical_company_names}")
         query_metadata = {
             "company": canonical_company_names,
@@ -183,117 +168,80 @@ opportunities, trends, and other qualitative aspects of the financial data.
             companies=canonical_company_names, years=years, quarters=quarters
         )
         docs = context_from_hybrid_retriever(
-            user_query, query_metadata, documents, metadata_filter, top_k=20
+            registry.get("unstructured"),
+            user_query,
+            query_metadata,
+            metadata_filter,
+            top_k=TOP_K_UNSTRUCTURED,
         )
         logger.info(f"Found {len(docs)} documents")
         # page_func = lambda x: docs[x].metadata["source"].split("/")[-1].split("_")[-1].split(".")[0]
 
-        file_name_func = lambda x: docs[x].metadata["source"].split("/")[-2] + ".pdf"
-        source_data = [
-            {"index": index, "file_name": file_name_func(index), "context": doc.page_content}
-            for index, doc in enumerate(docs)
-        ]
-        output = chain.invoke({"user_query": user_query, "source_data": str(source_data)})
-        result = output.content
-        try:
-            logger.info(f"tokens sent: {output.response_metadata['token_usage']['prompt_tokens']}")
-        except Exception as e:
-            print(str(e))
+        # the cited indices refer to the packed docs
+        docs, source_data = pack_sources(
+            docs,
+            lambda doc: doc.metadata["source_info"].file_name,
+            token_budget=UNSTRUCTURED_CONTEXT_TOKEN_BUDGET,
+            dedup_threshold=CONTEXT_DEDUP_THRESHOLD,
+            model=MODEL_UNSTRUCTURED,
+        )
+        # close to the deadline, the retrieved sources are returned without the synthesis call
+        if degrade("skip_synthesis", self.name):
+            result = json.dumps(
+                {
+                    "response": NO_SYNTHESIS_RESPONSE,
+                    "context_sources_indices": list(range(len(docs))),
+                }
+            )
+        else:
+            synthesis = llm if remaining() is None else llm_without_retries
+            chain = prompt | synthesis.bind(timeout=llm_timeout())
+            inputs = {"user_query": user_query, "source_data": source_data}
+            if HEDGED_LLM_CALLS:
+                output = hedged("unstructured_synthesis", lambda: chain.ainvoke(inputs))
+            else:
+                output = chain.invoke(inputs)
+            result = output.content
+            try:
+                logger.info(
+                    f"tokens sent: {output.response_metadata['token_usage']['prompt_tokens']}"
+                )
+            except Exception as e:
+                print(str(e))
 
         # try to convert into dict
-        company_dict = {
-            "hm": "H&M",
-            "volvo": "Volvo",
-            "ikea": "IKEA",
-        }
-        quarter_dict = {"q1": "Q1", "q2": "Q2", "q3": "Q3", "q4": "Q4", "annual": "FY"}
         try:
             result = json.loads(result)
             context_sources_indices = result.get("context_sources_indices", [])
-            selected_docs = [docs[index] for index in context_sources_indices]
-            companies = [
-                company_dict.get(doc.metadata["company"], doc.metadata["company"])
-                for doc in selected_docs
-            ]
-            quarters = [
-                quarter_dict.get(doc.metadata["quarter"], doc.metadata["quarter"])
-                for doc in selected_docs
-            ]
-            years = [doc.metadata["year"] for doc in selected_docs]
-            pages = [doc.metadata["page_nr"] for doc in selected_docs]
-            file_names = [
-                company + "_" + str(year) + "_" + quarter
-                for company, year, quarter in zip(companies, years, quarters)
-            ]
-            file_names_metadata = [file_name_func(index) for index in context_sources_indices]
-            images = []
-            for page, file_name in zip(pages, file_names_metadata):
-                base64_string = get_base_64_string(
-                    os.path.join(
-                        "data",
-                        "for_pydata",
-                        "pdf_png_base64",
-                        file_name.split(".")[0],
-                        file_name.split(".")[0] + "_page_" f"{page}.txt",
-                    )
-                )
-                images.append(base64_string)
-
+            sources = [docs[index].metadata["source_info"] for index in context_sources_indices]
         except IndexError as e:  # in case index starts from 1
             logger.error(f"Index error: {e}")
             context_sources_indices = [index - 1 for index in context_sources_indices]
-            selected_docs = [docs[index] for index in context_sources_indices]
-            companies = [
-                company_dict.get(doc.metadata["company"], doc.metadata["company"])
-                for doc in selected_docs
-            ]
-            quarters = [
-                quarter_dict.get(doc.metadata["quarter"], doc.metadata["quarter"])
-                for doc in selected_docs
-            ]
-            years = [doc.metadata["year"] for doc in selected_docs]
-            pages = [doc.metadata["page_nr"] for doc in selected_docs]
-            file_names = [
-                company + "_" + str(year) + "_" + quarter
-                for company, year, quarter in zip(companies, years, quarters)
-            ]
-            file_names_metadata = [file_name_func(index) for index in context_sources_indices]
-            images = []
-            for page, file_name in zip(pages, file_names_metadata):
-                base64_string = get_base_64_string(
-                    os.path.join(
-                        "data",
-                        "for_pydata",
-                        "pdf_png_base64",
-                        file_name.split(".")[0],
-                        file_name.split(".")[0] + "_page_" f"{page}.txt",
-                    )
-                )
-                images.append(base64_string)
-
+            sources = [docs[index].metadata["source_info"] for index in context_sources_indices]
         except Exception as e:
             logger.error(f"Error converting result to dict: {e}")
-            file_names = []
-            pages = []
-            images = []
-        logger.info(f"File names retrieved: {file_names}")
-        images = [Image.open(io.BytesIO(base64.b64decode(image))) for image in images]
-
-        for image, file_name, page in zip(images, file_names_metadata, pages):
-            company = company_dict[file_name.split("_")[0]]
-            quarter = quarter_dict[file_name.split("_")[1]]
-            year = file_name.split("_")[2].split(".")[0]
-
-            # image.info['file_name'] = file_name
-            image.info["file_name"] = f"{company} {quarter} {year}"
-            image.info["page"] = page
+            sources = []
 
+        file_names = [
+            f"{source.company_display}_{source.year}_{source.quarter_display}" for source in sources
+        ]
+        pages = [source.page_nr for source in sources]
+        logger.info(f"File names retrieved: {file_names}")
+        images = []
+        # close to the deadline, the pages are cited without their images
+        pages_shown = [] if degrade("drop_images", self.name) else sources
+        for source in pages_shown:
+            try:
+                page_image = load_page_image(source)
+            except Exception as e:
+                logger.error(str(e))
+                continue
+            images.append(open_page_image(page_image, source))
+
+        # pages cited per report, listed under its display name
         used_sources = {}
-        for file, page_nr in zip(file_names, pages):
-            if file in used_sources:
-                used_sources[file].append(page_nr)
-            else:
-                used_sources[file] = [page_nr]
+        for source in sources:
+            used_sources.setdefault(source.display_name, []).append(source.page_nr)
         for source in used_sources:
             used_sources[source] = [str(page_nr) for page_nr in sorted(used_sources[source])]
 
@@ -301,27 +249,12 @@ opportunities, trends, and other qualitative aspects of the financial data.
 
         result_markdown = f"{result['response']}"
 
-        def format_file_name(file_name: str) -> str:
-            company, year, report_type = file_name.replace(".pdf", "").split("_")
-            company_mapping = {"ikea": "IKEA", "volvo": "Volvo", "hm": "H&M", "h&m": "H&M"}
-            report_mapping = {
-                "q1": "Q1",
-                "q2": "Q2",
-                "q3": "Q3",
-                "q4": "Q4",
-                "annual": "annual",
-                "fy": "annual",
-            }
-            report_type = report_mapping[report_type.lower()]
-            company = company_mapping[company.lower()]
-            return f"{company} {report_type} report, year {year}"
-
         if len(used_sources) > 0:
             result_markdown += "\n\n**Sources:**\n\n"
             result_markdown += "\n".join(
                 [
-                    f"- {format_file_name(file_name)}\n  - Pages: {', '.join(used_sources[file_name])}"
-                    for file_name in used_sources
+                    f"- {display_name}\n  - Pages: {', '.join(pages_nr)}"
+                    for display_name, pages_nr in used_sources.items()
                 ]
             )
 
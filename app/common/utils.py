@@ -1,7 +1,7 @@
 import base64
 import datetime
+import io
 import json
-import os
 import re
 from typing import Dict
 from typing import Iterable
@@ -9,16 +9,29 @@ from typing import List
 from typing import Optional
 from typing import Union
 
-from dotenv import load_dotenv
 from langchain.schema import Document
-from openai import OpenAI
+from PIL import Image
 
+from app.common import HEDGED_LLM_CALLS
 from app.common import logger
+from app.common import PAGE_IMAGE_CACHE_MB
 from app.common import system_prompt_structured_tool
-
-load_dotenv()
-
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+from app.common import tracing
+from app.common.cache import SizedLRUCache
+from app.common.deadline import llm_timeout
+from app.common.deadline import remaining
+from app.common.hedging import hedged
+from app.common.metrics import record_token_usage
+from app.common.metrics import timed
+from app.common.openai_clients import get_async_client
+from app.common.openai_clients import get_client
+from app.common.sources import SourceInfo
+
+# decoded PNG of the pages, shared by the tools; a few pages (the latest statements) are cited
+# over and over
+page_image_cache: SizedLRUCache[bytes] = SizedLRUCache(
+    "page_image", PAGE_IMAGE_CACHE_MB * 2**20, len
+)
 
 
 def save_docs_to_jsonl(array: Iterable[Document], file_path: str) -> None:
@@ -99,7 +112,8 @@ def process_chat_completion(
     Process chat completion with image data and return model response.
 
     Args:
-        source_data (List[Dict]): List of dictionaries containing source data with image URLs
+        source_data (List[Dict]): List of dictionaries containing source data with base64 images,
+            sent from "vision_context" (else "context") with an optional "detail" level
         user_query (str): User query to process
         model (str): Model name to use for completion
 
@@ -127,25 +141,76 @@ def process_chat_completion(
     # Add image content to the user message
     for item in source_data:
         messages[1]["content"].append({"type": "text", "text": f"Image {item['index']}:"})
-        messages[1]["content"].append(
-            {
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:image/png;base64,{item['context']}",
-                    # "detail": "high"  # Using high detail for financial documents
-                },
-            }
+        image_url = {
+            "url": f"data:image/png;base64,{item.get('vision_context', item.get('context'))}"
+        }
+        if item.get("detail"):
+            image_url["detail"] = item["detail"]
+        messages[1]["content"].append({"type": "image_url", "image_url": image_url})
+
+    request = {
+        "model": model,
+        "messages": messages,
+        "temperature": 0.0,
+        "response_format": {"type": "json_object"},
+        "timeout": llm_timeout(),
+    }
+    openai_client = get_async_client() if HEDGED_LLM_CALLS else get_client()
+    if remaining() is not None:
+        # the timeout is the time left of the request, which a retry would outlive
+        openai_client = openai_client.with_options(max_retries=0)
+    if HEDGED_LLM_CALLS:
+        response = hedged(
+            "structured_synthesis", lambda: openai_client.chat.completions.create(**request)
         )
-
-    response = client.chat.completions.create(
-        model=model, messages=messages, temperature=0.0, response_format={"type": "json_object"}
-    )
+    else:
+        response = openai_client.chat.completions.create(**request)
 
     logger.info(f"structured, tokens sent: {response.usage.prompt_tokens}")
+    record_token_usage(model, response.usage.prompt_tokens, response.usage.completion_tokens)
+    tracing.set_attributes(
+        prompt_tokens=response.usage.prompt_tokens,
+        completion_tokens=response.usage.completion_tokens,
+        images=len(source_data),
+        image_bytes=sum(
+            len(item.get("vision_context", item.get("context")) or "") for item in source_data
+        ),
+    )
 
     return response.choices[0].message.content
 
 
 def get_base_64_string(string_path: str) -> str:
-    with open(string_path) as f:
-        return f.read()
+    with timed("page_image_io"):
+        with open(string_path) as f:
+            return f.read()
+
+
+def load_page_image(source: SourceInfo) -> bytes:
+    """Decoded PNG of a page, read from its base64 file on the first use and then cached."""
+    return page_image_cache.get_or_load(
+        (source.report, source.page_nr),
+        lambda: base64.b64decode(get_base_64_string(source.image_key)),
+    )
+
+
+def open_page_image(png: bytes, source: SourceInfo) -> Image.Image:
+    """Page image returned to the user, captioned with its report and page."""
+    image = Image.open(io.BytesIO(png))
+    image.info["file_name"] = source.caption
+    image.info["page"] = source.page_nr
+    image.info["png"] = png
+    return image
+
+
+def image_png(image: Image.Image) -> bytes:
+    """
+    PNG of an image: the bytes it was opened from if it is an unmodified page image, which spares
+    encoding the page again, else the image encoded.
+    """
+    # images derived from a page (crop, convert, ...) have no format but may have copied its info
+    if image.format == "PNG" and "png" in image.info:
+        return image.info["png"]
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG")
+    return buffered.getvalue()
@@ -0,0 +1,150 @@
+import math
+from typing import List
+from typing import Optional
+
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import Embeddings
+
+from app.common import logger
+
+# faiss.index_factory descriptions; SQ stores the vectors as float16 or int8 instead of float32,
+# PQ as one byte per sub-vector of 16 dimensions
+INDEX_TYPES = {
+    "flat": "Flat",
+    "flat-fp16": "SQfp16",
+    "flat-int8": "SQ8",
+    "hnsw": "HNSW32,Flat",
+    "hnsw-fp16": "HNSW32,SQfp16",
+    "hnsw-int8": "HNSW32,SQ8",
+    "ivfpq": "IVF{nlist},PQ{m}",
+}
+# k-means of the IVF lists and of the PQ codebooks wants this many training vectors per centroid
+TRAINING_POINTS_PER_CENTROID = 39
+PQ_CENTROIDS = 256
+
+
+def factory_string(index_type: str, n_vectors: int, dimensions: int) -> Optional[str]:
+    """
+    faiss.index_factory description of an index type for a number of vectors, None if there are too
+    few vectors to train it.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_type}, expected one of {list(INDEX_TYPES)}")
+    if index_type != "ivfpq":
+        return INDEX_TYPES[index_type]
+
+    nlist = min(int(4 * math.sqrt(n_vectors)), n_vectors // TRAINING_POINTS_PER_CENTROID)
+    m = next(
+        m for m in (dimensions // 16, dimensions // 8, dimensions) if m and dimensions % m == 0
+    )
+    if nlist < 1 or n_vectors < PQ_CENTROIDS:
+        return None
+    return INDEX_TYPES[index_type].format(nlist=nlist, m=m)
+
+
+def build_index(
+    index_type: str,
+    texts: List[str],
+    vectors: List[List[float]],
+    metadatas: List[dict],
+    embeddings: Embeddings,
+) -> FAISS:
+    """
+    Build a FAISS vector store with an index of the given type, trained on the vectors if needed.
+
+    An index type that needs more training vectors than given falls back to the exact flat index.
+
+    Args:
+        index_type (str): One of INDEX_TYPES
+        texts (List[str]): Texts of the documents
+        vectors (List[List[float]]): Embeddings of the texts
+        metadatas (List[dict]): Metadata of the documents
+        embeddings (Embeddings): Embedding model of the queries
+
+    Returns:
+        FAISS: Vector store with the documents
+    """
+    matrix = np.asarray(vectors, dtype=np.float32)
+    description = factory_string(index_type, len(matrix), matrix.shape[1])
+    if description is None:
+        logger.warning(f"{len(matrix)} vectors are too few to train {index_type}, using flat")
+        description = INDEX_TYPES["flat"]
+
+    index = faiss.index_factory(matrix.shape[1], description)
+    if not index.is_trained:
+        index.train(matrix)
+    db = FAISS(embeddings, index, InMemoryDocstore(), {})
+    db.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas)
+    prepare_index(db.index)
+    logger.info(f"Built {description} index of {len(matrix)} vectors, {index_bytes(index)} bytes")
+    return db
+
+
+def prepare_index(index: faiss.Index, params: Optional[dict] = None) -> None:
+    """
+    Set the search parameters (efSearch, nprobe) that apply to the index, and let IVF indexes
+    reconstruct their vectors, which the MMR search needs.
+    """
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        ivf = None
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        ivf.make_direct_map()
+
+    space = faiss.ParameterSpace()
+    for name, value in (params or {}).items():
+        try:
+            space.set_index_parameter(index, name, value)
+        except RuntimeError:
+            # the parameter belongs to another index type
+            continue
+
+
+def index_bytes(index: faiss.Index) -> int:
+    return faiss.serialize_index(index).nbytes
+
+
+def faiss_description(index: faiss.Index) -> str:
+    """Class of the index, with that of the vectors storage of an HNSW graph."""
+    index = faiss.downcast_index(index)
+    storage = getattr(index, "storage", None)
+    if storage is None:
+        return type(index).__name__
+    return f"{type(index).__name__}({type(faiss.downcast_index(storage)).__name__})"
+
+
+def recall_vs_flat(
+    index: faiss.Index, vectors: List[List[float]], k: int = 10, n_queries: int = 200, seed: int = 0
+) -> float:
+    """
+    Share of the exact k nearest neighbours that the index finds, for a sample of the indexed
+    vectors, slightly perturbed, as queries.
+
+    Args:
+        index (faiss.Index): Index to measure, holding the vectors in their order
+        vectors (List[List[float]]): The indexed vectors
+        k (int): Neighbours per query
+        n_queries (int): Queries sampled from the vectors
+        seed (int): Seed of the sampling
+
+    Returns:
+        float: Recall at k of the index against exact search
+    """
+    matrix = np.asarray(vectors, dtype=np.float32)
+    if len(matrix) == 0:
+        return 1.0
+    rng = np.random.default_rng(seed)
+    queries = matrix[rng.choice(len(matrix), min(n_queries, len(matrix)), replace=False)]
+    queries = queries + rng.normal(0, 0.01, queries.shape).astype(np.float32)
+    k = min(k, len(matrix))
+
+    flat = faiss.IndexFlatL2(matrix.shape[1])
+    flat.add(matrix)
+    _, exact = flat.search(queries, k)
+    _, approximate = index.search(queries, k)
+    found = sum(len(set(row) & set(other)) for row, other in zip(exact, approximate))
+    return found / exact.size
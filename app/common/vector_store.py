@@ -0,0 +1,476 @@
+import datetime
+import itertools
+import json
+import os
+import shutil
+import threading
+import uuid
+from collections import defaultdict
+from collections import OrderedDict
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from langchain.schema import Document
+from langchain_community.retrievers import BM25Retriever
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import Embeddings
+
+from app.common import BM25_CACHE_SIZE
+from app.common import COLLECTIONS_PATH
+from app.common import INDEX_SEARCH_PARAMS
+from app.common import logger
+from app.common import SHARD_MEMORY_BUDGET_MB
+from app.common import STRUCTURED_VDB_PATH
+from app.common import UNSTRUCTURED_VDB_PATH
+from app.common.cache import SizedLRUCache
+from app.common.embeddings import get_embeddings
+from app.common.metrics import record_cache_lookup
+from app.common.metrics import timed
+from app.common.sources import attach_source_info
+from app.common.sources import document_key
+from app.common.utils import load_docs_from_jsonl
+from app.common.utils import save_docs_to_jsonl
+from app.common.vector_index import build_index
+from app.common.vector_index import faiss_description
+from app.common.vector_index import index_bytes
+from app.common.vector_index import prepare_index
+from app.common.vector_index import recall_vs_flat
+
+# folders of the indexes built before collections were versioned, served without a manifest
+LEGACY_PATHS = {"structured": STRUCTURED_VDB_PATH, "unstructured": UNSTRUCTURED_VDB_PATH}
+LEGACY_VERSION = "legacy"
+
+# metadata the BM25 documents of a shard are partitioned by
+PARTITION_KEYS = ("company", "year", "quarter")
+# key of the single shard of an unsharded version
+ALL_SHARDS = "*"
+
+
+def manifest_path(name: str) -> str:
+    return os.path.join(COLLECTIONS_PATH, name, "manifest.json")
+
+
+def read_manifest(name: str) -> Optional[dict]:
+    """
+    Manifest of a collection: its current version and the list of its versions, each with its id,
+    parent version, creation time, number of documents and reports.
+    """
+    if not os.path.exists(manifest_path(name)):
+        return None
+    with open(manifest_path(name)) as f:
+        return json.load(f)
+
+
+def write_manifest(name: str, manifest: dict) -> None:
+    path = manifest_path(name)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(path + ".tmp", path)
+
+
+def version_path(name: str, version: str) -> str:
+    if version == LEGACY_VERSION:
+        return LEGACY_PATHS[name]
+    return os.path.join(COLLECTIONS_PATH, name, version)
+
+
+class Shard:
+    """The FAISS index, documents and BM25 partitions of one company of a collection."""
+
+    def __init__(
+        self, name: str, key: str, db: FAISS, documents: List[Document], nbytes: float = 0.0
+    ):
+        self.name = name
+        self.key = key
+        self.db = db
+        self.documents = documents
+        self.nbytes = nbytes
+        prepare_index(db.index, INDEX_SEARCH_PARAMS.get(name))
+        # the sources the tools show are derived once here, not per request
+        attach_source_info(
+            itertools.chain(documents, db.docstore._dict.values()), table=name == "structured"
+        )
+        # docstore ids of the documents, also for their copies in the BM25 corpus
+        self.document_ids = {document_key(doc): doc_id for doc_id, doc in db.docstore._dict.items()}
+        self.partitions: Dict[Tuple, List[Document]] = defaultdict(list)
+        for doc in documents:
+            self.partitions[tuple(doc.metadata[key] for key in PARTITION_KEYS)].append(doc)
+        self.bm25_cache: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, name: str, key: str, path: str) -> "Shard":
+        with timed("shard_load", f"{name}_tool") as span:
+            db = FAISS.load_local(path, get_embeddings(), allow_dangerous_deserialization=True)
+            documents = load_docs_from_jsonl(os.path.join(path, "docs.jsonl"))
+            span.set_attributes(shard=key, documents=len(documents))
+        logger.info(f"Loaded shard {key} of collection {name}: {len(documents)} documents")
+        return cls(name, key, db, documents, shard_bytes(path))
+
+    def bm25_retriever(self, query_metadata: dict) -> Optional[BM25Retriever]:
+        """
+        BM25 retriever over the partitions matching the allowed metadata values, cached per set of
+        partitions for the lifetime of this shard.
+        """
+        keys = tuple(
+            sorted(
+                (
+                    key
+                    for key in self.partitions
+                    if all(
+                        value in query_metadata[name]
+                        for name, value in zip(PARTITION_KEYS, key)
+                        if name in query_metadata
+                    )
+                ),
+                key=str,
+            )
+        )
+        if not keys:
+            return None
+
+        with self.lock:
+            retriever = self.bm25_cache.get(keys)
+            if retriever is not None:
+                self.bm25_cache.move_to_end(keys)
+        record_cache_lookup("bm25", retriever is not None)
+        if retriever is None:
+            retriever = BM25Retriever.from_documents(
+                [doc for key in keys for doc in self.partitions[key]]
+            )
+            with self.lock:
+                self.bm25_cache[keys] = retriever
+                if len(self.bm25_cache) > BM25_CACHE_SIZE:
+                    self.bm25_cache.popitem(last=False)
+        return retriever
+
+
+def shard_bytes(path: str) -> float:
+    """
+    Estimated memory of a loaded shard: its FAISS index, and its documents, held three times (the
+    docstore, the document list and the BM25 corpus) as Python objects about twice their size.
+    """
+    index_size = os.path.getsize(os.path.join(path, "index.faiss"))
+    documents_size = os.path.getsize(os.path.join(path, "docs.jsonl"))
+    return index_size + 6 * documents_size
+
+
+# shards of all collections held in memory, shared by the versions pointing to the same folder
+shard_cache: SizedLRUCache[Shard] = SizedLRUCache(
+    "shard", SHARD_MEMORY_BUDGET_MB * 2**20, lambda shard: shard.nbytes
+)
+
+
+class Collection:
+    """
+    A version of a collection: its shards, one per company, loaded on the first query routed to
+    them and kept in the memory-bounded `shard_cache`.
+
+    Versions built before the collections were sharded, and the legacy folders, are a single
+    shard of all companies, held in memory for the lifetime of the version.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        version: str,
+        shard_paths: Dict[str, str],
+        resident: Optional[Shard] = None,
+    ):
+        self.name = name
+        self.version = version
+        self.shard_paths = shard_paths
+        self.resident = resident
+
+    @classmethod
+    def load(cls, name: str, version: Optional[str] = None) -> "Collection":
+        """
+        Load a version of a collection, by default the current one of its manifest, or the legacy
+        folder if the collection has no manifest. Only the shard list of a sharded version is read.
+        """
+        manifest = read_manifest(name)
+        if version is None:
+            version = manifest["current"] if manifest is not None else LEGACY_VERSION
+        known = {entry["id"] for entry in manifest["versions"]} if manifest is not None else set()
+        path = version_path(name, version)
+        if (version != LEGACY_VERSION and version not in known) or not os.path.isdir(path):
+            raise FileNotFoundError(f"Version {version} of collection {name} not found")
+
+        if not os.path.exists(os.path.join(path, "shards.json")):
+            return cls(name, version, {}, resident=Shard.load(name, ALL_SHARDS, path))
+        with open(os.path.join(path, "shards.json")) as f:
+            shards = json.load(f)
+        shard_paths = {
+            key: os.path.join(COLLECTIONS_PATH, name, shard["path"])
+            for key, shard in shards.items()
+        }
+        logger.info(f"Loaded collection {name} version {version}: {len(shard_paths)} shards")
+        return cls(name, version, shard_paths)
+
+    @classmethod
+    def in_memory(
+        cls, name: str, version: str, db: FAISS, documents: List[Document]
+    ) -> "Collection":
+        """Collection of a single shard built in memory, e.g. by a benchmark."""
+        return cls(name, version, {}, resident=Shard(name, ALL_SHARDS, db, documents))
+
+    def shards(self, companies: Optional[List[str]] = None) -> List[Shard]:
+        """
+        Shards of the companies a query is routed to, loading those not in memory, or all shards
+        if no company is given.
+        """
+        if self.resident is not None:
+            return [self.resident]
+        keys = [key for key in companies if key in self.shard_paths] if companies else None
+        return [self.shard(key) for key in (keys if keys is not None else sorted(self.shard_paths))]
+
+    def shard(self, key: str) -> Shard:
+        if self.resident is not None and key == self.resident.key:
+            return self.resident
+        path = self.shard_paths[key]
+        return shard_cache.get_or_load(
+            self.cache_key(key), lambda: Shard.load(self.name, key, path)
+        )
+
+    def cache_key(self, key: str) -> Tuple[str, str]:
+        return (self.name, os.path.normpath(self.shard_paths[key]))
+
+    def resident_keys(self) -> List[str]:
+        """Keys of the shards of the version held in memory, all of them for a single shard."""
+        if self.resident is not None:
+            return [ALL_SHARDS]
+        return [key for key in self.shard_paths if self.cache_key(key) in shard_cache]
+
+    def preload(self, keys: List[str]) -> int:
+        """Load the shards of the given keys, all shards for ALL_SHARDS; the number loaded."""
+        if self.resident is not None:
+            return 0
+        if ALL_SHARDS in keys:
+            keys = sorted(self.shard_paths)
+        keys = [key for key in keys if key in self.shard_paths]
+        for key in keys:
+            self.shard(key)
+        return len(keys)
+
+    def document_ids(
+        self, docs: List[Document], shards: List[Shard]
+    ) -> Optional[List[Tuple[str, str]]]:
+        """
+        Shard keys and docstore ids of documents found in the shards, None if one of them is not
+        in a docstore (e.g. a legacy BM25 corpus that differs from its index).
+        """
+        ids = []
+        for doc in docs:
+            key = document_key(doc)
+            shard = next((shard for shard in shards if key in shard.document_ids), None)
+            if shard is None:
+                return None
+            ids.append((shard.key, shard.document_ids[key]))
+        return ids
+
+    def documents(self, ids: List[Tuple[str, str]]) -> List[Document]:
+        """Documents of shard keys and docstore ids, loading the shards not in memory."""
+        return [self.shard(key).db.docstore._dict[doc_id] for key, doc_id in ids]
+
+
+def write_shard(
+    name: str,
+    path: str,
+    key: str,
+    documents: List[Document],
+    vectors: List[List[float]],
+    embeddings: Embeddings,
+    index_type: str,
+    parent_path: Optional[str] = None,
+) -> dict:
+    """
+    Write the index and documents of a shard, appended to those of the parent shard if any.
+
+    Returns:
+        dict: Shard entry of shards.json, without its path
+    """
+    text_embeddings = list(zip([doc.page_content for doc in documents], vectors))
+    metadatas = [doc.metadata for doc in documents]
+    if parent_path is not None:
+        db = FAISS.load_local(parent_path, embeddings, allow_dangerous_deserialization=True)
+        prepare_index(db.index)
+        db.add_embeddings(text_embeddings, metadatas=metadatas)
+        documents = load_docs_from_jsonl(os.path.join(parent_path, "docs.jsonl")) + documents
+        # recall is measured when the index is built, its parameters do not change on append
+        recall = None
+    else:
+        db = build_index(
+            index_type, [doc.page_content for doc in documents], vectors, metadatas, embeddings
+        )
+        prepare_index(db.index, INDEX_SEARCH_PARAMS.get(name))
+        recall = recall_vs_flat(db.index, vectors, k=10)
+
+    db.save_local(path)
+    save_docs_to_jsonl(documents, os.path.join(path, "docs.jsonl"))
+    return {
+        "documents": len(documents),
+        "description": faiss_description(db.index),
+        "bytes": index_bytes(db.index),
+        "recall_at_10": recall,
+    }
+
+
+def publish(
+    name: str,
+    documents: List[Document],
+    vectors: List[List[float]],
+    embeddings: Embeddings,
+    reports: List[str],
+    append: bool,
+    model: Optional[str] = None,
+    index_type: str = "flat",
+) -> str:
+    """
+    Write a new version of a collection, sharded by company, and make it current in its manifest.
+
+    Args:
+        name (str): Collection name, "structured" or "unstructured"
+        documents (List[Document]): Documents of the new version, or those to add in append mode
+        vectors (List[List[float]]): Embeddings of the documents
+        embeddings (Embeddings): Embedding model of the collection
+        reports (List[str]): Reports of the documents, recorded in the manifest
+        append (bool): Add the documents to the shards of the current version, which must be
+            sharded; the shards of the other companies are shared with it
+        model (Optional[str]): Name of the embedding model, recorded in the manifest
+        index_type (str): Type of a new index, see INDEX_TYPES; an appended one keeps its type
+
+    Returns:
+        str: Id of the new version
+    """
+    collection_path = os.path.join(COLLECTIONS_PATH, name)
+    os.makedirs(collection_path, exist_ok=True)
+    manifest = read_manifest(name) or {"current": None, "versions": []}
+    parent = manifest["current"] if append else None
+    parent_shards = {}
+    if parent is not None:
+        with open(os.path.join(version_path(name, parent), "shards.json")) as f:
+            parent_shards = json.load(f)
+
+    by_company: Dict[str, List[int]] = defaultdict(list)
+    for i, doc in enumerate(documents):
+        by_company[doc.metadata["company"]].append(i)
+
+    version = f"{datetime.datetime.now():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:6]}"
+    path = version_path(name, version)
+    # written under a temporary name, so readers never see a partial version
+    shutil.rmtree(path + ".tmp", ignore_errors=True)
+    os.makedirs(path + ".tmp")
+    shards = dict(parent_shards)
+    for company, indices in sorted(by_company.items()):
+        parent_shard = parent_shards.get(company)
+        entry = write_shard(
+            name,
+            os.path.join(path + ".tmp", "shards", company),
+            company,
+            [documents[i] for i in indices],
+            [vectors[i] for i in indices],
+            embeddings,
+            index_type,
+            os.path.join(collection_path, parent_shard["path"]) if parent_shard else None,
+        )
+        if entry["recall_at_10"] is None:
+            entry["recall_at_10"] = parent_shard.get("recall_at_10")
+        shards[company] = dict(entry, path=os.path.join(version, "shards", company))
+    with open(os.path.join(path + ".tmp", "shards.json"), "w") as f:
+        json.dump(shards, f, indent=4)
+    os.replace(path + ".tmp", path)
+
+    if parent is not None:
+        parent_entry = next(entry for entry in manifest["versions"] if entry["id"] == parent)
+        reports = parent_entry["reports"] + [
+            report for report in reports if report not in parent_entry["reports"]
+        ]
+    n_documents = sum(shard["documents"] for shard in shards.values())
+    measured = [shard for shard in shards.values() if shard["recall_at_10"] is not None]
+    manifest["versions"].append(
+        {
+            "id": version,
+            "parent": parent,
+            "created": datetime.datetime.now().isoformat(),
+            "documents": n_documents,
+            "reports": reports,
+            "model": model,
+            "sharded": True,
+            "index": {
+                "type": index_type,
+                "bytes": sum(shard["bytes"] for shard in shards.values()),
+                # weighted by the documents of the shards
+                "recall_at_10": (
+                    sum(shard["recall_at_10"] * shard["documents"] for shard in measured)
+                    / sum(shard["documents"] for shard in measured)
+                    if measured
+                    else None
+                ),
+                "search_params": INDEX_SEARCH_PARAMS.get(name),
+            },
+            "shards": len(shards),
+        }
+    )
+    manifest["current"] = version
+    write_manifest(name, manifest)
+    logger.info(
+        f"Published collection {name} version {version} ({n_documents} documents in "
+        f"{len(shards)} shards, {len(by_company)} written), served after a swap or restart of the API"
+    )
+    return version
+
+
+class CollectionRegistry:
+    """The collections served, swapped atomically to a new version while serving."""
+
+    def __init__(self):
+        self.collections: Dict[str, Collection] = {}
+        self.lock = threading.Lock()
+
+    def get(self, name: str) -> Collection:
+        """
+        Current version of a collection. Callers keep the returned object for a whole request, so
+        a swap does not change the index under an in-flight request.
+        """
+        collection = self.collections.get(name)
+        if collection is None:
+            with self.lock:
+                if name not in self.collections:
+                    self.collections[name] = Collection.load(name)
+                collection = self.collections[name]
+        return collection
+
+    def swap(self, name: str, version: Optional[str] = None) -> Tuple[Optional[str], str]:
+        """
+        Load a version of a collection, by default the current one of its manifest, and serve it.
+
+        The new version is loaded while the old one keeps serving, with the shards of the
+        companies the old one held in memory, so its first queries do not pay for loading them.
+        It then replaces the old one in one assignment; requests holding the old version finish
+        with it.
+
+        Returns:
+            Tuple[Optional[str], str]: Previous and new version ids
+        """
+        if name not in LEGACY_PATHS:
+            raise KeyError(f"Unknown collection {name}")
+        collection = Collection.load(name, version)
+        serving = self.collections.get(name)
+        if serving is not None:
+            with timed("shard_preload"):
+                preloaded = collection.preload(serving.resident_keys())
+            logger.info(f"Preloaded {preloaded} shards of collection {name} {collection.version}")
+        with self.lock:
+            previous = self.collections.get(name)
+            self.collections[name] = collection
+        previous_version = previous.version if previous is not None else None
+        logger.info(f"Swapped collection {name}: {previous_version} -> {collection.version}")
+        return previous_version, collection.version
+
+    def versions(self) -> Dict[str, str]:
+        return {name: collection.version for name, collection in self.collections.items()}
+
+
+registry = CollectionRegistry()
@@ -0,0 +1,113 @@
+import base64
+import io
+import json
+import math
+import os
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from PIL import Image
+
+from app.common import logger
+from app.common import VISION_MAX_SIDE
+
+# OpenAI vision pricing: "low" detail is a fixed cost, "high" detail costs per 512px tile after
+# the image is fit in 2048x2048 and its shortest side scaled to 768
+LOW_DETAIL_TOKENS = 85
+TILE_TOKENS = 170
+TILE_SIDE = 512
+HIGH_DETAIL_MAX_SIDE = 2048
+HIGH_DETAIL_SHORT_SIDE = 768
+
+# margins added around detected tables (share of the page), more above for titles and units
+CROP_PADDING = 0.02
+CROP_PADDING_TOP = 0.05
+
+
+def table_boxes_path(page_path: str) -> str:
+    """Sidecar file with the table bounding boxes of a page, next to its base64 PNG."""
+    return os.path.splitext(page_path)[0] + ".tables.json"
+
+
+def load_table_boxes(page_path: str) -> Optional[List[List[float]]]:
+    """
+    Load the table bounding boxes of a page stored by the ingestion.
+
+    Args:
+        page_path (str): Path of the base64 PNG of the page
+
+    Returns:
+        Optional[List[List[float]]]: Boxes as [x0, y0, x1, y1] shares of the page width and
+        height, or None if the page has no sidecar file
+    """
+    path = table_boxes_path(page_path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return [table["box"] for table in json.load(f)["tables"]]
+
+
+def crop_box(boxes: List[List[float]], width: int, height: int) -> Tuple[int, int, int, int]:
+    """Pixel box around all tables of a page, with margins."""
+    x0 = min(box[0] for box in boxes) - CROP_PADDING
+    y0 = min(box[1] for box in boxes) - CROP_PADDING_TOP
+    x1 = max(box[2] for box in boxes) + CROP_PADDING
+    y1 = max(box[3] for box in boxes) + CROP_PADDING
+    return (
+        max(0, math.floor(x0 * width)),
+        max(0, math.floor(y0 * height)),
+        min(width, math.ceil(x1 * width)),
+        min(height, math.ceil(y1 * height)),
+    )
+
+
+def image_tokens(width: int, height: int, detail: str) -> int:
+    """Estimate the prompt tokens of an image for the OpenAI vision models."""
+    if detail == "low":
+        return LOW_DETAIL_TOKENS
+    scale = min(1.0, HIGH_DETAIL_MAX_SIDE / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, HIGH_DETAIL_SHORT_SIDE / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / TILE_SIDE) * math.ceil(height / TILE_SIDE)
+    return LOW_DETAIL_TOKENS + TILE_TOKENS * tiles
+
+
+def prepare_vision_image(png: bytes, page_path: str) -> Tuple[str, str, int]:
+    """
+    Reduce a page image to what the vision model needs to read its tables.
+
+    With table boxes stored for the page, the tables are cropped and downscaled to
+    VISION_MAX_SIDE, and sent with "low" detail if they fit in a single tile. Without them, the
+    full page is sent as is.
+
+    Args:
+        png (bytes): PNG of the page
+        page_path (str): Path of the base64 PNG of the page, to find its table boxes
+
+    Returns:
+        Tuple[str, str, int]: Base64 PNG to send, its detail level and its estimated tokens
+    """
+    image = Image.open(io.BytesIO(png))
+    boxes = load_table_boxes(page_path)
+    if not boxes:
+        # re-encoding a resized page costs more time and bytes than it saves
+        full_page = base64.b64encode(png).decode("utf-8")
+        return full_page, "auto", image_tokens(image.width, image.height, "high")
+
+    image = image.crop(crop_box(boxes, *image.size))
+    scale = min(1.0, VISION_MAX_SIDE / max(image.size))
+    if scale < 1.0:
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.LANCZOS)
+    detail = "low" if max(image.size) <= TILE_SIDE else "high"
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    tokens = image_tokens(image.width, image.height, detail)
+    logger.info(
+        f"Vision image {os.path.basename(page_path)}: {len(boxes)} tables cropped to "
+        f"{image.width}x{image.height}, detail {detail}, ~{tokens} tokens"
+    )
+    return base64.b64encode(buffer.getvalue()).decode("utf-8"), detail, tokens
@@ -0,0 +1,215 @@
+import json
+import re
+import time
+from collections import Counter
+from collections import defaultdict
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+
+from app.common import logger
+from app.common import TOP_K
+from app.common import WARMUP_HISTORY_ROWS
+from app.common import WARMUP_MAX_OPENAI_CALLS
+from app.common import WARMUP_MAX_QUESTIONS
+from app.common import WARMUP_MAX_SECONDS
+from app.common import WARMUP_SUGGESTIONS_PATH
+from app.common.metrics import timed
+from app.common.retrieval import embed_queries
+from app.common.router import rewrite_query
+from app.common.speculation import speculative_metadata
+from app.common.speculation import SPECULATIVE_SEARCHES
+from app.common.speculation import tool_search
+from app.common.utils import load_page_image
+from app.common.vector_store import registry
+
+# estimated OpenAI calls of answering a question: the agent's plan, the synthesis of its tool
+# call and the final answer
+SYNTHESIS_CALLS_PER_QUESTION = 3
+
+# answers a question through the agent, filling the caches its tools go through
+Answer = Callable[[str], object]
+
+
+def normalize_question(question: str) -> str:
+    return " ".join(question.lower().split())
+
+
+def suggested_questions(path: str = WARMUP_SUGGESTIONS_PATH) -> List[str]:
+    """Prompt suggestions of the frontend, the string literals of its PROMPT_EXAMPLES."""
+    try:
+        with open(path) as f:
+            source = f.read()
+    except OSError as e:
+        logger.warning(f"No prompt suggestions to warm up: {str(e)}")
+        return []
+    match = re.search(r"PROMPT_EXAMPLES\s*=\s*\[(.*?)\]", source, re.DOTALL)
+    if match is None:
+        return []
+    return [json.loads(literal) for literal in re.findall(r'"(?:[^"\\]|\\.)*"', match.group(1))]
+
+
+def historical_questions(supabase, rows: int = WARMUP_HISTORY_ROWS) -> List[str]:
+    """
+    Questions of the latest stored conversations, most frequent first. A conversation is stored
+    after each answer with its whole history, so only its last user message is counted.
+    """
+    try:
+        with timed("supabase_read"):
+            response = (
+                supabase.table("conversations")
+                .select("chat_history")
+                .order("created_at", desc=True)
+                .limit(rows)
+                .execute()
+            )
+    except Exception as e:
+        logger.error(f"Error reading the conversations to warm up: {str(e)}")
+        return []
+
+    counts: Counter = Counter()
+    texts: Dict[str, str] = {}
+    for row in response.data:
+        user_messages = [
+            message["content"]
+            for message in row.get("chat_history") or []
+            if message.get("role") == "user" and message.get("content")
+        ]
+        if user_messages:
+            key = normalize_question(user_messages[-1])
+            counts[key] += 1
+            texts.setdefault(key, user_messages[-1])
+    return [texts[key] for key, _ in counts.most_common()]
+
+
+def warmup_questions(
+    supabase, max_questions: int = WARMUP_MAX_QUESTIONS, rows: int = WARMUP_HISTORY_ROWS
+) -> List[str]:
+    """
+    Questions to warm up: the prompt suggestions, which every user is offered, then the most
+    frequent questions of the history, without duplicates.
+    """
+    questions: Dict[str, str] = {}
+    for question in suggested_questions() + historical_questions(supabase, rows):
+        questions.setdefault(normalize_question(question), question)
+    return list(questions.values())[:max_questions]
+
+
+def prefetch_embeddings(searches: List[tuple], max_calls: int) -> int:
+    """
+    Embed the search queries with one embedding call per collection, loading the shards of their
+    companies, so the searches find them in the query embedding cache.
+
+    Args:
+        searches (List[tuple]): Tool, search query and metadata of the searches
+        max_calls (int): Embedding calls allowed
+
+    Returns:
+        int: Number of embedding calls made
+    """
+    queries: Dict[str, List[str]] = defaultdict(list)
+    companies: Dict[str, Set[str]] = defaultdict(set)
+    for tool, query, query_metadata in searches:
+        name = SPECULATIVE_SEARCHES[tool][0]
+        queries[name].append(query)
+        companies[name].update(query_metadata["company"])
+
+    calls = 0
+    for name, collection_queries in queries.items():
+        if calls >= max_calls:
+            break
+        with timed("warmup_embedding"):
+            if embed_queries(registry.get(name), sorted(companies[name]), collection_queries):
+                calls += 1
+    return calls
+
+
+def warm_search(tool: str, query: str, query_metadata: dict) -> int:
+    """Run the search of a tool and load the page images of its top documents; the pages loaded."""
+    with timed("warmup_search", tool):
+        docs = tool_search(tool, registry.get(SPECULATIVE_SEARCHES[tool][0]), query, query_metadata)
+    pages = 0
+    for doc in docs[:TOP_K]:
+        try:
+            load_page_image(doc.metadata["source_info"])
+            pages += 1
+        except Exception as e:
+            logger.error(str(e))
+    return pages
+
+
+def warm_up(
+    questions: List[str],
+    answer: Optional[Answer] = None,
+    max_seconds: float = WARMUP_MAX_SECONDS,
+    max_openai_calls: int = WARMUP_MAX_OPENAI_CALLS,
+) -> dict:
+    """
+    Replay questions through the stages a chat request goes through before synthesis, so the
+    first users asking them hit warm caches: company resolution, the shards of the companies,
+    the query embeddings, the searches of both tools and the page images of their top documents.
+
+    The questions are warmed in order until the time or the OpenAI calls budget runs out. The
+    query embeddings are computed in one call per collection; with `answer`, each question is
+    then also answered through the agent, an estimated SYNTHESIS_CALLS_PER_QUESTION calls.
+
+    Args:
+        questions (List[str]): Questions, most valuable first
+        answer (Optional[Answer]): Answers a question, None to skip the LLM synthesis
+        max_seconds (float): Time budget
+        max_openai_calls (int): OpenAI calls budget
+
+    Returns:
+        dict: Questions warmed, skipped without a known company and failed, the pages loaded,
+            the OpenAI calls, the seconds taken and the budget that stopped the warm-up if any
+    """
+    start = time.monotonic()
+    stats = {"questions": len(questions), "warmed": 0, "skipped": 0, "failed": 0, "pages": 0}
+    stopped_by = None
+
+    searches = []
+    for question in questions:
+        query_metadata = speculative_metadata(question)
+        if query_metadata is None:
+            stats["skipped"] += 1
+            continue
+        query = rewrite_query(question)
+        searches.append((question, query, query_metadata))
+
+    openai_calls = prefetch_embeddings(
+        [
+            (tool, query, query_metadata)
+            for _, query, query_metadata in searches
+            for tool in SPECULATIVE_SEARCHES
+        ],
+        max_openai_calls,
+    )
+
+    for question, query, query_metadata in searches:
+        if time.monotonic() - start >= max_seconds:
+            stopped_by = "time"
+            break
+        if answer is not None and openai_calls + SYNTHESIS_CALLS_PER_QUESTION > max_openai_calls:
+            stopped_by = "openai_calls"
+            break
+        try:
+            for tool in SPECULATIVE_SEARCHES:
+                stats["pages"] += warm_search(tool, query, query_metadata)
+            if answer is not None:
+                openai_calls += SYNTHESIS_CALLS_PER_QUESTION
+                with timed("warmup_answer"):
+                    answer(question)
+            stats["warmed"] += 1
+        except Exception as e:
+            logger.error(f"Error warming up {question!r}: {str(e)}")
+            stats["failed"] += 1
+
+    stats.update(
+        openai_calls=openai_calls,
+        seconds=round(time.monotonic() - start, 3),
+        stopped_by=stopped_by,
+    )
+    logger.info(f"Warm-up done: {stats}")
+    return stats
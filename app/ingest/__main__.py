@@ -0,0 +1,70 @@
+"""
+Build the serving artifacts from report PDFs: page images, table boxes, text chunks, table
+documents, new versions of both collections, and the fact store.
+
+Reports are named like `volvo_q4_2023.pdf`. Each stage of a report is checkpointed, so a rerun
+after adding a report only processes the new one and appends its documents to the collections.
+The API serves the new versions after `POST /admin/collections/{name}/swap` or a restart.
+
+Usage (from the repository root):
+    python -m app.ingest --pdf-dir data/pdf
+    python -m app.ingest data/pdf/volvo_q4_2024.pdf --workers 8
+    python -m app.ingest --embedding-backend hashing --summarizer extractive  # offline
+    python -m app.ingest --rebuild  # after re-ingesting or removing a report
+    python -m app.ingest --index-type hnsw-int8  # approximate index, recall vs flat in the manifest
+"""
+
+import argparse
+import glob
+import os
+
+from app.common import EMBEDDING_BACKEND
+from app.common import VECTOR_INDEX_TYPE
+from app.common.vector_index import INDEX_TYPES
+from app.ingest.pipeline import run_pipeline
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("pdfs", nargs="*", help="reports to ingest, default: all in --pdf-dir")
+    parser.add_argument("--pdf-dir", default=os.path.join("data", "pdf"))
+    parser.add_argument("--work-dir", default=os.path.join("data", "ingest"))
+    parser.add_argument(
+        "--embedding-backend", choices=["openai", "hashing"], default=EMBEDDING_BACKEND
+    )
+    parser.add_argument(
+        "--summarizer",
+        choices=["openai", "extractive"],
+        default="openai",
+        help="summaries of the tables: by the LLM, or their title and line items",
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--dpi", type=int, default=150)
+    parser.add_argument(
+        "--index-type",
+        choices=list(INDEX_TYPES),
+        default=VECTOR_INDEX_TYPE,
+        help="FAISS index of the collections; changing it rebuilds them",
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="rebuild the collections from all reports instead of appending the new ones",
+    )
+    args = parser.parse_args()
+
+    pdf_paths = args.pdfs or sorted(glob.glob(os.path.join(args.pdf_dir, "*.pdf")))
+    run_pipeline(
+        pdf_paths,
+        work_dir=args.work_dir,
+        embedding_backend=args.embedding_backend,
+        summarizer=args.summarizer,
+        workers=args.workers,
+        dpi=args.dpi,
+        rebuild=args.rebuild,
+        index_type=args.index_type,
+    )
+
+
+if __name__ == "__main__":
+    main()
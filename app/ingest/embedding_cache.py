@@ -0,0 +1,86 @@
+import hashlib
+import sqlite3
+from typing import Dict
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from app.common import logger
+
+
+class EmbeddingCache:
+    """On-disk cache of document embeddings, keyed by the embedding model and the text hash."""
+
+    def __init__(self, path: str, model: str):
+        self.model = model
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(model TEXT, text_hash TEXT, vector BLOB, PRIMARY KEY (model, text_hash))"
+        )
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, text_hashes: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        # sqlite limits the number of query parameters
+        for start in range(0, len(text_hashes), 500):
+            batch = text_hashes[start : start + 500]
+            rows = self.connection.execute(
+                "SELECT text_hash, vector FROM embeddings WHERE model = ? "
+                f"AND text_hash IN ({', '.join('?' * len(batch))})",
+                [self.model, *batch],
+            )
+            for text_hash, vector in rows:
+                found[text_hash] = np.frombuffer(vector, dtype=np.float32).tolist()
+        return found
+
+    def put(self, vectors: Dict[str, List[float]]) -> None:
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                [
+                    (self.model, text_hash, np.asarray(vector, dtype=np.float32).tobytes())
+                    for text_hash, vector in vectors.items()
+                ],
+            )
+
+
+def embed_texts(
+    texts: List[str], embeddings: Embeddings, cache: EmbeddingCache, batch_size: int = 256
+) -> List[List[float]]:
+    """
+    Embed texts in batches, once per distinct text, reusing the vectors cached by earlier runs.
+
+    Args:
+        texts (List[str]): Texts to embed
+        embeddings (Embeddings): Embedding model, used for the texts missing from the cache
+        cache (EmbeddingCache): Cache of the model's vectors, updated after each batch
+        batch_size (int): Texts per embedding request
+
+    Returns:
+        List[List[float]]: Vectors of the texts, in their order
+    """
+    hashes = [cache.text_hash(text) for text in texts]
+    distinct = dict(zip(hashes, texts))
+    vectors = cache.get(list(distinct))
+    missing = [text_hash for text_hash in distinct if text_hash not in vectors]
+    logger.info(
+        f"Embeddings: {len(texts)} texts, {len(distinct)} distinct, "
+        f"{len(distinct) - len(missing)} cached, {len(missing)} to embed"
+    )
+
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start : start + batch_size]
+        batch_vectors = dict(
+            zip(batch, embeddings.embed_documents([distinct[text_hash] for text_hash in batch]))
+        )
+        # stored after each batch, so an interrupted run keeps what it paid for
+        cache.put(batch_vectors)
+        vectors.update(batch_vectors)
+        logger.info(f"Embedded {min(start + batch_size, len(missing))}/{len(missing)} texts")
+
+    return [vectors[text_hash] for text_hash in hashes]
@@ -0,0 +1,139 @@
+"""
+Extract the figures of the OCRed tables of the structured vector store into the fact store,
+for exact-lookup questions answered without a vision call.
+
+Usage (from the repository root):
+    python -m app.ingest.facts
+    python -m app.ingest.facts --docs-path data/structured_vdb/.../docs.jsonl --output facts.sqlite
+"""
+
+import argparse
+import os
+import re
+from typing import List
+from typing import Optional
+
+from langchain.schema import Document
+
+from app.common import FACTS_DB_PATH
+from app.common import logger
+from app.common import STRUCTURED_VDB_PATH
+from app.common.facts import Fact
+from app.common.facts import FactStore
+from app.common.facts import normalize_item
+from app.common.sources import SUMMARY_SEPARATOR
+from app.common.utils import load_docs_from_jsonl
+
+YEAR_PATTERN = re.compile(r"(?<!\d)((?:19|20)\d{2})(?!\d)")
+# 1,234 / 1 234 / 1234.5 / -12 / (12), the parentheses and minus signs being negative
+NUMBER_PATTERN = re.compile(
+    r"^(\()?([-\u2212\u2013])?\s?(\d{1,3}(?:[ ,\u00a0]\d{3})+|\d+)(\.\d+)?(\))?$"
+)
+UNIT_PATTERN = re.compile(
+    r"\b(MSEK|SEK ?m(?:illion)?|SEK ?bn|SEK ?billion|TSEK|KSEK|MEUR|EUR ?m(?:illion)?|"
+    r"EUR ?bn|EUR ?billion|MUSD|USD ?m(?:illion)?)\b",
+    re.IGNORECASE,
+)
+
+
+def split_row(line: str) -> List[str]:
+    """Cells of a table row, markdown or separated by tabs or several spaces."""
+    line = line.strip()
+    if "|" in line:
+        return [cell.strip() for cell in line.strip("|").split("|")]
+    return [cell.strip() for cell in re.split(r"\t|\s{2,}", line)]
+
+
+def parse_number(text: str) -> Optional[float]:
+    match = NUMBER_PATTERN.match(text.strip())
+    if match is None:
+        return None
+    open_parenthesis, minus, integer, decimals, close_parenthesis = match.groups()
+    if bool(open_parenthesis) != bool(close_parenthesis):
+        return None
+    value = float(re.sub(r"[ ,\u00a0]", "", integer) + (decimals or ""))
+    return -value if open_parenthesis or minus else value
+
+
+def extract_facts(doc: Document) -> List[Fact]:
+    """
+    Read the figures of an OCRed table: one fact per line item and year column.
+
+    Args:
+        doc (Document): Document of the structured vector store, a table followed by its summary
+
+    Returns:
+        List[Fact]: Facts of the table, empty if it has no header row with years
+    """
+    table, _, summary = doc.page_content.partition(SUMMARY_SEPARATOR)
+    unit_match = UNIT_PATTERN.search(table) or UNIT_PATTERN.search(summary)
+    unit = unit_match.group(0) if unit_match else None
+    metadata = doc.metadata
+    file_name = f"{metadata['company']}_{metadata['quarter']}_{metadata['year']}.pdf"
+
+    facts = []
+    columns = None  # (position, header, year) of the year columns
+    n_cells = 0
+    for line in table.splitlines():
+        cells = split_row(line)
+        if len(cells) < 2 or all(re.fullmatch(r":?-+:?|", cell) for cell in cells):
+            continue
+
+        header_years = [YEAR_PATTERN.search(cell) for cell in cells[1:]]
+        if any(header_years) and all(
+            parse_number(cell) is None or YEAR_PATTERN.fullmatch(cell) for cell in cells[1:]
+        ):
+            columns = [
+                (1 + i, cells[1 + i], int(year.group(1)))
+                for i, year in enumerate(header_years)
+                if year
+            ]
+            n_cells = len(cells)
+            continue
+
+        line_item = cells[0]
+        item_key = normalize_item(line_item)
+        # rows with missing or merged cells cannot be aligned with the header
+        if columns is None or len(cells) != n_cells or not item_key:
+            continue
+        if parse_number(line_item) is not None:
+            continue
+        for position, period, period_year in columns:
+            value_text = cells[position]
+            value = parse_number(value_text)
+            if value is None:
+                continue
+            facts.append(
+                Fact(
+                    company=metadata["company"],
+                    year=int(metadata["year"]),
+                    quarter=metadata["quarter"],
+                    period_year=period_year,
+                    period=period,
+                    line_item=line_item,
+                    item_key=item_key,
+                    value=value,
+                    value_text=value_text,
+                    unit=unit,
+                    page_nr=int(metadata["page_nr"]),
+                    file_name=file_name,
+                )
+            )
+    return facts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--docs-path", default=os.path.join(STRUCTURED_VDB_PATH, "docs.jsonl"))
+    parser.add_argument("--output", default=FACTS_DB_PATH)
+    args = parser.parse_args()
+
+    documents = load_docs_from_jsonl(args.docs_path)
+    facts = [fact for doc in documents for fact in extract_facts(doc)]
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    n_facts = FactStore(args.output).write(facts)
+    logger.info(f"Stored {n_facts} facts from {len(documents)} tables in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
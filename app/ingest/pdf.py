@@ -0,0 +1,174 @@
+import base64
+import io
+import os
+import re
+from typing import List
+from typing import Tuple
+
+from pdf2image import convert_from_path
+from pydantic import BaseModel
+from PyPDF2 import PdfReader
+
+# text items closer than this share of the font size are joined, farther ones are separate cells
+CELL_GAP = 1.0
+# vertical tolerance of a text line, in points
+LINE_TOLERANCE = 2.0
+NUMBER_CELL_PATTERN = re.compile(r"^\(?[-\u2212\u2013]?\s?\d[\d ,.\u00a0]*\)?%?$")
+
+
+class Line(BaseModel):
+    """A text line of a page, split into cells."""
+
+    box: Tuple[float, float, float, float]  # x0, y0, x1, y1 as shares of the page
+    cells: List[str]
+
+    @property
+    def text(self) -> str:
+        return "  ".join(self.cells)
+
+
+def page_count(pdf_path: str) -> int:
+    return len(PdfReader(pdf_path).pages)
+
+
+def render_pages(pdf_path: str, first_page: int, last_page: int, output_dir: str, dpi: int) -> int:
+    """
+    Render pages of a PDF to base64 PNG files `{report}_page_{n}.txt`, skipping those done before.
+
+    Args:
+        pdf_path (str): Path of the report
+        first_page (int): First page to render, from 1
+        last_page (int): Last page to render, included
+        output_dir (str): Folder of the report's pages
+        dpi (int): Resolution of the rendering
+
+    Returns:
+        int: Number of pages rendered
+    """
+    report = os.path.splitext(os.path.basename(pdf_path))[0]
+    pages = [
+        page
+        for page in range(first_page, last_page + 1)
+        if not os.path.exists(os.path.join(output_dir, f"{report}_page_{page}.txt"))
+    ]
+    if not pages:
+        return 0
+
+    images = convert_from_path(pdf_path, dpi=dpi, first_page=pages[0], last_page=pages[-1])
+    for page, image in zip(range(pages[0], pages[-1] + 1), images):
+        path = os.path.join(output_dir, f"{report}_page_{page}.txt")
+        if os.path.exists(path):
+            continue
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        # written under a temporary name, so an interrupted run leaves no partial page
+        with open(path + ".tmp", "w") as f:
+            f.write(base64.b64encode(buffer.getvalue()).decode("utf-8"))
+        os.replace(path + ".tmp", path)
+    return len(pages)
+
+
+def extract_lines(pdf_path: str) -> List[List[Line]]:
+    """
+    Extract the text of each page of a PDF as lines of cells, with their positions.
+
+    Text items are grouped into lines by their baseline and split into cells where the horizontal
+    gap between them is wider than the font size, so table rows keep their columns.
+
+    Args:
+        pdf_path (str): Path of the report
+
+    Returns:
+        List[List[Line]]: Lines of each page, from top to bottom
+    """
+    pages = []
+    for page in PdfReader(pdf_path).pages:
+        width = float(page.mediabox.width) or 1.0
+        height = float(page.mediabox.height) or 1.0
+        items = []
+
+        def visitor(text, cm, tm, font_dict, font_size):
+            if not text.strip():
+                return
+            x = tm[4] * cm[0] + tm[5] * cm[2] + cm[4]
+            y = tm[4] * cm[1] + tm[5] * cm[3] + cm[5]
+            size = (font_size or 10.0) * abs(tm[0] * cm[0] or 1.0)
+            for part in text.split("\n"):
+                if part.strip():
+                    items.append((y, x, size, part.strip()))
+                y -= size
+
+        page.extract_text(visitor_text=visitor)
+
+        lines = []
+        for y, x, size, text in sorted(items, key=lambda item: (-item[0], item[1])):
+            if lines and abs(lines[-1]["y"] - y) <= LINE_TOLERANCE:
+                line = lines[-1]
+            else:
+                line = {"y": y, "size": size, "items": []}
+                lines.append(line)
+            line["items"].append((x, size, text))
+
+        page_lines = []
+        for line in lines:
+            cells = []
+            end = None
+            items = sorted(line["items"])
+            for x, size, text in items:
+                if end is not None and x - end <= CELL_GAP * size:
+                    cells[-1] = f"{cells[-1]} {text}"
+                else:
+                    cells.append(text)
+                # average glyph width is about half the font size
+                end = x + len(text) * size * 0.5
+            top = 1 - (line["y"] + line["size"]) / height
+            bottom = 1 - line["y"] / height
+            box = (
+                max(0.0, items[0][0] / width),
+                max(0.0, top),
+                min(1.0, end / width),
+                min(1.0, bottom),
+            )
+            page_lines.append(Line(box=box, cells=cells))
+        pages.append(page_lines)
+    return pages
+
+
+def is_table_row(line: Line) -> bool:
+    """A line with a label followed by at least two figures."""
+    numbers = sum(bool(NUMBER_CELL_PATTERN.match(cell)) for cell in line.cells[1:])
+    return len(line.cells) >= 3 and numbers >= 2
+
+
+def find_table_blocks(lines: List[Line], min_rows: int = 3) -> List[List[Line]]:
+    """
+    Group runs of table rows into tables, including the header line above each run.
+
+    Used when Table Transformer is not installed, it finds the tables of reports with a text
+    layer but not those printed as images.
+    """
+    tables = []
+    block = []
+    for i, line in enumerate(lines):
+        if is_table_row(line):
+            # the header of the columns, e.g. the periods, is above the first row
+            if not block and i > 0 and len(lines[i - 1].cells) >= 2:
+                block.append(lines[i - 1])
+            block.append(line)
+            continue
+        if sum(map(is_table_row, block)) >= min_rows:
+            tables.append(block)
+        block = []
+    if sum(map(is_table_row, block)) >= min_rows:
+        tables.append(block)
+    return tables
+
+
+def lines_in_box(lines: List[Line], box: List[float]) -> List[Line]:
+    """Lines whose center lies in a box given as [x0, y0, x1, y1] shares of the page."""
+    x0, y0, x1, y1 = box
+    return [
+        line
+        for line in lines
+        if y0 <= (line.box[1] + line.box[3]) / 2 <= y1 and line.box[0] < x1 and line.box[2] > x0
+    ]
@@ -0,0 +1,389 @@
+import functools
+import json
+import os
+import re
+from concurrent.futures import as_completed
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from langchain.schema import Document
+from langchain_openai import ChatOpenAI
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from app.common import FACTS_DB_PATH
+from app.common import logger
+from app.common import MODEL_STRUCTURED
+from app.common import OPENAI_API_KEY
+from app.common import OPENAI_EMBEDDING_MODEL
+from app.common import PAGES_PATH
+from app.common import VECTOR_INDEX_TYPE
+from app.common.embeddings import get_embeddings
+from app.common.embeddings import HashingEmbeddings
+from app.common.facts import FactStore
+from app.common.sources import SUMMARY_SEPARATOR
+from app.common.utils import load_docs_from_jsonl
+from app.common.utils import save_docs_to_jsonl
+from app.common.vector_store import publish
+from app.common.vector_store import read_manifest
+from app.common.vision import table_boxes_path
+from app.ingest.embedding_cache import embed_texts
+from app.ingest.embedding_cache import EmbeddingCache
+from app.ingest.facts import extract_facts
+from app.ingest.pdf import extract_lines
+from app.ingest.pdf import find_table_blocks
+from app.ingest.pdf import Line
+from app.ingest.pdf import lines_in_box
+from app.ingest.pdf import page_count
+from app.ingest.pdf import render_pages
+from app.ingest.tables import load_detector
+from app.ingest.tables import store_page_tables
+
+TEXT_PATH = os.path.join("data", "pdf_txt")
+REPORT_PATTERN = re.compile(r"^([a-z0-9&]+)_(q[1-4]|annual)_(\d{4})$")
+
+RENDER_BATCH_PAGES = 8
+CHUNK_SIZE = 1500
+CHUNK_OVERLAP = 150
+
+SUMMARY_PROMPT = """\
+Summarize the table below from the {company} {quarter} {year} financial report in two sentences: \
+name the statement or breakdown it shows, its periods, its unit and its main line items.
+
+{table}"""
+
+
+def parse_report_name(report: str) -> Tuple[str, str, int]:
+    """Company, quarter and year of a report named like `volvo_q4_2023`."""
+    match = REPORT_PATTERN.match(report)
+    if match is None:
+        raise ValueError(
+            f"Report {report} is not named as company_quarter_year, e.g. volvo_q4_2023"
+        )
+    company, quarter, year = match.groups()
+    return company, quarter, int(year)
+
+
+class Checkpoint:
+    """Stages of a report done by earlier runs, stored in its work folder."""
+
+    def __init__(self, work_dir: str, report: str):
+        self.path = os.path.join(work_dir, report, "checkpoint.json")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.stages = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.stages = json.load(f)
+
+    def done(self, stage: str) -> bool:
+        return stage in self.stages
+
+    def mark(self, stage: str, value=True) -> None:
+        self.stages[stage] = value
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.stages, f, indent=4)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def extract_report_text(pdf_path: str, work_dir: str) -> int:
+    """
+    Extract the text of a report: a text file per page, the unstructured chunks and the page lines
+    for the table stage. Runs in a worker process.
+    """
+    report = os.path.splitext(os.path.basename(pdf_path))[0]
+    company, quarter, year = parse_report_name(report)
+    pages = extract_lines(pdf_path)
+
+    text_dir = os.path.join(TEXT_PATH, report)
+    os.makedirs(text_dir, exist_ok=True)
+    splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    chunks = []
+    for page_nr, lines in enumerate(pages, start=1):
+        text = "\n".join(line.text for line in lines)
+        source = os.path.join(TEXT_PATH, report, f"{report}_page_{page_nr}.txt")
+        with open(source, "w") as f:
+            f.write(text)
+        metadata = {
+            "company": company,
+            "year": year,
+            "quarter": quarter,
+            "page_nr": page_nr,
+            "source": source,
+        }
+        chunks += [
+            Document(page_content=chunk, metadata=metadata) for chunk in splitter.split_text(text)
+        ]
+
+    save_docs_to_jsonl(chunks, os.path.join(work_dir, report, "unstructured.jsonl"))
+    with open(os.path.join(work_dir, report, "lines.jsonl"), "w") as f:
+        for lines in pages:
+            f.write(json.dumps([line.dict() for line in lines]) + "\n")
+    return len(chunks)
+
+
+def load_lines(work_dir: str, report: str) -> List[List[Line]]:
+    with open(os.path.join(work_dir, report, "lines.jsonl")) as f:
+        return [[Line(**line) for line in json.loads(row)] for row in f]
+
+
+@functools.lru_cache(maxsize=None)
+def table_detector_available() -> bool:
+    try:
+        load_detector()
+        return True
+    except ImportError as e:
+        logger.warning(f"{e}; finding tables in the text layer instead")
+        return False
+
+
+def detect_report_tables(report: str, n_pages: int, pages: List[List[Line]]) -> str:
+    """
+    Store the table boxes of each page next to its image, with Table Transformer if it is
+    installed, else from the rows of figures of the text layer.
+
+    Returns:
+        str: The detection method
+    """
+    detector_available = table_detector_available()
+    for page_nr in range(1, n_pages + 1):
+        page_path = os.path.join(PAGES_PATH, report, f"{report}_page_{page_nr}.txt")
+        if detector_available:
+            store_page_tables(page_path)
+            continue
+        tables = [
+            {
+                "box": [
+                    min(line.box[0] for line in block),
+                    min(line.box[1] for line in block),
+                    max(line.box[2] for line in block),
+                    max(line.box[3] for line in block),
+                ],
+                "score": 1.0,
+            }
+            for block in find_table_blocks(pages[page_nr - 1] if page_nr <= len(pages) else [])
+        ]
+        with open(table_boxes_path(page_path), "w") as f:
+            json.dump({"model": "text-layer", "tables": tables}, f)
+    return "table-transformer" if detector_available else "text-layer"
+
+
+def summarize_tables(tables: List[Document], summarizer: str) -> List[str]:
+    """Summaries of the tables for the structured search: by the LLM, or their title and items."""
+    if summarizer == "extractive":
+        return [
+            f"Table of the {table.metadata['company']} {table.metadata['quarter']} "
+            f"{table.metadata['year']} report, page {table.metadata['page_nr']}: "
+            + "; ".join(line.split("  ")[0] for line in table.page_content.splitlines()[:12])
+            for table in tables
+        ]
+
+    llm = ChatOpenAI(model=MODEL_STRUCTURED, api_key=OPENAI_API_KEY, temperature=0.0)
+    prompts = [
+        SUMMARY_PROMPT.format(table=table.page_content, **table.metadata) for table in tables
+    ]
+    return [message.content for message in llm.batch(prompts, config={"max_concurrency": 8})]
+
+
+def build_report_tables(report: str, work_dir: str, summarizer: str) -> int:
+    """Write the structured documents of a report: the text of each table and its summary."""
+    company, quarter, year = parse_report_name(report)
+    tables = []
+    for page_nr, lines in enumerate(load_lines(work_dir, report), start=1):
+        page_path = os.path.join(PAGES_PATH, report, f"{report}_page_{page_nr}.txt")
+        if not os.path.exists(table_boxes_path(page_path)):
+            continue
+        with open(table_boxes_path(page_path)) as f:
+            boxes = [table["box"] for table in json.load(f)["tables"]]
+        for box in boxes:
+            table_lines = lines_in_box(lines, box)
+            if not table_lines:
+                continue
+            tables.append(
+                Document(
+                    page_content="\n".join(line.text for line in table_lines),
+                    metadata={
+                        "company": company,
+                        "year": year,
+                        "quarter": quarter,
+                        "page_nr": page_nr,
+                        "source": os.path.join(TEXT_PATH, report, f"{report}_page_{page_nr}.txt"),
+                    },
+                )
+            )
+
+    summaries = summarize_tables(tables, summarizer) if tables else []
+    docs = [
+        Document(
+            page_content=f"{table.page_content}\n{SUMMARY_SEPARATOR}{summary}",
+            metadata=table.metadata,
+        )
+        for table, summary in zip(tables, summaries)
+    ]
+    save_docs_to_jsonl(docs, os.path.join(work_dir, report, "structured.jsonl"))
+    return len(docs)
+
+
+def publish_collection(
+    name: str,
+    docs_by_report: Dict[str, List[Document]],
+    embedding_backend: str,
+    cache: EmbeddingCache,
+    rebuild: bool,
+    index_type: str,
+) -> Optional[str]:
+    """
+    Publish a new version of a collection with the documents of the reports it does not cover yet.
+
+    The new documents are appended to the index of the current version; the index is rebuilt from
+    all reports instead when asked to, when the collection has no version yet, when a report of
+    the current version is gone, when the embedding model or index type changed, or when the
+    current version is not sharded yet.
+
+    Returns:
+        Optional[str]: Id of the new version, None if the current one covers all reports
+    """
+    model = embedding_model(embedding_backend)
+    manifest = read_manifest(name)
+    current = None
+    if manifest is not None and manifest["current"] is not None:
+        current = next(
+            entry for entry in manifest["versions"] if entry["id"] == manifest["current"]
+        )
+    append = (
+        not rebuild
+        and current is not None
+        and current.get("sharded", False)
+        and current.get("model") == model
+        and (current.get("index") or {}).get("type", "flat") == index_type
+        and set(current["reports"]) <= set(docs_by_report)
+    )
+    reports = [
+        report for report in docs_by_report if not append or report not in current["reports"]
+    ]
+    if append and not reports:
+        logger.info(f"Collection {name} version {current['id']} covers all reports")
+        return None
+
+    docs = [doc for report in reports for doc in docs_by_report[report]]
+    embeddings = get_embeddings(embedding_backend)
+    vectors = embed_texts([doc.page_content for doc in docs], embeddings, cache)
+    logger.info(
+        f"Collection {name}: {'appending' if append else 'building'} {len(docs)} documents "
+        f"of {len(reports)} reports"
+    )
+    return publish(
+        name, docs, vectors, embeddings, reports, append=append, model=model, index_type=index_type
+    )
+
+
+def embedding_model(embedding_backend: str) -> str:
+    if embedding_backend == "hashing":
+        return f"hashing-{HashingEmbeddings().dimensions}"
+    return OPENAI_EMBEDDING_MODEL
+
+
+def run_pipeline(
+    pdf_paths: List[str],
+    work_dir: str,
+    embedding_backend: str,
+    summarizer: str,
+    workers: int,
+    dpi: int,
+    rebuild: bool = False,
+    index_type: str = VECTOR_INDEX_TYPE,
+) -> None:
+    """
+    Build the serving artifacts from report PDFs named like `volvo_q4_2023.pdf`.
+
+    Rendering and text extraction run in a process pool; each stage of a report is checkpointed in
+    `work_dir`, so a rerun only processes new reports. Their documents are appended to new versions
+    of the collections, which the API serves after a swap; the embeddings are cached in `work_dir`.
+
+    Args:
+        pdf_paths (List[str]): Reports to ingest
+        work_dir (str): Folder of the checkpoints, intermediate documents and embedding cache
+        embedding_backend (str): "openai", or "hashing" for the offline stand-in
+        summarizer (str): "openai", or "extractive" to summarize tables without an LLM
+        workers (int): Processes of the pool
+        dpi (int): Resolution of the page images
+        rebuild (bool): Rebuild the collections from all reports, e.g. after re-ingesting one
+        index_type (str): FAISS index of the collections, see INDEX_TYPES
+    """
+    reports = {os.path.splitext(os.path.basename(path))[0]: path for path in pdf_paths}
+    checkpoints = {}
+    for report in reports:
+        parse_report_name(report)
+        checkpoints[report] = Checkpoint(work_dir, report)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for report, pdf_path in reports.items():
+            checkpoint = checkpoints[report]
+            if not checkpoint.done("rendered"):
+                n_pages = page_count(pdf_path)
+                pages_dir = os.path.join(PAGES_PATH, report)
+                os.makedirs(pages_dir, exist_ok=True)
+                for first_page in range(1, n_pages + 1, RENDER_BATCH_PAGES):
+                    last_page = min(n_pages, first_page + RENDER_BATCH_PAGES - 1)
+                    future = pool.submit(
+                        render_pages, pdf_path, first_page, last_page, pages_dir, dpi
+                    )
+                    futures[future] = (report, "render")
+            if not checkpoint.done("text"):
+                futures[pool.submit(extract_report_text, pdf_path, work_dir)] = (report, "text")
+
+        failed = set()
+        for future in as_completed(futures):
+            report, stage = futures[future]
+            try:
+                result = future.result()
+                logger.info(f"{report}: {stage} done ({result})")
+            except Exception as e:
+                logger.error(f"{report}: {stage} failed: {e}")
+                failed.add((report, stage))
+
+    for report, pdf_path in reports.items():
+        checkpoint = checkpoints[report]
+        if (report, "render") in failed or (report, "text") in failed:
+            continue
+        if not checkpoint.done("rendered"):
+            checkpoint.mark("rendered", page_count(pdf_path))
+        checkpoint.mark("text")
+        if not checkpoint.done("tables"):
+            pages = load_lines(work_dir, report)
+            checkpoint.mark(
+                "tables", detect_report_tables(report, checkpoint.stages["rendered"], pages)
+            )
+        if not checkpoint.done("structured"):
+            checkpoint.mark("structured", build_report_tables(report, work_dir, summarizer))
+    if failed:
+        raise RuntimeError(f"Ingestion failed for {sorted(failed)}, rerun to resume")
+
+    # the collections cover every report ingested so far
+    structured_docs, unstructured_docs = {}, {}
+    for report in sorted(os.listdir(work_dir)):
+        report_dir = os.path.join(work_dir, report)
+        if os.path.exists(os.path.join(report_dir, "structured.jsonl")):
+            structured_docs[report] = load_docs_from_jsonl(
+                os.path.join(report_dir, "structured.jsonl")
+            )
+            unstructured_docs[report] = load_docs_from_jsonl(
+                os.path.join(report_dir, "unstructured.jsonl")
+            )
+
+    cache = EmbeddingCache(
+        os.path.join(work_dir, "embeddings.sqlite"), embedding_model(embedding_backend)
+    )
+    for name, docs_by_report in [
+        ("structured", structured_docs),
+        ("unstructured", unstructured_docs),
+    ]:
+        publish_collection(name, docs_by_report, embedding_backend, cache, rebuild, index_type)
+
+    os.makedirs(os.path.dirname(FACTS_DB_PATH), exist_ok=True)
+    n_facts = FactStore(FACTS_DB_PATH).write(
+        fact for docs in structured_docs.values() for doc in docs for fact in extract_facts(doc)
+    )
+    logger.info(f"Stored {n_facts} facts in {FACTS_DB_PATH}")
@@ -0,0 +1,114 @@
+"""
+Detect the tables of the rendered report pages with Microsoft Table Transformer and store their
+bounding boxes next to each page, for the table crops sent to the vision model.
+
+Needs the optional `transformers` and `torch` packages.
+
+Usage (from the repository root):
+    python -m app.ingest.tables
+    python -m app.ingest.tables --report volvo_q4_2023 --overwrite
+"""
+
+import argparse
+import base64
+import functools
+import glob
+import io
+import json
+import os
+from typing import List
+
+from PIL import Image
+
+from app.common import logger
+from app.common import PAGES_PATH
+from app.common.vision import table_boxes_path
+
+DETECTION_MODEL = "microsoft/table-transformer-detection"
+DETECTION_THRESHOLD = 0.9
+
+
+@functools.lru_cache(maxsize=None)
+def load_detector():
+    try:
+        import torch
+        from transformers import AutoImageProcessor
+        from transformers import TableTransformerForObjectDetection
+    except ImportError as e:
+        raise ImportError(
+            "Table detection needs the optional packages: pip install transformers torch timm"
+        ) from e
+
+    processor = AutoImageProcessor.from_pretrained(DETECTION_MODEL)
+    model = TableTransformerForObjectDetection.from_pretrained(DETECTION_MODEL)
+    model.eval()
+    return torch, processor, model
+
+
+def detect_tables(image: Image.Image, threshold: float = DETECTION_THRESHOLD) -> List[dict]:
+    """
+    Detect the tables of a page image.
+
+    Args:
+        image (Image.Image): Rendered page
+        threshold (float): Minimum detection score
+
+    Returns:
+        List[dict]: Tables with their "box" as [x0, y0, x1, y1] shares of the page width and
+        height and their detection "score", from top to bottom
+    """
+    torch, processor, model = load_detector()
+    image = image.convert("RGB")
+    with torch.no_grad():
+        outputs = model(**processor(images=image, return_tensors="pt"))
+    detections = processor.post_process_object_detection(
+        outputs, threshold=threshold, target_sizes=[(image.height, image.width)]
+    )[0]
+
+    tables = [
+        {
+            "box": [
+                round(max(0.0, x0) / image.width, 4),
+                round(max(0.0, y0) / image.height, 4),
+                round(min(image.width, x1) / image.width, 4),
+                round(min(image.height, y1) / image.height, 4),
+            ],
+            "score": round(float(score), 4),
+        }
+        for score, (x0, y0, x1, y1) in zip(
+            detections["scores"].tolist(), detections["boxes"].tolist()
+        )
+    ]
+    return sorted(tables, key=lambda table: table["box"][1])
+
+
+def store_page_tables(page_path: str, threshold: float = DETECTION_THRESHOLD) -> int:
+    """Detect the tables of a base64 PNG page and write them to its sidecar file."""
+    with open(page_path) as f:
+        image = Image.open(io.BytesIO(base64.b64decode(f.read())))
+    tables = detect_tables(image, threshold)
+    with open(table_boxes_path(page_path), "w") as f:
+        json.dump({"model": DETECTION_MODEL, "tables": tables}, f)
+    return len(tables)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--pages-path", default=PAGES_PATH)
+    parser.add_argument("--report", help="only this report, e.g. volvo_q4_2023")
+    parser.add_argument("--threshold", type=float, default=DETECTION_THRESHOLD)
+    parser.add_argument("--overwrite", action="store_true", help="detect pages done before")
+    args = parser.parse_args()
+
+    page_paths = sorted(
+        glob.glob(os.path.join(args.pages_path, args.report or "*", "*_page_*.txt"))
+    )
+    for page_path in page_paths:
+        if not args.overwrite and os.path.exists(table_boxes_path(page_path)):
+            continue
+        n_tables = store_page_tables(page_path, args.threshold)
+        logger.info(f"{os.path.basename(page_path)}: {n_tables} tables")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Throughput of a question sheet sent to /api/batch against the same questions sent one by one to
+/api/chat, with the local mock of OpenAI and Supabase.
+
+The sheet crosses metrics, companies and periods like an analyst's. Reports the time to the first
+and the last answer, the throughput and the errors of both modes.
+
+Usage (from the repository root, with the data downloaded):
+    python -m benchmarks.batch
+    python -m benchmarks.batch --questions 60 --output batch.json
+    MOCK_VISION_LATENCY_MS=1000 BATCH_CONCURRENCY=16 python -m benchmarks.batch
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from typing import List
+
+import httpx
+
+from benchmarks.loadtest import API_KEY
+from benchmarks.loadtest import services
+
+METRICS = ["revenue", "EBITDA", "net income", "total assets", "gross profit"]
+COMPANIES = ["Volvo", "H&M", "IKEA"]
+PERIODS = ["Q3 2023", "Q4 2023", "Q2 2024"]
+NARRATIVE = ["What are the main risks for {company} in {period}?"]
+
+
+def question_sheet(n_questions: int) -> List[str]:
+    """Questions of the sheet, metrics × companies × periods and a narrative one per pair."""
+    questions = [
+        f"What was the {metric} of {company} for {period}?"
+        for company, period, metric in itertools.product(COMPANIES, PERIODS, METRICS)
+    ] + [
+        template.format(company=company, period=period)
+        for company, period, template in itertools.product(COMPANIES, PERIODS, NARRATIVE)
+    ]
+    return list(itertools.islice(itertools.cycle(questions), n_questions))
+
+
+async def run_sequential(client: httpx.AsyncClient, questions: List[str]) -> dict:
+    start = time.perf_counter()
+    finished, errors = [], 0
+    for index, question in enumerate(questions):
+        response = await client.post(
+            "/api/chat",
+            json={"messages": [{"role": "user", "content": question}], "userId": f"batch-{index}"},
+        )
+        errors += response.status_code != 200
+        finished.append(time.perf_counter() - start)
+    return summary(finished, errors)
+
+
+async def run_batch(client: httpx.AsyncClient, questions: List[str]) -> dict:
+    start = time.perf_counter()
+    finished, errors = [], 0
+    async with client.stream(
+        "POST", "/api/batch", json={"questions": [{"question": q} for q in questions]}
+    ) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if line.strip():
+                errors += json.loads(line)["error"] is not None
+                finished.append(time.perf_counter() - start)
+    return summary(finished, errors)
+
+
+def summary(finished: List[float], errors: int) -> dict:
+    elapsed = finished[-1] if finished else 0.0
+    return {
+        "answers": len(finished),
+        "errors": errors,
+        "first_answer_seconds": finished[0] if finished else 0.0,
+        "elapsed_seconds": elapsed,
+        "throughput_qps": len(finished) / elapsed if elapsed else 0.0,
+    }
+
+
+async def run(args) -> dict:
+    questions = question_sheet(args.questions)
+    async with httpx.AsyncClient(
+        base_url=f"http://127.0.0.1:{args.app_port}",
+        headers={"Authorization": f"Bearer {API_KEY}"},
+        timeout=args.request_timeout,
+    ) as client:
+        # the sequential calls run second, on the caches the batch warmed, which favours them
+        batch = await run_batch(client, questions)
+        sequential = await run_sequential(client, questions)
+    return {
+        "questions": len(questions),
+        "batch": batch,
+        "sequential": sequential,
+        "speedup": (
+            sequential["elapsed_seconds"] / batch["elapsed_seconds"]
+            if batch["elapsed_seconds"]
+            else 0.0
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--questions", type=int, default=30)
+    parser.add_argument("--app-port", type=int, default=8090)
+    parser.add_argument("--mock-port", type=int, default=8100)
+    parser.add_argument("--request-timeout", type=float, default=600.0)
+    parser.add_argument("--startup-timeout", type=float, default=120.0)
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+    args.workers = 1
+
+    with services(args):
+        result = asyncio.run(run(args))
+
+    print(json.dumps(result, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Micro-benchmark of the bytes on the wire and the CPU time of a chat response with page images.
+
+Calls a minimal FastAPI app in-process through ASGI, returning the answer of a tool with report
+pages: as the API did before (PNG encoded again, validated and serialized by FastAPI), with
+orjson, with orjson and each installed compression codec, and as multipart with raw PNG parts.
+The pages are rendered like report pages, lines of words and figures on a white A4 page.
+
+Usage (from the repository root):
+    python -m benchmarks.encoding
+    python -m benchmarks.encoding --images 5 --requests 100 --output encoding.json
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import random
+import time
+from io import BytesIO
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+from fastapi import FastAPI
+from fastapi import Request
+from PIL import Image as PILImage
+from PIL import ImageDraw
+from pydantic import BaseModel
+
+from app.common.encoding import COMPRESSORS
+from app.common.encoding import encoded_response
+from app.common.middleware import CompressionMiddleware
+from app.common.sources import make_source_info
+from app.common.utils import image_png
+from app.common.utils import open_page_image
+
+WORDS = ["Revenue", "EBITDA", "SEK", "net", "income", "growth", "of", "the", "%", "Q3", "2023"]
+
+
+class Image(BaseModel):
+    base64: str
+    caption: str
+
+
+class ChatResponse(BaseModel):
+    role: str
+    content: str
+    images: Optional[List[Image]] = None
+
+
+def page_png(seed: int) -> bytes:
+    """PNG of a report-like A4 page at 150 dpi."""
+    rng = random.Random(seed)
+    image = PILImage.new("RGB", (1240, 1754), "white")
+    draw = ImageDraw.Draw(image)
+    y = 80
+    while y < 1680:
+        words = [
+            rng.choice(WORDS) if rng.random() < 0.7 else f"{rng.randint(1, 99999):,}"
+            for _ in range(rng.randint(5, 14))
+        ]
+        draw.text((80, y), " ".join(words), fill="black")
+        y += 22
+        if rng.random() < 0.05:
+            draw.rectangle((80, y, 1160, y + 2), fill=(30, 60, 120))
+            y += 10
+    buffered = BytesIO()
+    image.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+def tool_output(pngs: List[bytes]) -> dict:
+    images = [
+        open_page_image(png, make_source_info("volvo", "q3", 2023, page))
+        for page, png in enumerate(pngs, start=1)
+    ]
+    return {"result": "The revenue of Volvo for Q3 2023 was 133,5 bn SEK. " * 10, "image": images}
+
+
+def before_app(pngs: List[bytes]) -> FastAPI:
+    """The response of the API before: the pages encoded again and the model serialized by FastAPI."""
+    app = FastAPI()
+
+    @app.get("/api/answer", response_model=ChatResponse)
+    async def answer():
+        output = tool_output(pngs)
+        images = []
+        for img in output["image"]:
+            buffered = BytesIO()
+            img.save(buffered, format="PNG")
+            caption = f"{img.info['file_name']} - Page {img.info['page']}"
+            images.append(
+                Image(base64=base64.b64encode(buffered.getvalue()).decode(), caption=caption)
+            )
+        return ChatResponse(role="assistant", content=output["result"], images=images)
+
+    return app
+
+
+def encoded_app(pngs: List[bytes]) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/api/answer", response_model=ChatResponse)
+    async def answer(request: Request):
+        output = tool_output(pngs)
+        images = [
+            Image(
+                base64=base64.b64encode(image_png(img)).decode(),
+                caption=f"{img.info['file_name']} - Page {img.info['page']}",
+            )
+            for img in output["image"]
+        ]
+        result = ChatResponse(role="assistant", content=output["result"], images=images)
+        return encoded_response(result.dict(), request.headers.get("accept"))
+
+    app.add_middleware(CompressionMiddleware)
+    return app
+
+
+# name, app and request headers of each mode
+MODES: List[Tuple[str, Callable[[List[bytes]], FastAPI], Dict[str, str]]] = [
+    ("before", before_app, {}),
+    ("orjson", encoded_app, {}),
+    *[(f"orjson+{name}", encoded_app, {"accept-encoding": name}) for name in COMPRESSORS],
+    (
+        "multipart",
+        encoded_app,
+        {"accept": "multipart/mixed", "accept-encoding": ", ".join(COMPRESSORS)},
+    ),
+]
+
+
+async def call(app: FastAPI, headers: Dict[str, str]) -> Tuple[int, int, str]:
+    """One GET request through the ASGI interface: its status, body bytes and content encoding."""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/api/answer",
+        "raw_path": b"/api/answer",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"host", b"localhost")]
+        + [(name.encode(), value.encode()) for name, value in headers.items()],
+        "client": ("127.0.0.1", 1234),
+        "server": ("localhost", 80),
+    }
+    status, size, encoding = 0, 0, ""
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if requested:
+            await asyncio.Event().wait()
+        requested = True
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status, size, encoding
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            encoding = dict(message["headers"]).get(b"content-encoding", b"").decode()
+        elif message["type"] == "http.response.body":
+            size += len(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return status, size, encoding
+
+
+async def measure(app: FastAPI, headers: Dict[str, str], n_requests: int, warmup: int) -> dict:
+    for _ in range(warmup):
+        await call(app, headers)
+    latencies, cpu_times = [], []
+    for _ in range(n_requests):
+        start, start_cpu = time.perf_counter(), time.process_time()
+        status, size, encoding = await call(app, headers)
+        latencies.append(time.perf_counter() - start)
+        cpu_times.append(time.process_time() - start_cpu)
+        assert status == 200, status
+    return {
+        "bytes": size,
+        "content_encoding": encoding,
+        "p50_ms": float(np.percentile(latencies, 50)) * 1e3,
+        "cpu_ms": float(np.mean(cpu_times)) * 1e3,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--images", type=int, default=5, help="page images per response")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    pngs = [page_png(seed) for seed in range(args.images)]
+    results = {}
+    for name, make_app, headers in MODES:
+        results[name] = asyncio.run(measure(make_app(pngs), headers, args.requests, args.warmup))
+
+    print(f"\n== {args.images} pages of {sum(map(len, pngs)) // args.images} bytes on average")
+    print(f"{'response':<16}{'bytes':>10}{'vs before':>11}{'p50 ms':>9}{'cpu ms':>9}")
+    for name, stats in results.items():
+        stats["bytes_ratio"] = stats["bytes"] / results["before"]["bytes"]
+        print(
+            f"{name:<16}{stats['bytes']:>10}{stats['bytes_ratio']:>11.2f}"
+            f"{stats['p50_ms']:>9.1f}{stats['cpu_ms']:>9.1f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""
+End-to-end load test of /api/chat against the local mock of OpenAI and Supabase.
+
+Starts benchmarks.mock_server and the FastAPI app as subprocesses, drives /api/chat with
+concurrent virtual users replaying a mix of conversations, and reports latency percentiles,
+throughput, error rate and the RSS of the app processes.
+
+Usage (from the repository root, with the data downloaded):
+    python -m benchmarks.loadtest --users 20 --duration 60
+    python -m benchmarks.loadtest --users 50 --workers 4 --output loadtest.json
+    MOCK_VISION_LATENCY_MS=5000 python -m benchmarks.loadtest --users 10
+    SPECULATIVE_RETRIEVAL=true python -m benchmarks.loadtest --users 10
+    MOCK_SLOW_RATE=0.05 HEDGED_LLM_CALLS=true python -m benchmarks.loadtest --users 10
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from typing import Dict
+from typing import Iterator
+from typing import List
+
+import httpx
+import numpy as np
+from prometheus_client.parser import text_string_to_metric_families
+
+
+API_KEY = "loadtest-key"
+# a syntactically valid JWT, the mock does not check it
+SUPABASE_KEY = "eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.eyJyb2xlIjoiYW5vbiJ9.bW9jaw"
+
+# (weight, turns) pairs; follow-up turns are sent with the previous answers as history
+CONVERSATIONS = [
+    (3, ["What was the EBITDA of Volvo for 2023?"]),
+    (3, ["What was the gross profit of H&M for Q2 2024?"]),
+    (2, ["Total comprehensive income of IKEA for 2022?"]),
+    (2, ["What were the sales of H&M in the Nordics for Q1 2024?"]),
+    (2, ["How did IKEA determine the fair value of the financial instruments in 2023?"]),
+    (2, ["What are the main risks for Volvo in 2024?"]),
+    (1, ["H&M management board members for 2023?"]),
+    (
+        2,
+        [
+            "What was the full revenue of Volvo for Q4 2023?",
+            "And what were the main risks mentioned in that report?",
+        ],
+    ),
+    (1, ["Hello! Which companies do you have data for?"]),
+]
+
+
+def process_rss_mb(pid: int) -> float:
+    """RSS of a process and its children (uvicorn workers) in MB, from /proc."""
+    total_kb = 0
+    pids = [pid]
+    try:
+        children = subprocess.run(
+            ["pgrep", "-P", str(pid)], capture_output=True, text=True
+        ).stdout.split()
+        pids += [int(child) for child in children]
+    except FileNotFoundError:
+        pass
+
+    for process_id in pids:
+        try:
+            with open(f"/proc/{process_id}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+        except FileNotFoundError:
+            continue
+    return total_kb / 1024
+
+
+async def wait_healthy(url: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(url)).status_code < 500:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise TimeoutError(f"{url} did not become healthy in {timeout}s")
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.errors: Dict[str, int] = {}
+        self.requests = 0
+
+    def record(self, latency: float, error: str = None) -> None:
+        self.requests += 1
+        if error is None:
+            self.latencies.append(latency)
+        else:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+
+async def virtual_user(client: httpx.AsyncClient, user_id: int, stop_at: float, stats: Stats):
+    weights = [weight for weight, _ in CONVERSATIONS]
+    conversations = [turns for _, turns in CONVERSATIONS]
+    while time.monotonic() < stop_at:
+        messages = []
+        for turn in random.choices(conversations, weights=weights)[0]:
+            messages.append({"role": "user", "content": turn})
+            start = time.perf_counter()
+            try:
+                response = await client.post(
+                    "/api/chat", json={"messages": messages, "userId": f"loadtest-{user_id}"}
+                )
+                latency = time.perf_counter() - start
+                if response.status_code != 200:
+                    stats.record(latency, f"HTTP {response.status_code}")
+                    break
+                stats.record(latency)
+                messages.append({"role": "assistant", "content": response.json()["content"]})
+            except httpx.HTTPError as e:
+                stats.record(time.perf_counter() - start, type(e).__name__)
+                break
+
+
+async def run_load(args, app_process: subprocess.Popen) -> dict:
+    stats = Stats()
+    rss_samples = []
+    stop_at = time.monotonic() + args.duration
+
+    async def sample_rss():
+        while time.monotonic() < stop_at:
+            rss_samples.append(process_rss_mb(app_process.pid))
+            await asyncio.sleep(1)
+
+    async with httpx.AsyncClient(
+        base_url=f"http://127.0.0.1:{args.app_port}",
+        headers={"Authorization": f"Bearer {API_KEY}"},
+        timeout=args.request_timeout,
+        limits=httpx.Limits(max_connections=args.users),
+    ) as client:
+        start = time.perf_counter()
+        await asyncio.gather(
+            sample_rss(),
+            *(virtual_user(client, user_id, stop_at, stats) for user_id in range(args.users)),
+        )
+        elapsed = time.perf_counter() - start
+        metrics = (await client.get("/metrics")).text
+
+    latencies = stats.latencies or [0.0]
+    return {
+        "users": args.users,
+        "workers": args.workers,
+        "duration_seconds": elapsed,
+        "requests": stats.requests,
+        "throughput_rps": len(stats.latencies) / elapsed,
+        "error_rate": sum(stats.errors.values()) / stats.requests if stats.requests else 0.0,
+        "errors": stats.errors,
+        "latency_ms": {
+            "p50": float(np.percentile(latencies, 50)) * 1000,
+            "p95": float(np.percentile(latencies, 95)) * 1000,
+            "p99": float(np.percentile(latencies, 99)) * 1000,
+            "max": max(latencies) * 1000,
+        },
+        "rss_mb": {
+            "start": rss_samples[0] if rss_samples else 0.0,
+            "max": max(rss_samples) if rss_samples else 0.0,
+        },
+        "speculation": speculation_stats(metrics),
+        "hedging": hedging_stats(metrics),
+    }
+
+
+def hedging_stats(metrics: str) -> dict:
+    """
+    Outcomes of the hedgeable LLM calls (HEDGED_LLM_CALLS=true) and the share of them hedged, from
+    the /metrics of the worker that served the scrape.
+    """
+    outcomes: Dict[str, float] = {}
+    for family in text_string_to_metric_families(metrics):
+        for sample in family.samples:
+            if sample.name == "kapital_llm_hedged_calls_total":
+                outcome = sample.labels["outcome"]
+                outcomes[outcome] = outcomes.get(outcome, 0.0) + sample.value
+    total = sum(outcomes.values())
+    hedged = outcomes.get("primary_won", 0.0) + outcomes.get("hedge_won", 0.0)
+    return {"outcomes": outcomes, "hedge_rate": hedged / total if total else 0.0}
+
+
+def speculation_stats(metrics: str) -> dict:
+    """
+    Outcomes of the speculative searches (SPECULATIVE_RETRIEVAL=true) and the search time saved by
+    the hits, from the /metrics of the worker that served the scrape.
+    """
+    outcomes: Dict[str, float] = {}
+    saved = {"sum": 0.0, "count": 0.0}
+    for family in text_string_to_metric_families(metrics):
+        for sample in family.samples:
+            if sample.name == "kapital_speculations_total":
+                outcome = sample.labels["outcome"]
+                outcomes[outcome] = outcomes.get(outcome, 0.0) + sample.value
+            elif sample.name.startswith("kapital_speculation_saved_seconds_"):
+                kind = sample.name.rsplit("_", 1)[1]
+                if kind in saved:
+                    saved[kind] += sample.value
+    total = sum(outcomes.values())
+    claimed = total - outcomes.get("unused", 0.0)
+    return {
+        "outcomes": outcomes,
+        # of the searches of the tools called, and of all the speculative searches
+        "hit_rate": outcomes.get("hit", 0.0) / claimed if claimed else 0.0,
+        "unused_rate": outcomes.get("unused", 0.0) / total if total else 0.0,
+        "saved_ms_per_hit": saved["sum"] / saved["count"] * 1000 if saved["count"] else 0.0,
+    }
+
+
+@contextmanager
+def services(args) -> Iterator[subprocess.Popen]:
+    """
+    Run the mock server and the app (with args.workers workers) on args.mock_port and
+    args.app_port until the block exits, yielding the app process once both are healthy.
+    """
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    env = dict(
+        os.environ,
+        OPENAI_API_KEY="sk-mock",
+        OPENAI_BASE_URL=f"{mock_url}/v1",
+        OPENAI_API_BASE=f"{mock_url}/v1",
+        SUPABASE_URL=mock_url,
+        SUPABASE_KEY=SUPABASE_KEY,
+        API_KEYS=API_KEY,
+    )
+    env.pop("environment", None)
+
+    processes = []
+    try:
+        processes.append(
+            subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "benchmarks.mock_server:app"]
+                + ["--port", str(args.mock_port), "--log-level", "warning"],
+                env=env,
+            )
+        )
+        app_process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.api:app", "--port", str(args.app_port)]
+            + ["--workers", str(args.workers), "--log-level", "warning"],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        processes.append(app_process)
+
+        asyncio.run(wait_healthy(f"{mock_url}/docs", args.startup_timeout))
+        asyncio.run(
+            wait_healthy(f"http://127.0.0.1:{args.app_port}/api/health", args.startup_timeout)
+        )
+        yield app_process
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=10, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers of the app")
+    parser.add_argument("--app-port", type=int, default=8090)
+    parser.add_argument("--mock-port", type=int, default=8100)
+    parser.add_argument("--request-timeout", type=float, default=120.0)
+    parser.add_argument("--startup-timeout", type=float, default=120.0)
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    with services(args) as app_process:
+        result = asyncio.run(run_load(args, app_process))
+
+    print(json.dumps(result, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Micro-benchmark of the per-request overhead of the authentication middleware.
+
+Calls a minimal FastAPI app in-process through ASGI, without a server or network, with no
+middleware, with the two `@app.middleware("http")` functions the API used before, and with
+`AuthMiddleware`. Reports the latency per request and the overhead over the bare app, for a
+small JSON response and a streamed one.
+
+Usage (from the repository root):
+    python -m benchmarks.middleware
+    python -m benchmarks.middleware --requests 20000 --output middleware.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from typing import Callable
+from typing import Dict
+from typing import List
+
+import numpy as np
+from fastapi import FastAPI
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from fastapi.responses import StreamingResponse
+
+from app.common.middleware import AuthMiddleware
+
+API_KEY = "benchmark-key"
+PUBLIC_PATHS = {"/api/health", "/metrics"}
+
+
+def base_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/api/ping")
+    async def ping():
+        return {"status": "ok"}
+
+    @app.get("/api/stream")
+    async def stream():
+        async def chunks():
+            for i in range(10):
+                yield f"{i}\n".encode()
+
+        return StreamingResponse(chunks(), media_type="text/plain")
+
+    return app
+
+
+def http_middleware_app() -> FastAPI:
+    """The middleware of the API before AuthMiddleware, on BaseHTTPMiddleware."""
+    app = base_app()
+
+    @app.middleware("http")
+    async def enforce_https(request: Request, call_next):
+        if os.getenv("environment") == "production":
+            if request.url.scheme != "https":
+                return JSONResponse(status_code=403, content={"detail": "HTTPS is required"})
+        return await call_next(request)
+
+    @app.middleware("http")
+    async def validate_api_key(request: Request, call_next):
+        if request.url.path in PUBLIC_PATHS:
+            return await call_next(request)
+        auth_header = request.headers.get("Authorization")
+        if not auth_header or not auth_header.startswith("Bearer "):
+            return JSONResponse(status_code=401, content={"detail": "Missing Authorization"})
+        if auth_header.split(" ")[1] not in {API_KEY}:
+            return JSONResponse(status_code=403, content={"detail": "Invalid API key"})
+        return await call_next(request)
+
+    return app
+
+
+def asgi_middleware_app() -> FastAPI:
+    app = base_app()
+    app.add_middleware(AuthMiddleware, api_keys={API_KEY}, public_paths=PUBLIC_PATHS)
+    return app
+
+
+APPS: Dict[str, Callable[[], FastAPI]] = {
+    "none": base_app,
+    "http_middleware": http_middleware_app,
+    "asgi_middleware": asgi_middleware_app,
+}
+
+
+async def call(app: FastAPI, path: str) -> int:
+    """One GET request through the ASGI interface, returning the status and draining the body."""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"host", b"localhost"), (b"authorization", f"Bearer {API_KEY}".encode())],
+        "client": ("127.0.0.1", 1234),
+        "server": ("localhost", 80),
+    }
+    status = 0
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if requested:
+            # like a server, wait for the client to disconnect; cancelled when the response ends
+            await asyncio.Event().wait()
+        requested = True
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+
+async def measure(app: FastAPI, path: str, n_requests: int, warmup: int) -> List[float]:
+    for _ in range(warmup):
+        await call(app, path)
+    latencies = []
+    for _ in range(n_requests):
+        start = time.perf_counter()
+        status = await call(app, path)
+        latencies.append(time.perf_counter() - start)
+        assert status == 200, status
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--warmup", type=int, default=500)
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    results = {}
+    for path in ["/api/ping", "/api/stream"]:
+        results[path] = {}
+        for name, make_app in APPS.items():
+            latencies = asyncio.run(measure(make_app(), path, args.requests, args.warmup))
+            results[path][name] = {
+                "mean_us": float(np.mean(latencies)) * 1e6,
+                "p50_us": float(np.percentile(latencies, 50)) * 1e6,
+                "p99_us": float(np.percentile(latencies, 99)) * 1e6,
+            }
+
+    for path, by_app in results.items():
+        print(f"\n== GET {path}, {args.requests} requests")
+        print(f"{'middleware':<18}{'mean us':>10}{'p50 us':>10}{'p99 us':>10}{'overhead us':>14}")
+        for name, stats in by_app.items():
+            overhead = stats["p50_us"] - by_app["none"]["p50_us"]
+            stats["overhead_p50_us"] = overhead
+            print(
+                f"{name:<18}{stats['mean_us']:>10.1f}{stats['p50_us']:>10.1f}"
+                f"{stats['p99_us']:>10.1f}{overhead:>14.1f}"
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
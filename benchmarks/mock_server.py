@@ -0,0 +1,212 @@
+"""
+Local stand-in for the OpenAI API (chat, vision, embeddings) and the Supabase REST insert and
+select, for load tests without network access or API costs.
+
+Configured with environment variables:
+    MOCK_CHAT_LATENCY_MS, MOCK_VISION_LATENCY_MS, MOCK_EMBEDDING_LATENCY_MS: mean latencies
+    MOCK_LATENCY_JITTER: relative standard deviation of the latencies (default 0.3)
+    MOCK_SLOW_RATE, MOCK_SLOW_FACTOR: share of the calls slowed down by the factor, for a long
+        tail like OpenAI's (default 0, 5)
+    MOCK_SUPABASE_LATENCY_MS: latency of the conversation insert
+    MOCK_PROMPT_TOKENS, MOCK_COMPLETION_TOKENS: token counts reported in the usage
+    MOCK_EMBEDDING_DIMENSIONS: size of the embeddings, must match the served indexes (default 1536)
+
+Usage:
+    uvicorn benchmarks.mock_server:app --port 8100
+"""
+
+import asyncio
+import json
+import os
+import random
+import re
+import time
+import uuid
+from collections import deque
+from typing import Dict
+
+from fastapi import FastAPI
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from fastapi.responses import StreamingResponse
+
+from app.common.embeddings import HashingEmbeddings
+
+
+CHAT_LATENCY_MS = float(os.getenv("MOCK_CHAT_LATENCY_MS", "800"))
+VISION_LATENCY_MS = float(os.getenv("MOCK_VISION_LATENCY_MS", "3000"))
+EMBEDDING_LATENCY_MS = float(os.getenv("MOCK_EMBEDDING_LATENCY_MS", "150"))
+SUPABASE_LATENCY_MS = float(os.getenv("MOCK_SUPABASE_LATENCY_MS", "50"))
+LATENCY_JITTER = float(os.getenv("MOCK_LATENCY_JITTER", "0.3"))
+SLOW_RATE = float(os.getenv("MOCK_SLOW_RATE", "0"))
+SLOW_FACTOR = float(os.getenv("MOCK_SLOW_FACTOR", "5"))
+PROMPT_TOKENS = int(os.getenv("MOCK_PROMPT_TOKENS", "2000"))
+COMPLETION_TOKENS = int(os.getenv("MOCK_COMPLETION_TOKENS", "150"))
+
+NUMERIC_PATTERN = re.compile(
+    r"\b(revenue|sales|profit|income|ebitda?|liabilities|assets|equity|total|amount|how much)\b",
+    re.IGNORECASE,
+)
+COMPANY_PATTERN = re.compile(r"\b(volvo|h&m|ikea)\b", re.IGNORECASE)
+YEAR_PATTERN = re.compile(r"\b(20\d{2})\b")
+QUARTER_PATTERN = re.compile(r"\bq([1-4])\b", re.IGNORECASE)
+# context sources of the unstructured prompt, as a list of dicts or as "[i]" lines
+SOURCE_INDEX_PATTERN = re.compile(r"'index': \d+|^\[\d+\]", re.MULTILINE)
+
+app = FastAPI()
+# rows inserted into the Supabase tables
+tables: Dict[str, deque] = {}
+embeddings = HashingEmbeddings(dimensions=int(os.getenv("MOCK_EMBEDDING_DIMENSIONS", "1536")))
+
+
+async def sleep_ms(mean_ms: float) -> None:
+    if random.random() < SLOW_RATE:
+        mean_ms *= SLOW_FACTOR
+    await asyncio.sleep(max(0.0, random.gauss(mean_ms, mean_ms * LATENCY_JITTER)) / 1000)
+
+
+def usage(prompt_tokens: int = PROMPT_TOKENS) -> dict:
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": COMPLETION_TOKENS,
+        "total_tokens": prompt_tokens + COMPLETION_TOKENS,
+    }
+
+
+def message_text(message: dict) -> str:
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if part.get("type") == "text")
+    return content
+
+
+def tool_call(query: str) -> dict:
+    """Call a tool with arguments extracted from the query, like the agent would."""
+    tool = "structured_tool" if NUMERIC_PATTERN.search(query) else "unstructured_tool"
+    arguments = {
+        "user_query": query,
+        "company_names": [company for company in COMPANY_PATTERN.findall(query)] or ["Volvo"],
+        "years": [int(year) for year in YEAR_PATTERN.findall(query)] or None,
+        "quarters": [f"q{quarter}" for quarter in QUARTER_PATTERN.findall(query)] or None,
+    }
+    return {
+        "id": f"call_{uuid.uuid4().hex[:24]}",
+        "type": "function",
+        "function": {"name": tool, "arguments": json.dumps(arguments)},
+    }
+
+
+def completion(model: str, message: dict, finish_reason: str, stream: bool):
+    if not stream:
+        return JSONResponse(
+            {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+                "usage": usage(),
+            }
+        )
+
+    delta = dict(message)
+    if "tool_calls" in delta:
+        delta["tool_calls"] = [dict(call, index=i) for i, call in enumerate(delta["tool_calls"])]
+    chunks = [
+        {"index": 0, "delta": delta, "finish_reason": None},
+        {"index": 0, "delta": {}, "finish_reason": finish_reason},
+    ]
+    body = "".join(
+        "data: "
+        + json.dumps(
+            {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [chunk],
+            }
+        )
+        + "\n\n"
+        for chunk in chunks
+    )
+    return StreamingResponse(iter([body + "data: [DONE]\n\n"]), media_type="text/event-stream")
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    messages = body["messages"]
+    stream = body.get("stream", False)
+
+    if body.get("tools"):
+        # agent routing: call a tool once, then finish after its observation
+        await sleep_ms(CHAT_LATENCY_MS)
+        if any(message.get("role") == "tool" for message in messages):
+            return completion(
+                body["model"], {"role": "assistant", "content": "Done."}, "stop", stream
+            )
+        message = {
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [tool_call(message_text(messages[-1]))],
+        }
+        return completion(body["model"], message, "tool_calls", stream)
+
+    images = sum(
+        part.get("type") == "image_url"
+        for message in messages
+        if isinstance(message.get("content"), list)
+        for part in message["content"]
+    )
+    await sleep_ms(VISION_LATENCY_MS if images else CHAT_LATENCY_MS)
+    # cite the first two sources, if there are any
+    sources = images or len(
+        SOURCE_INDEX_PATTERN.findall(" ".join(message_text(message) for message in messages))
+    )
+    content = json.dumps(
+        {
+            "response": "The answer is: 42 MSEK.",
+            "context_sources_indices": list(range(min(2, sources))),
+        }
+    )
+    return completion(body["model"], {"role": "assistant", "content": content}, "stop", stream)
+
+
+@app.post("/v1/embeddings")
+async def create_embeddings(request: Request):
+    body = await request.json()
+    inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    await sleep_ms(EMBEDDING_LATENCY_MS)
+    # LangChain sends token ids, which are hashed like words
+    texts = [
+        " ".join(str(token) for token in item) if isinstance(item, list) else item
+        for item in inputs
+    ]
+    vectors = embeddings.embed_documents(texts)
+    return {
+        "object": "list",
+        "data": [
+            {"object": "embedding", "index": i, "embedding": vector}
+            for i, vector in enumerate(vectors)
+        ],
+        "model": body.get("model", ""),
+        "usage": {"prompt_tokens": 8 * len(texts), "total_tokens": 8 * len(texts)},
+    }
+
+
+@app.post("/rest/v1/{table}")
+async def supabase_insert(table: str, request: Request):
+    body = json.loads(await request.body() or b"[]")
+    await sleep_ms(SUPABASE_LATENCY_MS)
+    rows = tables.setdefault(table, deque(maxlen=10000))
+    for row in body if isinstance(body, list) else [body]:
+        rows.append({**row, "created_at": time.time()})
+    return JSONResponse([], status_code=201)
+
+
+@app.get("/rest/v1/{table}")
+async def supabase_select(table: str, limit: int = 1000):
+    """The latest rows inserted, whatever the selected columns and the order asked for."""
+    await sleep_ms(SUPABASE_LATENCY_MS)
+    return JSONResponse(list(tables.get(table, []))[::-1][:limit])
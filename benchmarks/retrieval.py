@@ -0,0 +1,352 @@
+"""
+Offline retrieval benchmark for the hybrid search of both tools.
+
+Embeds the corpora with a deterministic local stand-in for the OpenAI embeddings, so it runs
+without network access. Reports latency percentiles and throughput per retrieval stage, memory
+per phase and recall against a labeled question set, for a FAISS index type with its recall
+against exact search.
+
+Usage:
+    python -m benchmarks.retrieval --tool both --corpus real
+    python -m benchmarks.retrieval --tool unstructured --corpus synthetic --scale 100
+    python -m benchmarks.retrieval --questions questions.jsonl --output results.json
+    python -m benchmarks.retrieval --corpus synthetic --scale 50 --index-type hnsw-int8 --ef-search 32
+    python -m benchmarks.retrieval --repeat 3 --retrieval-cache
+
+Labeled questions are JSON lines such as:
+    {"tool": "structured_tool", "query": "Total liabilities of Volvo in 2023",
+     "companies": ["volvo"], "years": [2023], "quarters": ["q4", "annual"],
+     "relevant": [{"company": "volvo", "year": 2023, "page_nr": 84}]}
+Without them, questions are sampled from the corpus itself: a snippet of a document is the query
+and the document's page is the relevant one.
+"""
+
+import argparse
+import json
+import os
+import random
+import time
+from collections import defaultdict
+from typing import Dict
+from typing import List
+
+import numpy as np
+from langchain.schema import Document
+
+from app.common import INDEX_SEARCH_PARAMS
+from app.common import STRUCTURED_VDB_PATH
+from app.common import TOP_K
+from app.common import TOP_K_UNSTRUCTURED
+from app.common import tracing
+from app.common import UNSTRUCTURED_VDB_PATH
+from app.common.embeddings import HashingEmbeddings
+from app.common.retrieval import hybrid_search
+from app.common.sources import SUMMARY_SEPARATOR
+from app.common.utils import load_docs_from_jsonl
+from app.common.utils import metadata_filter_callable
+from app.common.vector_index import build_index
+from app.common.vector_index import faiss_description
+from app.common.vector_index import index_bytes
+from app.common.vector_index import INDEX_TYPES
+from app.common.vector_index import prepare_index
+from app.common.vector_index import recall_vs_flat
+from app.common.vector_store import Collection
+
+
+TOOLS = {
+    "structured_tool": {"vdb_path": STRUCTURED_VDB_PATH, "top_k": TOP_K},
+    "unstructured_tool": {"vdb_path": UNSTRUCTURED_VDB_PATH, "top_k": TOP_K_UNSTRUCTURED},
+}
+
+SYNTHETIC_VOCABULARY = (
+    "revenue sales profit income ebit ebitda margin liabilities assets equity cash flow debt "
+    "earnings dividend expenses costs loans turnover deficit retained gross net operating "
+    "risk strategy trend outlook policy impact opportunities board management sustainability "
+    "lease currency supply chain demand inflation interest rate impairment goodwill tax "
+    "segment region nordics europe americas asia store online growth decline increase decrease"
+).split()
+
+
+def rss_mb() -> float:
+    """Current resident set size of the process in MB, from /proc."""
+    with open("/proc/self/statm") as f:
+        resident_pages = int(f.read().split()[1])
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def percentile(values: List[float], q: float) -> float:
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def synthetic_documents(tool: str, n_docs: int, seed: int) -> List[Document]:
+    """Generate random documents with the metadata and layout of the tool's corpus."""
+    rng = random.Random(seed)
+    companies = [f"company{i}" for i in range(max(1, n_docs // 500))]
+    documents = []
+    for i in range(n_docs):
+        company = rng.choice(companies)
+        year = rng.choice([2022, 2023, 2024])
+        quarter = rng.choice(["q1", "q2", "q3", "q4", "annual"])
+        page_nr = rng.randint(1, 200)
+        text = " ".join(rng.choices(SYNTHETIC_VOCABULARY, k=rng.randint(40, 200)))
+        if tool == "structured_tool":
+            summary = " ".join(rng.choices(SYNTHETIC_VOCABULARY, k=20))
+            text = f"{text}\n{SUMMARY_SEPARATOR}{summary}"
+        documents.append(
+            Document(
+                page_content=f"{text} doc{i}",
+                metadata={
+                    "company": company,
+                    "year": year,
+                    "quarter": quarter,
+                    "page_nr": page_nr,
+                    "source": f"data/{company}_{quarter}_{year}/{company}_{quarter}_{year}.txt",
+                },
+            )
+        )
+    return documents
+
+
+def scale_documents(documents: List[Document], scale: int) -> List[Document]:
+    """
+    Grow a real corpus by copying it under new company names, so the documents per company (and
+    hence the BM25 partitions) keep their size while the vector index grows `scale` times.
+    """
+    scaled = list(documents)
+    for copy in range(1, scale):
+        for doc in documents:
+            metadata = dict(doc.metadata, company=f"{doc.metadata['company']}{copy}")
+            scaled.append(Document(page_content=f"{doc.page_content} ({copy})", metadata=metadata))
+    return scaled
+
+
+def load_corpus(tool: str, corpus: str, scale: int, synthetic_docs: int, seed: int):
+    docs_path = os.path.join(TOOLS[tool]["vdb_path"], "docs.jsonl")
+    if corpus == "real":
+        documents = load_docs_from_jsonl(docs_path)
+        return scale_documents(documents, scale) if scale > 1 else documents
+    if os.path.exists(docs_path):
+        return scale_documents(load_docs_from_jsonl(docs_path), scale)
+    return synthetic_documents(tool, synthetic_docs * scale, seed)
+
+
+def sample_questions(tool: str, documents: List[Document], n: int, seed: int) -> List[dict]:
+    """Use snippets of random documents as queries, with their page as the relevant one."""
+    rng = random.Random(seed)
+    questions = []
+    for doc in rng.sample(documents, min(n, len(documents))):
+        text = doc.page_content
+        if tool == "structured_tool" and SUMMARY_SEPARATOR in text:
+            text = text.split(SUMMARY_SEPARATOR)[1]
+        words = text.split()
+        start = rng.randint(0, max(0, len(words) - 12))
+        metadata = doc.metadata
+        questions.append(
+            {
+                "tool": tool,
+                "query": " ".join(words[start : start + 12]),
+                "companies": [metadata["company"]],
+                "years": [metadata["year"]],
+                "quarters": [metadata["quarter"]],
+                "relevant": [
+                    {
+                        "company": metadata["company"],
+                        "year": metadata["year"],
+                        "page_nr": metadata["page_nr"],
+                    }
+                ],
+            }
+        )
+    return questions
+
+
+def run_query(collection: Collection, question: dict, top_k: int, use_cache: bool = False):
+    """Run the hybrid search of a tool for one question and collect its stage latencies."""
+    query_metadata = {
+        "company": question["companies"],
+        "year": question["years"],
+        "quarter": question["quarters"],
+    }
+    metadata_filter = metadata_filter_callable(
+        companies=question["companies"], years=question["years"], quarters=question["quarters"]
+    )
+    with tracing.start_trace("benchmark", sampled=True) as trace:
+        start = time.perf_counter()
+        docs = hybrid_search(
+            collection,
+            question["query"],
+            query_metadata,
+            metadata_filter,
+            top_k,
+            tool=question["tool"],
+            use_cache=use_cache,
+        )
+        total = time.perf_counter() - start
+
+    stage_latencies = {
+        span.name: (span.end_time_ns - span.start_time_ns) / 1e9
+        for span in trace.spans
+        if span.name != "benchmark"
+    }
+    stage_latencies["total"] = total
+    return docs, stage_latencies
+
+
+def recall(docs: List[Document], relevant: List[dict], k: int) -> float:
+    retrieved = {
+        (doc.metadata["company"], doc.metadata["year"], doc.metadata["page_nr"]) for doc in docs[:k]
+    }
+    relevant_keys = {(item["company"], item["year"], item["page_nr"]) for item in relevant}
+    return len(retrieved & relevant_keys) / len(relevant_keys) if relevant_keys else 0.0
+
+
+def benchmark_tool(tool: str, args, questions: List[dict]) -> dict:
+    top_k = TOOLS[tool]["top_k"]
+    rss_start = rss_mb()
+
+    start = time.perf_counter()
+    documents = load_corpus(tool, args.corpus, args.scale, args.synthetic_docs, args.seed)
+    load_seconds = time.perf_counter() - start
+    rss_loaded = rss_mb()
+
+    embeddings = HashingEmbeddings(dimensions=args.dimensions)
+    start = time.perf_counter()
+    texts = [doc.page_content for doc in documents]
+    vectors = embeddings.embed_documents(texts)
+    db = build_index(
+        args.index_type, texts, vectors, [doc.metadata for doc in documents], embeddings
+    )
+    name = tool.split("_")[0]
+    collection = Collection.in_memory(name, "benchmark", db, documents)
+    search_params = dict(INDEX_SEARCH_PARAMS[name])
+    if args.ef_search:
+        search_params["efSearch"] = args.ef_search
+    if args.nprobe:
+        search_params["nprobe"] = args.nprobe
+    prepare_index(db.index, search_params)
+    index_seconds = time.perf_counter() - start
+    rss_indexed = rss_mb()
+    recall_flat = recall_vs_flat(db.index, vectors, k=top_k, seed=args.seed)
+    # query-time embedding latency is simulated, index building is not
+    embeddings.latency_ms = args.embedding_latency_ms
+
+    tool_questions = [question for question in questions if question["tool"] == tool]
+    if not tool_questions:
+        tool_questions = sample_questions(tool, documents, args.queries, args.seed)
+
+    stage_latencies: Dict[str, List[float]] = defaultdict(list)
+    recalls = []
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for question in tool_questions:
+            docs, latencies = run_query(collection, question, top_k, args.retrieval_cache)
+            for stage, latency in latencies.items():
+                stage_latencies[stage].append(latency)
+            recalls.append(recall(docs, question["relevant"], top_k))
+    query_seconds = time.perf_counter() - start
+    n_queries = args.repeat * len(tool_questions)
+
+    return {
+        "tool": tool,
+        "index": faiss_description(db.index),
+        "search_params": search_params,
+        "documents": len(documents),
+        "queries": n_queries,
+        "load_seconds": load_seconds,
+        "index_build_seconds": index_seconds,
+        "throughput_qps": n_queries / query_seconds if query_seconds else 0.0,
+        f"recall_at_{top_k}": float(np.mean(recalls)) if recalls else 0.0,
+        "recall_vs_flat": recall_flat,
+        "memory_mb": {
+            "corpus": rss_loaded - rss_start,
+            "index": rss_indexed - rss_loaded,
+            "queries": rss_mb() - rss_indexed,
+            "index_vectors": db.index.ntotal * db.index.d * 4 / 2**20,
+            "index_serialized": index_bytes(db.index) / 2**20,
+        },
+        "stages": {
+            stage: {
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "mean_ms": float(np.mean(latencies)) * 1000,
+                "throughput_per_s": len(latencies) / sum(latencies) if sum(latencies) else 0.0,
+            }
+            for stage, latencies in stage_latencies.items()
+        },
+    }
+
+
+def print_report(result: dict) -> None:
+    print(f"\n== {result['tool']}: {result['documents']} documents, {result['queries']} queries")
+    recall_key = next(key for key in result if key.startswith("recall_at_"))
+    print(
+        f"load {result['load_seconds']:.2f}s, index build {result['index_build_seconds']:.2f}s, "
+        f"throughput {result['throughput_qps']:.1f} q/s, {recall_key} {result[recall_key]:.3f}"
+    )
+    print(
+        f"index {result['index']} {result['search_params']}, "
+        f"recall vs flat {result['recall_vs_flat']:.3f}"
+    )
+    print(
+        "memory (MB): "
+        + ", ".join(f"{phase} {mb:.1f}" for phase, mb in result["memory_mb"].items())
+    )
+    print(f"{'stage':<18}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'mean ms':>10}{'ops/s':>10}")
+    for stage, stats in result["stages"].items():
+        print(
+            f"{stage:<18}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}"
+            f"{stats['mean_ms']:>10.2f}{stats['throughput_per_s']:>10.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tool", choices=["structured", "unstructured", "both"], default="both")
+    parser.add_argument(
+        "--corpus",
+        choices=["real", "synthetic"],
+        default="real",
+        help="real: data/*_vdb docs; synthetic: real docs copied --scale times, "
+        "or random docs if the data is missing",
+    )
+    parser.add_argument("--scale", type=int, default=1, help="corpus size multiplier")
+    parser.add_argument(
+        "--synthetic-docs", type=int, default=2000, help="random docs per scale unit"
+    )
+    parser.add_argument("--questions", help="labeled questions (JSON lines)")
+    parser.add_argument("--queries", type=int, default=100, help="sampled questions per tool")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--index-type", choices=list(INDEX_TYPES), default="flat")
+    parser.add_argument("--ef-search", type=int, help="HNSW efSearch, default: the tool's")
+    parser.add_argument("--nprobe", type=int, help="IVF lists searched, default: the tool's")
+    parser.add_argument("--embedding-latency-ms", type=float, default=0.0)
+    parser.add_argument(
+        "--retrieval-cache",
+        action="store_true",
+        help="use the retrieval cache, hit by the queries after the first --repeat",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    questions = []
+    if args.questions:
+        with open(args.questions) as f:
+            questions = [json.loads(line) for line in f if line.strip()]
+
+    tools = (
+        ["structured_tool", "unstructured_tool"] if args.tool == "both" else [f"{args.tool}_tool"]
+    )
+    results = [benchmark_tool(tool, args, questions) for tool in tools]
+    for result in results:
+        print_report(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+Startup benchmark of the app: import time and time to first healthy response, against a budget.
+
+Imports app.api, which the server imports before it listens, and app.chat, the chat backend it
+loads in the background, in fresh interpreters and breaks their import time down per top-level
+package with `python -X importtime`. Then starts benchmarks.mock_server and the app as
+subprocesses and measures, from the start of the app process, the time to its first response,
+to its first healthy response and to its first answered /api/chat request. Exits with status 1
+if a median is over its budget.
+
+Usage (from the repository root, with the data downloaded):
+    python -m benchmarks.startup
+    python -m benchmarks.startup --repeat 5 --runs 5 --output startup.json
+    python -m benchmarks.startup --budget-import 1.5 --budget-healthy 10
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import httpx
+import numpy as np
+
+from benchmarks.loadtest import API_KEY
+from benchmarks.loadtest import SUPABASE_KEY
+
+# imported by the server before it listens, and loaded in the background once it does
+MODULES = ["app.api", "app.chat"]
+
+QUESTION = "What was the EBITDA of Volvo for 2023?"
+
+
+def app_env(mock_url: str) -> Dict[str, str]:
+    env = dict(
+        os.environ,
+        OPENAI_API_KEY="sk-mock",
+        OPENAI_BASE_URL=f"{mock_url}/v1",
+        OPENAI_API_BASE=f"{mock_url}/v1",
+        SUPABASE_URL=mock_url,
+        SUPABASE_KEY=SUPABASE_KEY,
+        API_KEYS=API_KEY,
+    )
+    env.pop("environment", None)
+    return env
+
+
+def import_seconds(module: str, env: Dict[str, str]) -> float:
+    """Wall time of importing a module in a fresh interpreter."""
+    code = f"import time; start = time.perf_counter(); import {module}; "
+    code += "print(time.perf_counter() - start)"
+    result = subprocess.run(
+        [sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True
+    )
+    return float(result.stdout.split()[-1])
+
+
+def import_breakdown(module: str, env: Dict[str, str], top: int) -> Dict[str, float]:
+    """
+    Seconds spent importing each top-level package when importing a module, from the self times
+    of `python -X importtime`, the largest first.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    packages: Dict[str, float] = defaultdict(float)
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:") :].split("|")
+        packages[name.strip().split(".")[0]] += int(self_us) / 1e6
+    ranked = sorted(packages.items(), key=lambda item: item[1], reverse=True)
+    return {name: round(seconds, 3) for name, seconds in ranked[:top]}
+
+
+def wait_for(url: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url)
+            return
+        except httpx.TransportError:
+            time.sleep(0.1)
+    raise TimeoutError(f"{url} did not respond in {timeout}s")
+
+
+def cold_start(args, env: Dict[str, str]) -> Dict[str, Optional[float]]:
+    """
+    Start the app and measure the seconds to its first response, its first healthy response and
+    its first answered chat request.
+    """
+    app_url = f"http://127.0.0.1:{args.app_port}"
+    timings: Dict[str, Optional[float]] = {"first_response": None, "healthy": None, "chat": None}
+    start = time.monotonic()
+    app_process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.api:app", "--port", str(args.app_port)]
+        + ["--log-level", "warning"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        with httpx.Client(base_url=app_url, timeout=args.request_timeout) as client:
+            while time.monotonic() - start < args.startup_timeout:
+                try:
+                    status_code = client.get("/api/health").status_code
+                except httpx.TransportError:
+                    time.sleep(0.02)
+                    continue
+                if timings["first_response"] is None:
+                    timings["first_response"] = time.monotonic() - start
+                if status_code == 200:
+                    timings["healthy"] = time.monotonic() - start
+                    break
+                time.sleep(0.02)
+            if timings["healthy"] is None:
+                raise TimeoutError(f"The app did not become healthy in {args.startup_timeout}s")
+
+            response = client.post(
+                "/api/chat",
+                json={"messages": [{"role": "user", "content": QUESTION}], "userId": "startup"},
+                headers={"Authorization": f"Bearer {API_KEY}"},
+            )
+            response.raise_for_status()
+            timings["chat"] = time.monotonic() - start
+    finally:
+        app_process.terminate()
+        app_process.wait()
+    return timings
+
+
+def median(values: List[float]) -> float:
+    return round(float(np.median(values)), 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=3, help="imports timed per module")
+    parser.add_argument("--runs", type=int, default=3, help="cold starts of the app")
+    parser.add_argument("--top", type=int, default=15, help="packages listed per import")
+    parser.add_argument("--app-port", type=int, default=8091)
+    parser.add_argument("--mock-port", type=int, default=8101)
+    parser.add_argument("--request-timeout", type=float, default=120.0)
+    parser.add_argument("--startup-timeout", type=float, default=120.0)
+    parser.add_argument(
+        "--budget-import", type=float, default=1.5, help="seconds to import app.api"
+    )
+    parser.add_argument(
+        "--budget-first-response", type=float, default=3.0, help="seconds to the first response"
+    )
+    parser.add_argument(
+        "--budget-healthy", type=float, default=15.0, help="seconds to the first healthy response"
+    )
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    env = app_env(mock_url)
+
+    result = {"imports": {}, "cold_start": {}}
+    for module in MODULES:
+        seconds = [import_seconds(module, env) for _ in range(args.repeat)]
+        result["imports"][module] = {
+            "seconds": median(seconds),
+            "packages": import_breakdown(module, env, args.top),
+        }
+
+    mock_process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "benchmarks.mock_server:app"]
+        + ["--port", str(args.mock_port), "--log-level", "warning"],
+        env=env,
+    )
+    try:
+        wait_for(f"{mock_url}/docs", args.startup_timeout)
+        runs = [cold_start(args, env) for _ in range(args.runs)]
+    finally:
+        mock_process.terminate()
+        mock_process.wait()
+    for name in runs[0]:
+        result["cold_start"][name] = median([run[name] for run in runs])
+
+    budgets = {
+        "import app.api": (result["imports"]["app.api"]["seconds"], args.budget_import),
+        "first_response": (result["cold_start"]["first_response"], args.budget_first_response),
+        "healthy": (result["cold_start"]["healthy"], args.budget_healthy),
+    }
+    result["over_budget"] = [
+        f"{name}: {seconds}s > {budget}s"
+        for name, (seconds, budget) in budgets.items()
+        if seconds > budget
+    ]
+
+    print(json.dumps(result, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=4)
+    if result["over_budget"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
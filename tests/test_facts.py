@@ -0,0 +1,103 @@
+import pytest
+
+from app.common.facts import Fact
+from app.common.facts import FactStore
+from app.common.facts import normalize_item
+from app.common.facts import period_quarter
+
+
+def make_fact(quarter: str, period: str, value: float, line_item: str = "EBITDA") -> Fact:
+    return Fact(
+        company="volvo",
+        year=2023,
+        quarter=quarter,
+        period_year=2023,
+        period=period,
+        line_item=line_item,
+        item_key=normalize_item(line_item),
+        value=value,
+        value_text=str(value),
+        page_nr=1,
+        file_name=f"volvo_{quarter}_2023.pdf",
+    )
+
+
+def make_store(tmp_path, facts) -> FactStore:
+    store = FactStore(str(tmp_path / "facts.sqlite"))
+    store.write(facts)
+    return store
+
+
+def test_annual_fact_does_not_answer_a_quarter(tmp_path):
+    store = make_store(tmp_path, [make_fact("annual", "2023", 100.0)])
+
+    assert store.match("EBITDA of Volvo Q2 2023", "volvo", 2023, ["q2"], ["Volvo"]) is None
+    assert store.match("EBITDA of Volvo 2023", "volvo", 2023, ["annual"], ["Volvo"]).value == 100.0
+
+
+def test_quarter_column_answers_its_quarter_only(tmp_path):
+    store = make_store(
+        tmp_path,
+        [make_fact("q2", "Apr-Jun 2023", 30.0), make_fact("q2", "Jan-Jun 2023", 55.0)],
+    )
+
+    assert store.match("EBITDA of Volvo Q2 2023", "volvo", 2023, ["q2"], ["Volvo"]).value == 30.0
+    assert store.match("EBITDA of Volvo 2023", "volvo", 2023, ["annual"], ["Volvo"]) is None
+
+
+def test_default_quarters_match_the_annual_column(tmp_path):
+    store = make_store(
+        tmp_path,
+        [
+            make_fact("q4", "Oct-Dec 2023", 140.0, "Net sales"),
+            make_fact("q4", "Jan-Dec 2023", 552.0, "Net sales"),
+        ],
+    )
+
+    fact = store.match(
+        "What were net sales of Volvo in 2023?", "volvo", 2023, ["q4", "annual"], ["Volvo"]
+    )
+    assert fact.value == 552.0
+    assert (
+        store.match("Net sales of Volvo Q4 2023", "volvo", 2023, ["q4"], ["Volvo"]).value == 140.0
+    )
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "What was the net sales growth of Volvo in 2023?",
+        "How much did net sales increase for Volvo in 2023?",
+        "Change in total liabilities of Volvo in 2023",
+        "Volvo operating income margin 2023",
+    ],
+)
+def test_derived_figures_fall_back(tmp_path, query):
+    store = make_store(
+        tmp_path,
+        [
+            make_fact("annual", "2023", 552.0, "Net sales"),
+            make_fact("annual", "2023", 300.0, "Total liabilities"),
+            make_fact("annual", "2023", 60.0, "Operating income"),
+        ],
+    )
+
+    assert store.match(query, "volvo", 2023, ["q4", "annual"], ["Volvo"]) is None
+
+
+def test_line_item_naming_a_derived_word_matches(tmp_path):
+    store = make_store(tmp_path, [make_fact("annual", "2023", 11.2, "Operating margin")])
+
+    fact = store.match("Operating margin of Volvo 2023", "volvo", 2023, ["annual"], ["Volvo"])
+    assert fact.value == 11.2
+
+
+def test_period_quarter():
+    assert period_quarter("Q3 2023", "q3") == "q3"
+    assert period_quarter("Oct-Dec 2023", "q4") == "q4"
+    assert period_quarter("Jan-Dec 2023", "q4") == "annual"
+    assert period_quarter("Full year 2023", "q4") == "annual"
+    assert period_quarter("30 Jun 2023", "q2") == "q2"
+    assert period_quarter("Jan-Sep 2023", "q3") is None
+    assert period_quarter("2023", "q2") is None
+    assert period_quarter("2023", "annual") == "annual"